@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""
+Timing checks for the slow spots in the toolset.
+
+Usage:
+    ./benchmarks.py gini --year 2010     # Gini scaling on the largest state
+    ./benchmarks.py gini --synthetic 20000
+    ./benchmarks.py decode --year 1998       # Row decoding on a fixed width layout
+"""
+import sys
+import time
+import random
+import argparse
+import csv
+import tempfile
+import itertools
+import os
+
+from segcalc import SegCalc
+from segcalc import gini_pairwise_sum
+from segcalc_array import ArraySegCalc
+from segcalc_array import columns_from_schools
+from nces_parser import NCESParser
+from nces_parser import decode_records
+
+# ==============================================================================
+# Constants
+# ==============================================================================
+# Don't bother timing the O(n^2) form past this many schools
+MAX_PAIRWISE = 4000
+
+# ==============================================================================
+# Functions
+# ==============================================================================
+def timeit(func, *args):
+    """
+    Return (seconds, result) for one call
+    """
+    start = time.time()
+    result = func(*args)
+    return (time.time() - start, result)
+
+# -------------------------------------
+def synthetic_schools(count, seed=0):
+    """
+    Random schools all in one state, enough to time things without NCES data
+    """
+    rnd = random.Random(seed)
+    schools = []
+    for i in range(count):
+        black = rnd.randint(0, 500)
+        white = rnd.randint(0, 500)
+        schools.append({
+            'FIPS': '06',
+            'LEAID': '06%05d' % (i / 50),
+            'BLACK': float(black),
+            'WHITE': float(white),
+            'MEMBER': float(black + white + rnd.randint(0, 100)),
+        })
+    return schools
+
+# -------------------------------------
+def bench_gini(args):
+    """
+    Time the pairwise Gini sum against the sorted SegCalc/ArraySegCalc
+    versions for increasing numbers of schools in the largest state.
+    """
+    if args.synthetic:
+        schools = synthetic_schools(args.synthetic)
+    else:
+        schools = NCESParser(year=args.year).parse(make_dict=True)
+
+    # Largest state by number of schools
+    counts = {}
+    for school in schools:
+        counts[school['FIPS']] = counts.get(school['FIPS'], 0) + 1
+    fips = max(counts.keys(), key=lambda key: counts[key])
+    state = [school for school in schools if school['FIPS'] == fips]
+    print "Largest State: %s, %d Schools" % (fips, len(state))
+
+    idx = {
+        'MINORITY': 'BLACK',
+        'MAJORITY': 'WHITE',
+        'TOTAL': 'MEMBER',
+        'CATEGORY': 'FIPS',
+    }
+
+    sizes = []
+    size = 250
+    while size < len(state):
+        sizes.append(size)
+        size *= 2
+    sizes.append(len(state))
+
+    print "%8s %12s %12s %12s %12s" % ("Schools", "Pairwise", "Sorted", "Array", "Difference")
+    for size in sizes:
+        subset = state[:size]
+        sorted_time, gini = timeit(SegCalc(subset, idx).calc_gini_coef)
+        array_time, array_gini = timeit(ArraySegCalc(columns_from_schools(subset), idx).calc_gini_coef)
+
+        if size <= MAX_PAIRWISE:
+            points = []
+            for school in subset:
+                if school['BLACK'] >= 0 and school['MEMBER'] > 0:
+                    points.append((float(int(school['BLACK']))/int(school['MEMBER']), int(school['MEMBER'])))
+            T, Py, Pz = SegCalc(subset, idx).calc_cat_totals()
+            pair_time, num = timeit(gini_pairwise_sum, points)
+            diff = abs(num / (2 * T[fips] * T[fips] * Py[fips] * (1 - Py[fips])) - gini[fips])
+            print "%8d %12.4f %12.4f %12.4f %12.2g" % (size, pair_time, sorted_time, array_time, diff)
+        else:
+            print "%8d %12s %12.4f %12.4f %12s" % (size, "-", sorted_time, array_time, "-")
+
+# -------------------------------------
+def synthetic_lines(parser, count, seed=0):
+    """
+    Random fixed width rows for a parser's layout, numbers in the 'N'
+    columns (with the odd missing value marker) and letters elsewhere.
+    """
+    rnd = random.Random(seed)
+    width = max([instr[3] for instr in parser.parse_instr])
+    lines = []
+    for i in range(count):
+        line = [' '] * width
+        for name, type, lo, hi, desc in parser.parse_instr:
+            size = hi - lo
+            if type == 'N':
+                if rnd.random() < 0.02:
+                    val = 'M'
+                else:
+                    val = str(rnd.randint(0, 10 ** min(size, 6) - 1))
+                val = val.rjust(size)
+            else:
+                val = "".join([rnd.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ ") for j in range(size)])
+            line[lo:hi] = list(val)
+        lines.append("".join(line) + "\r\n")
+    return lines
+
+# -------------------------------------
+def bench_decode(args):
+    """
+    Time the field by field parse_line against the compiled row decoder and
+    the bulk decoder on a synthetic data file built from a real layout.
+    """
+    parser = NCESParser(year=args.year)
+    parser.read_formatfile(parser.formatfile)
+    if parser.index_mode:
+        raise Exception("%d uses a tab separated layout, pick a fixed width year" % args.year)
+
+    fd, fname = tempfile.mkstemp()
+    os.write(fd, "".join(synthetic_lines(parser, args.rows)))
+    os.close(fd)
+    try:
+        lines = open(fname, 'rb').readlines()
+        generic_time, generic = timeit(lambda: [parser.parse_line_generic(line) for line in lines])
+        decode = parser.get_decoder()
+        decoder_time, decoded = timeit(lambda: [decode(line) for line in lines])
+        data = "".join(lines)
+        bulk_time, columns = timeit(decode_records, data, len(lines[0]), parser.parse_instr)
+        file_time, schools = timeit(parser.parse_orig, fname)
+    finally:
+        os.remove(fname)
+
+    if generic != decoded:
+        raise Exception("Compiled decoder doesn't match parse_line")
+    if map(list, zip(*columns)) != decoded:
+        raise Exception("Bulk decoder doesn't match parse_line")
+    print "Layout %d, %d Columns, %d Rows" % (args.year, len(parser.parse_instr), args.rows)
+    print "%-20s %10.4f" % ("parse_line", generic_time)
+    print "%-20s %10.4f  (%.1fx)" % ("compiled decoder", decoder_time, generic_time / decoder_time)
+    print "%-20s %10.4f  (%.1fx)" % ("bulk decoder", bulk_time, generic_time / bulk_time)
+    print "%-20s %10.4f" % ("parse_orig (file)", file_time)
+
+# -------------------------------------
+def synthetic_tsv_lines(parser, count, columns=0, seed=0):
+    """
+    Random tab separated rows for an index mode layout, numbers in the
+    'N' columns (with the odd missing value marker), words elsewhere
+    and filler in the columns the layout doesn't keep.  The rows are
+    padded out to columns fields.
+    """
+    rnd = random.Random(seed)
+    words = ["".join([rnd.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for j in range(6)]) for i in range(1000)]
+    width = max([instr[2] for instr in parser.parse_instr] + [columns - 1]) + 1
+    lines = []
+    for i in range(count):
+        line = ['X'] * width
+        for name, type, pos, hi, desc in parser.parse_instr:
+            if type == 'N':
+                if rnd.random() < 0.02:
+                    val = rnd.choice(['M', 'N', '-1', '-2'])
+                else:
+                    val = str(rnd.randint(0, 3000))
+            else:
+                val = " ".join([rnd.choice(words) for j in range(rnd.randint(1, 4))])
+            line[pos] = val
+        lines.append("\t".join(line) + "\r\n")
+    return lines
+
+# -------------------------------------
+def bench_tsv(args):
+    """
+    Time the csv.reader line by line decode against the block reader, on
+    their own and for the whole parse, on a synthetic tab separated data
+    file built from a real layout.
+    """
+    parser = NCESParser(year=args.year)
+    parser.read_formatfile(parser.formatfile)
+    if not parser.index_mode:
+        raise Exception("%d uses a fixed width layout, pick a tab separated year" % args.year)
+
+    lines = synthetic_tsv_lines(parser, args.rows, args.columns)
+    fd, fname = tempfile.mkstemp()
+    os.write(fd, "HEADER\r\n" + "".join(lines))
+    os.close(fd)
+    try:
+        decode = parser.get_decoder()
+        csv_time, decoded = timeit(lambda: map(decode, csv.reader(parser.open_datafile(fname), dialect='excel-tab')))
+        block_time, rows = timeit(lambda: list(itertools.chain.from_iterable(parser.iter_tsv_blocks(parser.open_datafile(fname)))))
+        if rows != decoded:
+            raise Exception("Block reader doesn't match the csv.reader decode")
+        del decoded, rows
+        lines_time, schools = timeit(lambda: list(parser.iter_lines(parser.open_datafile(fname))))
+        del schools
+        file_time, schools = timeit(parser.parse_orig, fname)
+    finally:
+        os.remove(fname)
+
+    print "Layout %d, %d of %d Columns, %d Rows" % (args.year, len(parser.parse_instr),
+            lines[0].count("\t") + 1, args.rows)
+    print "%-20s %10.4f" % ("csv.reader", csv_time)
+    print "%-20s %10.4f  (%.1fx)" % ("block reader", block_time, csv_time / block_time)
+    print "%-20s %10.4f" % ("iter_lines (file)", lines_time)
+    print "%-20s %10.4f  (%.1fx)" % ("parse_orig (file)", file_time, lines_time / file_time)
+
+# -------------------------------------
+# Parse the command line options
+# -------------------------------------
+def main(argv):
+    parser = argparse.ArgumentParser(description='Segrete Benchmarks')
+    subparsers = parser.add_subparsers()
+
+    gini = subparsers.add_parser('gini', help='Gini coefficient scaling')
+    gini.add_argument('--year', action='store', dest='year', required=False, type=int, default=2010,
+            help='Year of NCES data to use')
+    gini.add_argument('--synthetic', action='store', dest='synthetic', required=False, type=int,
+            help='Use this many random schools instead of NCES data')
+    gini.set_defaults(func=bench_gini)
+
+    decode = subparsers.add_parser('decode', help='Raw data file row decoding')
+    decode.add_argument('--year', action='store', dest='year', required=False, type=int, default=1998,
+            help='Year of the fixed width layout file to use')
+    decode.add_argument('--rows', action='store', dest='rows', required=False, type=int, default=100000,
+            help='Number of synthetic rows to decode')
+    decode.set_defaults(func=bench_decode)
+
+    tsv = subparsers.add_parser('tsv', help='Tab separated data file decoding')
+    tsv.add_argument('--year', action='store', dest='year', required=False, type=int, default=2010,
+            help='Year of the tab separated layout file to use')
+    tsv.add_argument('--rows', action='store', dest='rows', required=False, type=int, default=100000,
+            help='Number of synthetic rows to decode')
+    tsv.add_argument('--columns', action='store', dest='columns', required=False, type=int, default=0,
+            help='Pad the synthetic rows out to this many columns, the full NCES files have a few hundred')
+    tsv.set_defaults(func=bench_tsv)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+# -------------------------------------
+# Drop the script name from the args
+# and call our command line parser
+# -------------------------------------
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -8,6 +8,9 @@ import argparse
 
 from segcalc import SegCalc
 from nces_parser import NCESParser
+from nces_parser import FLAG_CHARTER
+from nces_parser import FLAG_MAGNET
+from nces_parser import FLAG_OPEN
 
 from xlwt import Workbook
 from xlwt import Formula
@@ -31,6 +34,8 @@ def main(argv):
             help='Local Agency (School District) ID')
     parser.add_argument('--fips', action='store', dest='fips', required=False,
             help='ANSI State Code')
+    parser.add_argument('--subset', action='store', dest='subset', required=False,
+            help='Read a subset cached by nces_parser.py --outputs (e.g. urban, city_san_jose)')
     parser.add_argument('-debug', action='store_true', dest='debug', required=False,
             help='Debug Mode')
     args = parser.parse_args()
@@ -47,8 +52,8 @@ def main(argv):
     else:
         fips = None
 
-    nces = NCESParser(year=2010)
-    schools = nces.parse(make_dict=True)
+    nces = NCESParser(year=2010, subset=args.subset)
+    schools = nces.iter_schools(make_dict=True)
 
     wb = Workbook()
     sheets = []
@@ -100,14 +105,15 @@ def main(argv):
     dist_black = 0.0
     dist_hisp = 0.0
     for school in schools:
+        flags = int(school['FLAGS'])
         if (
             (
                 school['LEAID'] == leaid and
-                school['STATUS'] == '1'
+                flags & FLAG_OPEN
             ) or
             (
                 school['FIPS'] == fips and
-                school['STATUS'] == '1'
+                flags & FLAG_OPEN
             ) or
             (
                 not leaid and
@@ -115,9 +121,9 @@ def main(argv):
             )
         ):
             # print school
-            if school['CHARTR'] == '1':
+            if flags & FLAG_CHARTER:
                 idx = 1
-            elif school['MAGNET'] == '1':
+            elif flags & FLAG_MAGNET:
                 idx = 2
             else:
                 idx = 0
@@ -1,14 +1,36 @@
 #!/usr/bin/env python
 """
-Download all the NCES Data and the file format information and merge it into 
-UTF-8 txt files.
+Download all the NCES Data and the file format information.  The layout
+files are re-encoded into UTF-8 txt files, the data is left in the zip
+archives it comes in, nces_parser.py reads the (latin-1) data straight
+out of them, see get_archives().
+
+Files are fetched several at a time, an interrupted download picks up
+where it left off and every finished file's SHA-1 goes in a manifest
+(nces_files.json), so a rerun only fetches what's missing or damaged.
+--refresh asks the server whether the files we have are still current.
 
 Usage:
-   ./nces_get.py
+   ./nces_get.py [--jobs N] [--refresh]
 
 """
 import os
-from subprocess import call
+import sys
+import json
+import time
+import shutil
+import socket
+import httplib
+import urllib2
+import hashlib
+import zipfile
+import argparse
+import tempfile
+import threading
+import unittest
+import SocketServer
+import BaseHTTPServer
+from multiprocessing.pool import ThreadPool
 
 # ==============================================================================
 # Filelist
@@ -58,59 +80,256 @@ special_filenames = {
     }
 
 
+# Downloads running at once
+CONNECTIONS = 4
+
+# Attempts at each file, every retry resumes from what has arrived so far
+RETRIES = 5
+RETRY_WAIT = 2      # Seconds before the first retry, doubled for each one after
+TIMEOUT = 60
+
+BLOCK_SIZE = 64 * 1024
+manifest_name = "nces_files.json"
+
 # ==============================================================================
 # Download the files
 # ==============================================================================
+class Downloader(object):
+    """
+    Fetch files over HTTP into one directory, up to connections at a time.
+
+    Each file is written to name.part and renamed once it is complete, a
+    failed attempt is retried with a Range request for the rest of it.
+    The manifest records the size, SHA-1 and the server's ETag and
+    Last-Modified for every finished file.  A file that matches its
+    manifest entry is left alone, or with refresh only fetched again if
+    the server says it has changed.
+    """
+    def __init__(self, dirname, connections=CONNECTIONS, refresh=False, retries=RETRIES, retry_wait=RETRY_WAIT):
+        self.dirname = dirname
+        self.connections = connections
+        self.refresh = refresh
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.opener = urllib2.build_opener()
+        self.lock = threading.Lock()
+        self.manifest = self.read_manifest()
+
+    # --------------------------------------
+    def get_filename(self, name):
+        return os.path.join(self.dirname, name)
+
+    # --------------------------------------
+    def read_manifest(self):
+        try:
+            with open(self.get_filename(manifest_name), 'rb') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    # --------------------------------------
+    def update_manifest(self, name, entry):
+        """
+        Record a file and save the manifest, it only shows up once it's
+        completely written
+        """
+        with self.lock:
+            self.manifest[name] = entry
+            fd, tmpname = tempfile.mkstemp(dir=self.dirname, suffix=".tmp")
+            with os.fdopen(fd, 'wb') as f:
+                json.dump(self.manifest, f, indent=1, sort_keys=True)
+            os.rename(tmpname, self.get_filename(manifest_name))
+
+    # --------------------------------------
+    def is_current(self, name):
+        """
+        True if the file is there and matches its manifest entry
+        """
+        entry = self.manifest.get(name, {})
+        fname = self.get_filename(name)
+        if 'sha1' not in entry or not os.path.exists(fname):
+            return False
+        return os.path.getsize(fname) == entry['size'] and file_sha1(fname) == entry['sha1']
+
+    # --------------------------------------
+    def fetch(self, url, name=None):
+        """
+        Download url into the directory (as name, default the last part of
+        the url).  Returns True if the file was downloaded, False if the
+        copy we have is current.
+        """
+        if name is None:
+            name = url.split('/')[-1]
+        current = self.is_current(name)
+        if current and not self.refresh:
+            return False
+
+        for attempt in range(self.retries):
+            try:
+                return self.attempt(url, name, current)
+            except urllib2.HTTPError as e:
+                if e.code < 500:
+                    raise
+                error = e
+            except (urllib2.URLError, httplib.HTTPException, socket.error, IOError) as e:
+                error = e
+            print "Download of %s failed (%s), retrying" % (name, error)
+            time.sleep(self.retry_wait * 2**attempt)
+        raise Exception("Could not download %s: %s" % (url, error))
+
+    # --------------------------------------
+    def attempt(self, url, name, current):
+        """
+        One try at fetching a file, conditional if we have a current copy,
+        otherwise resuming whatever is in name.part.  The partial download
+        is only resumed if the file hasn't changed on the server since.
+        """
+        fname = self.get_filename(name)
+        part = fname + ".part"
+        entry = self.manifest.get(name, {})
+        validator = entry.get('etag') or entry.get('last_modified')
+
+        request = urllib2.Request(url)
+        done = 0
+        if current:
+            if entry.get('etag'):
+                request.add_header('If-None-Match', entry['etag'])
+            if entry.get('last_modified'):
+                request.add_header('If-Modified-Since', entry['last_modified'])
+        elif os.path.exists(part) and validator:
+            done = os.path.getsize(part)
+            request.add_header('Range', 'bytes=%d-' % done)
+            request.add_header('If-Range', validator)
+
+        try:
+            response = self.opener.open(request, timeout=TIMEOUT)
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                print "%s is up to date" % name
+                return False
+            if e.code == 416:
+                # The partial file is no good, start again
+                os.remove(part)
+                return self.attempt(url, name, current)
+            raise
+
+        info = response.info()
+        etag = info.getheader('ETag')
+        last_modified = info.getheader('Last-Modified')
+        if response.getcode() == 206:
+            total = int(info.getheader('Content-Range').split('/')[-1])
+            mode = 'ab'
+        else:
+            total = info.getheader('Content-Length')
+            if total is not None:
+                total = int(total)
+            mode = 'wb'
+            # Remember what we're downloading, a retry resumes it
+            self.update_manifest(name, dict(url=url, etag=etag, last_modified=last_modified))
+
+        with open(part, mode) as f:
+            while True:
+                block = response.read(BLOCK_SIZE)
+                if not block:
+                    break
+                f.write(block)
+        response.close()
+
+        size = os.path.getsize(part)
+        if total is not None and size != total:
+            raise IOError("stopped at %d of %d bytes" % (size, total))
+        os.rename(part, fname)
+        self.update_manifest(name, dict(url=url, etag=etag, last_modified=last_modified,
+                size=size, sha1=file_sha1(fname)))
+        print "Downloaded %s" % name
+        return True
+
+    # --------------------------------------
+    def fetch_all(self, downloads):
+        """
+        Fetch a list of (url, name), returns the fetch() result for each,
+        None for any that couldn't be downloaded
+        """
+        def fetch(download):
+            try:
+                return self.fetch(*download)
+            except Exception as e:
+                print "Cannot download %s: %s" % (download[0], e)
+                return None
+
+        if not downloads:
+            return []
+        pool = ThreadPool(processes=min(self.connections, len(downloads)))
+        try:
+            return pool.map(fetch, downloads)
+        finally:
+            pool.close()
+            pool.join()
+
 # --------------------------------------
-# Call wget
-# --------------------------------------
-def download(addr):
-    call(["wget", addr])
+def file_sha1(fname):
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), ''):
+            sha1.update(block)
+    return sha1.hexdigest()
 
 # --------------------------------------
-# Unzip
+# Find the data in the archives
 # --------------------------------------
-def unzip(filename):
+def get_archives(year):
     """
-    Unzip and remove the zip file
+    [(zip file, member), ...] holding the raw data for a year, in order,
+    the split years (ai/kn/ow) have one archive per part.  Empty if the
+    year isn't one we know how to download.
     """
-    call(["unzip", filename])
-    call(["rm", filename])
-
-# --------------------------------------
-# Construct the final filename
-# --------------------------------------
-def get_unzip_filenames(year, filenames):
-    if year in special_filenames.keys():
-        return special_filenames[year]
+    year = year % 100
+    if year in split_old_format_years:
+        parts = [(old_format % (year, split), txt_ext, zip_ext) for split in splits]
+    elif year in split_new_format_years:
+        ver = split_new_format_ver[split_new_format_years.index(year)]
+        parts = [(new_format % (year, ver, split), dat_ext, zip_ext) for split in splits]
+    elif year in new_format_years:
+        ver = new_format_ver[new_format_years.index(year)]
+        parts = [(new_format % (year, ver, ""), txt_ext, new_zip_ext)]
+    elif year in supp_format_years:
+        ver = supp_format_ver[supp_format_years.index(year)]
+        parts = [(supp_format % (year, ver, "_supp"), txt_ext, supp_zip_ext)]
     else:
-        return filenames
+        return []
 
-# --------------------------------------
-# Merge
-# --------------------------------------
-def merge(year, filenames, dest):
-    filenames = get_unzip_filenames(year, filenames)
-    try:
-        fout = open(dest, 'wb')
-        for file in filenames:
-            fin = open(file, 'rb')
-            for line in fin:
-                fout.write(line.decode('latin1').encode('utf-8'))
-            fin.close()
-        fout.close()
+    archives = []
+    for i, (filename, ext, archive_ext) in enumerate(parts):
+        member = filename + ext
+        if year in special_filenames:
+            member = special_filenames[year][i]
+        archives.append((filename + archive_ext, member))
+    return archives
 
-        # Delete the split files
-        call(["rm"] + filenames)
-    except IOError:
-        print "Cannot find files: ", filenames
+# --------------------------------------
+def find_member(names, member):
+    """
+    The name in an archive's namelist() for a member, the NCES isn't
+    consistent about case or folders inside the zip files.  An archive
+    with just the one file in it is that file.
+    """
+    if member in names:
+        return member
+    for name in names:
+        if os.path.basename(name).lower() == member.lower():
+            return name
+    files = [name for name in names if not name.endswith('/')]
+    if len(files) == 1:
+        return files[0]
+    raise Exception("Cannot find %s in the archive, it has %s" % (member, ", ".join(names)))
 
 # --------------------------------------
 # Rename
 # --------------------------------------
 def utf8_encode(src, dest):
     """
-    For non-split datafiles, re-encode to UTF-8 to fit our conventions
+    Re-encode the layout files to UTF-8 to fit our conventions, the
+    original is kept so the downloader can tell it's current
     """
     try:
         fin = open(src, 'rb')
@@ -119,7 +338,6 @@ def utf8_encode(src, dest):
             fout.write(line.decode('latin1').encode('utf-8'))
         fin.close()
         fout.close()
-        call(["rm"] + [src])
     except IOError:
         print "Cannot find file: ", src
 
@@ -135,103 +353,188 @@ def std_layout_filename(year):
 # --------------------------------------
 # Download and Process Routines
 # --------------------------------------
-def get_layout_files():
+def layout_files():
+    """
+    [(layout file, our name for it), ...] for every year
+    """
+    files = []
     for year in split_old_format_years:
-        layout_filename = old_layout_format % (year)
-        print layout_filename
-        if not os.path.exists(layout_filename) and not os.path.exists(std_layout_filename(year)):
-            download(layout_web_addr + layout_filename)  # Layout file
-            utf8_encode(layout_filename, std_layout_filename(year))
+        files.append((old_layout_format % (year), std_layout_filename(year)))
 
     for i, year in enumerate(split_new_format_years):
         if year > 50 or year < 2:
             layout_filename = old_layout_format % (year)
         else:
             layout_filename = new_layout_format % (year, split_new_format_ver[i])
-        if not os.path.exists(layout_filename) and not os.path.exists(std_layout_filename(year)):
-            download(layout_web_addr + layout_filename)
-            utf8_encode(layout_filename, std_layout_filename(year))
+        files.append((layout_filename, std_layout_filename(year)))
 
     for i, year in enumerate(new_format_years):
-        layout_filename = new_layout_format % (year, new_format_ver[i])
-        if not os.path.exists(layout_filename) and not os.path.exists(std_layout_filename(year)):
-            download(layout_web_addr + layout_filename)
-            utf8_encode(layout_filename, std_layout_filename(year))
+        files.append((new_layout_format % (year, new_format_ver[i]), std_layout_filename(year)))
 
     for i, year in enumerate(supp_format_years):
-        layout_filename = supp_layout_format % (year, supp_format_ver[i])
-        if not os.path.exists(layout_filename) and not os.path.exists(std_layout_filename(year)):
-            download(layout_web_addr + layout_filename)
-            utf8_encode(layout_filename, std_layout_filename(year))
+        files.append((supp_layout_format % (year, supp_format_ver[i]), std_layout_filename(year)))
+    return files
 
 # --------------------------------------
-# Download the files
-# --------------------------------------
-def get_data_files():
-    for year in split_old_format_years:
-        for split in splits:
-            filename = old_format % (year, split) + zip_ext
-            if not os.path.exists(filename) and not os.path.exists(std_data_filename(year)):
-                download(web_addr + filename)
-
-    for i, year in enumerate(split_new_format_years):
-        for split in splits:
-            filename = new_format % (year, split_new_format_ver[i], split) + zip_ext
-            if not os.path.exists(filename) and not os.path.exists(std_data_filename(year)):
-                download(web_addr + filename)
-
-    for i, year in enumerate(new_format_years):
-        filename = new_format % (year, new_format_ver[i], "") + new_zip_ext
-        if not os.path.exists(filename) and not os.path.exists(std_data_filename(year)):
-            download(web_addr + filename)
-
-    for i, year in enumerate(supp_format_years):
-        filename = supp_format % (year, supp_format_ver[i], "_supp") + supp_zip_ext
-        if not os.path.exists(filename) and not os.path.exists(std_data_filename(year)):
-            download(web_addr + filename)
+def data_files():
+    """
+    [(archive, merged data file), ...] for every year, a year that was
+    merged into one data file by an older version of this script doesn't
+    need its archives
+    """
+    files = []
+    for year in split_old_format_years + split_new_format_years + new_format_years + supp_format_years:
+        for zipname, member in get_archives(year):
+            files.append((zipname, std_data_filename(year)))
+    return files
 
 # --------------------------------------
-# Unzip, Encode and Rename the files
-# --------------------------------------
-def cleanup_files():
-    for year in split_old_format_years:
-        filenames = []
-        for split in splits:
-            filename = old_format % (year, split)
-            filenames.append(filename + txt_ext)
-            unzip(filename + zip_ext)
-        merge(year, filenames, std_data_filename(year))
-
-    for i, year in enumerate(split_new_format_years):
-        filenames = []
-        for split in splits:
-            filename = new_format % (year, split_new_format_ver[i], split)
-            filenames.append(filename + dat_ext)
-            unzip(filename + zip_ext)
-        merge(year, filenames, std_data_filename(year))
+def get_layout_files(downloader, addr=layout_web_addr):
+    files = [(filename, std) for filename, std in layout_files()
+            if downloader.refresh or not os.path.exists(downloader.get_filename(std))]
+    results = downloader.fetch_all([(addr + filename, filename) for filename, std in files])
+    for (filename, std), fetched in zip(files, results):
+        std = downloader.get_filename(std)
+        if fetched or (fetched is False and not os.path.exists(std)):
+            utf8_encode(downloader.get_filename(filename), std)
 
-    for i, year in enumerate(new_format_years):
-        filename = new_format % (year, new_format_ver[i], "")
-        unzip(filename + new_zip_ext)
-        utf8_encode(filename + txt_ext, std_data_filename(year))
+# --------------------------------------
+def get_data_files(downloader, addr=web_addr):
+    files = [filename for filename, std in data_files()
+            if not os.path.exists(downloader.get_filename(std))]
+    downloader.fetch_all([(addr + filename, filename) for filename in files])
 
-    for i, year in enumerate(supp_format_years):
-        filename = supp_format % (year, supp_format_ver[i], "_supp")
-        unzip(filename + supp_zip_ext)
-        utf8_encode(filename + txt_ext, std_data_filename(year))
+# *****************************************************************************
+# Unit Tests
+# *****************************************************************************
+class MirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in for the NCES web server, serves server.files ({path: (data,
+    etag)}) with Range/If-Range/If-None-Match support.  The paths in
+    server.flaky have their connection dropped half way the first time.
+    """
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        data, etag = self.server.files[self.path]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') in (None, etag):
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data)-1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.send_header('ETag', etag)
+        self.end_headers()
+
+        if self.path in self.server.flaky:
+            self.server.flaky.remove(self.path)
+            self.wfile.write(data[start:start + (len(data) - start) / 2])
+            return
+        self.wfile.write(data[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class TestDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.server = MirrorServer(('127.0.0.1', 0), MirrorHandler)
+        self.server.files = {}
+        self.server.flaky = set()
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.addr = "http://127.0.0.1:%d/ccd/data/zip/" % self.server.server_address[1]
+
+        # Synthetic archives for a split year
+        for zipname, member in get_archives(1987):
+            fname = os.path.join(self.dirname, "src.zip")
+            with zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr(member, "".join(["%s %06d\r\n" % (member, i) for i in range(5000)]))
+            self.server.files["/ccd/data/zip/" + zipname] = (open(fname, 'rb').read(), '"%s-1"' % zipname)
+            os.remove(fname)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dirname)
+
+    def downloader(self, refresh=False):
+        downloader = Downloader(self.dirname, connections=2, refresh=refresh, retry_wait=0)
+        downloader.opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+        return downloader
+
+    def get_data(self, refresh=False):
+        downloader = self.downloader(refresh)
+        results = downloader.fetch_all([(self.addr + zipname, zipname) for zipname, member in get_archives(1987)])
+        for zipname, member in get_archives(1987):
+            with open(os.path.join(self.dirname, zipname), 'rb') as f:
+                self.assertEqual(f.read(), self.server.files["/ccd/data/zip/" + zipname][0])
+        return results
+
+    def test_resume(self):
+        self.server.flaky.add("/ccd/data/zip/psu87kn_dat.zip")
+        self.assertEqual(self.get_data(), [True, True, True])
+        ranges = [headers.get('range') for path, headers in self.server.requests if path.endswith("psu87kn_dat.zip")]
+        self.assertEqual(ranges[0], None)
+        self.assertTrue(ranges[1].startswith("bytes="))
+        manifest = json.load(open(os.path.join(self.dirname, manifest_name)))
+        self.assertEqual(sorted(manifest.keys()), sorted([zipname for zipname, member in get_archives(1987)]))
+
+    def test_conditional(self):
+        self.get_data()
+        # Nothing is asked for again unless the file is damaged
+        count = len(self.server.requests)
+        with open(os.path.join(self.dirname, "psu87ow_dat.zip"), 'r+b') as f:
+            f.write("X")
+        self.assertEqual(self.get_data(), [False, False, True])
+        self.assertEqual(len(self.server.requests), count + 1)
+        # A refresh only fetches what has changed
+        path = "/ccd/data/zip/psu87ai_dat.zip"
+        self.server.files[path] = (self.server.files[path][0] + "more", '"new"')
+        self.assertEqual(self.get_data(refresh=True), [True, False, False])
 
+# *****************************************************************************
+# Program Flow
 # *****************************************************************************
 # -------------------------------------
-# Print the Usage
+# Parse the command line options
 # -------------------------------------
-def usage():
-    print __doc__
+def main(argv):
+    this_dir, this_filename = os.path.split(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Download the NCES data and layout files')
+    parser.add_argument('--jobs', action='store', dest='jobs', required=False, type=int, default=CONNECTIONS,
+            help='Number of files to download at once')
+    parser.add_argument('--refresh', action='store_true', dest='refresh', required=False,
+            help='Ask the server if the files already downloaded have changed')
+    parser.add_argument('--dir', action='store', dest='dirname', required=False, default=this_dir,
+            help='Where to put the files, defaults to the data directory')
+    args = parser.parse_args(argv)
+
+    downloader = Downloader(args.dirname, args.jobs, args.refresh)
+    get_layout_files(downloader)
+    get_data_files(downloader)
 
 # -------------------------------------
 # Drop the script name from the args
 # and call our command line parser
 # -------------------------------------
 if __name__ == "__main__":
-    get_layout_files()
-    get_data_files()
-    cleanup_files()
+    main(sys.argv[1:])
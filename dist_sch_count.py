@@ -7,6 +7,12 @@ import argparse
 
 from segcalc import SegCalc
 from nces_parser import NCESParser
+from nces_parser import SCHLEVEL_ELEMENTARY
+from nces_parser import SCHLEVEL_HIGH
+from nces_parser import SCHLEVEL_MIDDLE
+from nces_parser import SCHLEVEL_MH
+from nces_parser import SCHLEVEL_K8
+from nces_parser import SCHLEVEL_K12
 
 from filters.tuda import tuda_dist
 from filters.ca_big import ca_big_dist
@@ -69,7 +75,7 @@ def main(argv):
         dist_tot[dist] = 0
 
     nces = NCESParser(year=2011)
-    schools = nces.parse(make_dict=True)
+    schools = nces.iter_schools(make_dict=True)
 
     # Default SegCalc search query - for calculating basic totals
     idx = {
@@ -113,19 +119,19 @@ def main(argv):
     # --------------------------------------
     # Now fill in the static data data
     # --------------------------------------
+    # School level codes are worked out when the data is parsed
+    dist_by_level = {
+        SCHLEVEL_ELEMENTARY: dist_el,
+        SCHLEVEL_HIGH: dist_hs,
+        SCHLEVEL_MIDDLE: dist_ms,
+        SCHLEVEL_MH: dist_mh,
+        SCHLEVEL_K8: dist_k8,
+        SCHLEVEL_K12: dist_k12,
+    }
     for school in schools:
-        if segcalc.is_elementary(school):
-            dist_el[school['LEAID']] += 1
-        elif segcalc.is_high_school(school):
-            dist_hs[school['LEAID']] += 1
-        elif segcalc.is_middle(school):
-            dist_ms[school['LEAID']] += 1
-        elif segcalc.is_mh(school):
-            dist_mh[school['LEAID']] += 1
-        elif segcalc.is_k8(school):
-            dist_k8[school['LEAID']] += 1
-        elif segcalc.is_k12(school):
-            dist_k12[school['LEAID']] += 1
+        level = segcalc.get_level(school)
+        if level in dist_by_level:
+            dist_by_level[level][school['LEAID']] += 1
         else:
             dist_other[school['LEAID']] += 1
             print dist_list[school['LEAID']]
@@ -1,2 +1,62 @@
+"""
+Registry of the named school filters.
 
+Each filter is a column name plus a frozenset of the values to keep, so
+testing a school is a single hash lookup however long the list is:
 
+    column, values = get_filter('urban')
+    if school[column] in values: ...
+
+New lists only need a register() call here to show up in nces_parser.py --filter.
+"""
+from filters.urban import urban_dist
+from filters.big import big_dist
+from filters.tuda import tuda_dist
+from filters.ca_big import ca_big_dist
+from filters.ca_big import ca_big_30_dist
+from filters.city_zips import sjzips
+from filters.city_zips import sfzips
+from filters.cities import cities
+from filters.cities import city_key
+
+# ==============================================================================
+# Registry
+# ==============================================================================
+_filters = {}
+
+# --------------------------------------
+def register(name, column, values):
+    """
+    Add a named filter, values can be any iterable (dict keys for the
+    district lists that carry names)
+    """
+    _filters[name] = (column, frozenset(values))
+
+# --------------------------------------
+def get_filter(name):
+    """
+    Return (column, frozenset of values) for a named filter
+    """
+    try:
+        return _filters[name]
+    except KeyError:
+        raise Exception("Unknown filter: %s, pick one of %s" % (name, ", ".join(filter_names())))
+
+# --------------------------------------
+def filter_names():
+    return sorted(_filters.keys())
+
+# ==============================================================================
+# Built in Filters
+# ==============================================================================
+register('urban', 'LEAID', urban_dist)
+register('big', 'LEAID', big_dist)
+register('tuda', 'LEAID', tuda_dist)
+register('ca_big', 'LEAID', ca_big_dist)
+register('ca_big_30', 'LEAID', ca_big_30_dist)
+register('sjzips', 'ZIP', sjzips)
+register('sfzips', 'ZIP', sfzips)
+
+# One filter per mobility city, e.g. city_san_jose, matching every spelling
+for city_names, state in cities:
+    register('city_' + city_key(city_names), 'CITY', [name.strip().upper() for name in city_names])
@@ -0,0 +1,35 @@
+"""
+Cities summarised by mobility/mobility.py
+
+Each entry is the list of spellings used for the city in the NCES CITY
+column along with the state it is in.
+"""
+cities = [
+    (['San Jose'], 'CA'),
+    (['San Francisco'], 'CA'),
+    (['Washington'], 'DC'),
+    (['Seattle'], 'WA'),
+    (['Salt Lake City'], 'UT'),
+    (['New York'], 'NY'),
+    (['Boston'], 'MA'),
+    (['San Diego'], 'CA'),
+    (['Newark'], 'NJ'),
+    (['Machester'], 'NH'),
+    (['Cleveland '], 'OH'),
+    (['St Louis', 'St. Louis', 'Saint Louis'], 'MO'),
+    (['Raleigh'], 'NC'),
+    (['Jacksonville'], 'FL'),
+    (['Columbus'], 'OH'),
+    (['Indianapolis'], 'IN'),
+    (['Dayton'], 'OH'),
+    (['Atlanta'], 'GA'),
+    (['Milwaukee'], 'WI'),
+    (['Charlotte'], 'NC')
+]
+
+# --------------------------------------
+def city_key(city_names):
+    """
+    Short name for a city, used for the filter/subset name and report files
+    """
+    return city_names[0].strip().lower().replace(' ', '_')
@@ -2,54 +2,35 @@
 """
 Quick script to generate several summaries for a list of cities
 """
+import os
+import sys
 from subprocess import call
 import fips
 
-cities = [
-    (['San Jose'], 'CA'),
-    (['San Francisco'], 'CA'),
-    (['Washington'], 'DC'),
-    (['Seattle'], 'WA'),
-    (['Salt Lake City'], 'UT'),
-    (['New York'], 'NY'),
-    (['Boston'], 'MA'),
-    (['San Diego'], 'CA'),
-    (['Newark'], 'NJ'),
-    (['Machester'], 'NH'),
-    (['Cleveland '], 'OH'),
-    (['St Louis', 'St. Louis', 'Saint Louis'], 'MO'),
-    (['Raleigh'], 'NC'),
-    (['Jacksonville'], 'FL'),
-    (['Columbus'], 'OH'),
-    (['Indianapolis'], 'IN'),
-    (['Dayton'], 'OH'),
-    (['Atlanta'], 'GA'),
-    (['Milwaukee'], 'WI'),
-    (['Charlotte'], 'NC')
-]
+# The city lists live with the rest of the filters in the main package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from filters.cities import cities
+from filters.cities import city_key
+
+# Data Update
+# Every city's subset comes out of a single pass over each year's raw data
+subsets = ['city_' + city_key(city_names) for city_names, state in cities]
+args = ['../nces_parser.py', '--outputs'] + subsets
+print args
+call(args)
 
 for city_names, state in cities:
     fips_str = fips.st_to_fips[state]
-
-    city_name = city_names[0]
-
-    # Build up a list of possible city names - if there are spelling variations this allows nces_parser to select them all
-    match_vals = []
-    for city_name in city_names:
-        match_vals.append(city_name.upper())
-
-    # Data Update
-    args = ['../nces_parser.py', '--match_idx', 'CITY', '--match_val'] + match_vals
-    print args
-    call(args)
+    city_name = city_key(city_names)
+    subset = 'city_' + city_name
 
     # Report generation
     # First do the district wide segregation statistics
-    args = ['../seg_by_category.py', '--outfile', city_name.lower().replace(' ', '_') + '_seg_report.xls', '--category', 'FIPS', '--match_idx', 'FIPS', '--match_val', fips_str]
+    args = ['../seg_by_category.py', '--outfile', city_name + '_seg_report.xls', '--category', 'FIPS', '--match_idx', 'FIPS', '--match_val', fips_str, '--subset', subset]
     print args
     call(args)
 
     # Next do the per school reports
-    args = ['../chrtr_sch_details.py', '--outfile', city_name.lower().replace(' ', '_') + '_school_report.xls', '--fips', fips_str]
+    args = ['../chrtr_sch_details.py', '--outfile', city_name + '_school_report.xls', '--fips', fips_str, '--subset', subset]
     print args
     call(args)
@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+"""
+Columnar on-disk cache for the reduced NCES datasets.
+
+Each cached year is a directory holding one typed array per column plus a
+small JSON manifest that records the column order and type:
+
+    nces87-88_<key>_cache/
+        columns.json        - headers, row count, column kinds, key/source
+        MEMBER.npy          - float64, -1 for missing data
+        LEAID.codes.npy     - int32 index into the vocab
+        LEAID.vocab.npy     - fixed width byte strings, one per unique value
+        LEAID.last.npy      - row of the last school for each LEAID code
+        ...
+
+Numeric ('N') columns are stored as float64 so the values match what
+NCESParser.parse_line produces.  Every other column is dictionary encoded,
+which takes LEANM/CITY/STATE etc. from ~100k strings down to a few thousand.
+For the columns the cache is indexed on (the district LEAID) the row of the
+last school for each value is saved as well, so LEAID -> name/FIPS lookup
+tables come straight from the codes (see CachedColumns.lookup).
+
+The arrays are plain .npy files so they can be memory mapped straight out of
+the OS page cache (see CachedColumns), several report runs or processes
+looking at the same year all share one copy of the data.
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from array import array
+
+import numpy as np
+
+# ==============================================================================
+# Constants
+# ==============================================================================
+CACHE_VERSION = 1
+MANIFEST_NAME = "columns.json"
+
+NUMBER = 'N'
+STRING = 'AN'
+
+# Rows decoded at a time by ColumnCache.iter_rows
+CHUNK_ROWS = 4096
+
+# ==============================================================================
+# Utility Functions
+# ==============================================================================
+# --------------------------------------
+def column_filenames(dirname, col):
+    """
+    Return the (data, vocab) files for a column manifest entry
+    """
+    base = os.path.join(dirname, col['file'])
+    if col['kind'] == NUMBER:
+        return (base + ".npy", None)
+    else:
+        return (base + ".codes.npy", base + ".vocab.npy")
+
+# --------------------------------------
+def last_rows(codes, count):
+    """
+    Position of the last occurrence of each code (0 to count-1) in
+    codes, -1 for the codes that never appear
+    """
+    last = np.repeat(np.int32(-1), count)
+    codes = np.asarray(codes)
+    if len(codes):
+        uniq, first = np.unique(codes[::-1], return_index=True)
+        last[uniq] = len(codes) - 1 - first
+    return last
+
+# ==============================================================================
+# Column Encoders
+# ==============================================================================
+class StringColumn(object):
+    """
+    Dictionary encode a column of strings one value at a time
+    """
+    def __init__(self):
+        self.lut = {}
+        self.vocab = []
+        self.codes = array('i')
+
+    def append(self, val):
+        try:
+            self.codes.append(self.lut[val])
+        except KeyError:
+            self.lut[val] = len(self.vocab)
+            self.codes.append(len(self.vocab))
+            self.vocab.append(val)
+
+    def save(self, data_fname, vocab_fname):
+        np.save(data_fname, np.frombuffer(self.codes, dtype=np.int32))
+        np.save(vocab_fname, np.array(self.vocab, dtype='S'))
+
+    def save_last_rows(self, fname):
+        np.save(fname, last_rows(np.frombuffer(self.codes, dtype=np.int32), len(self.vocab)))
+
+# --------------------------------------
+class NumberColumn(object):
+    """
+    Pack a column of numbers into float64 one value at a time.  Anything
+    that doesn't convert is squashed to -1 to match parse_line.
+    """
+    def __init__(self):
+        self.data = array('d')
+
+    def append(self, val):
+        try:
+            self.data.append(float(val))
+        except ValueError:
+            self.data.append(-1.0)
+
+    def save(self, data_fname, vocab_fname=None):
+        np.save(data_fname, np.frombuffer(self.data, dtype=np.float64))
+
+# ==============================================================================
+# Column Cache
+# ==============================================================================
+class ColumnCache(object):
+    """
+    A directory of column arrays for one reduced NCES data set.
+    """
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self._manifest = None
+
+    # --------------------------------------
+    def exists(self):
+        """
+        The directory is only renamed into place once it is complete,
+        manifest and all, so its presence means the cache is complete.
+        """
+        return os.path.exists(os.path.join(self.dirname, MANIFEST_NAME))
+
+    # --------------------------------------
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            fh = open(os.path.join(self.dirname, MANIFEST_NAME), 'rb')
+            self._manifest = json.load(fh)
+            fh.close()
+            if self._manifest['version'] != CACHE_VERSION:
+                raise Exception("Unsupported cache version %s in %s" % (self._manifest['version'], self.dirname))
+        return self._manifest
+
+    # --------------------------------------
+    def get_headers(self):
+        return [str(col['name']) for col in self.manifest['columns']]
+
+    # --------------------------------------
+    def get_row_count(self):
+        return self.manifest['rows']
+
+    # --------------------------------------
+    def write(self, headers, kinds, schools):
+        """
+        Save schools (lists ordered like headers) out to the cache.
+
+        schools can be any iterable, each school is encoded straight into
+        the compact column arrays so a generator is never held in memory.
+        kinds maps a column name to 'N' for numbers, anything else is a string.
+        """
+        writer = self.writer(headers, kinds)
+        for school in schools:
+            writer.append(school)
+        writer.close()
+
+    # --------------------------------------
+    def writer(self, headers, kinds, key=None, source=None, index=None):
+        """
+        ColumnWriter to fill this cache one school at a time,
+        several caches can be written from a single pass this way.
+
+        key/source identify what the cache was built from, they are
+        kept in the manifest so stale caches can be spotted.  index is
+        a list of string columns to save the last_rows() of.
+        """
+        return ColumnWriter(self, headers, kinds, key, source, index)
+
+    # --------------------------------------
+    def write_arrays(self, columns, key=None, source=None):
+        """
+        Save already encoded columns, a list of (name, data, vocab).
+        vocab is None for numeric (float64) columns, otherwise data holds
+        int32 codes into it.
+        """
+        build_dir = self.begin_write()
+        rows = 0
+        manifest_columns = []
+        for name, data, vocab in columns:
+            kind = NUMBER if vocab is None else STRING
+            col = dict(name=name, kind=kind, file=name)
+            data_fname, vocab_fname = column_filenames(build_dir, col)
+            if kind == NUMBER:
+                np.save(data_fname, np.asarray(data, dtype=np.float64))
+            else:
+                np.save(data_fname, np.asarray(data, dtype=np.int32))
+                np.save(vocab_fname, np.asarray(vocab, dtype='S'))
+            manifest_columns.append(col)
+            rows = len(data)
+        self.finish_write(build_dir, dict(version=CACHE_VERSION, rows=rows, columns=manifest_columns,
+                key=key, source=source))
+
+    # --------------------------------------
+    def begin_write(self):
+        """
+        Start a new copy of the cache in a temporary directory next to
+        it and return the directory, see finish_write()
+        """
+        parent = os.path.dirname(os.path.abspath(self.dirname))
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                # Another process got there first
+                if not os.path.isdir(parent):
+                    raise
+        return tempfile.mkdtemp(dir=parent, prefix=os.path.basename(self.dirname) + ".", suffix=".tmp")
+
+    # --------------------------------------
+    def finish_write(self, build_dir, manifest):
+        """
+        Save the manifest and rename a finished copy into place.  A cache
+        directory is never written to once it's there, so readers never
+        see half written files or have them change under their memory
+        maps.  The caches are named after what went into them, if another
+        process has already saved this one it is kept and ours dropped.
+        """
+        self.save_manifest(manifest, build_dir)
+        if os.path.isdir(self.dirname) and not self.exists():
+            # Left over from an interrupted build by an older version
+            shutil.rmtree(self.dirname, ignore_errors=True)
+        if not self.exists():
+            try:
+                os.rename(build_dir, self.dirname)
+                self._manifest = manifest
+                return
+            except OSError:
+                if not self.exists():
+                    raise
+        shutil.rmtree(build_dir)
+        self._manifest = None
+
+    # --------------------------------------
+    def save_manifest(self, manifest, dirname):
+        """
+        Write the manifest into dirname, the file only shows up once it's
+        completely written
+        """
+        fd, tmpname = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as fh:
+            json.dump(manifest, fh, indent=1)
+        os.rename(tmpname, os.path.join(dirname, MANIFEST_NAME))
+
+    # --------------------------------------
+    def get_column_info(self, name):
+        """
+        Manifest entry for a column, by name.  Like make_dict,
+        the last column wins if a name is repeated.
+        """
+        for col in reversed(self.manifest['columns']):
+            if col['name'] == name:
+                return col
+        raise KeyError(name)
+
+    # --------------------------------------
+    def read_column(self, pos):
+        """
+        Read back one column as a list of python values
+        """
+        col = self.manifest['columns'][pos]
+        data_fname, vocab_fname = column_filenames(self.dirname, col)
+        data = np.load(data_fname, mmap_mode='r')
+        if col['kind'] == NUMBER:
+            return data.tolist()
+        # Share one string object per unique value across all of the schools
+        vocab = np.array(np.load(vocab_fname).tolist(), dtype=object)
+        return vocab.take(data).tolist()
+
+    # --------------------------------------
+    def iter_rows(self, make_dict=False, chunk_rows=CHUNK_ROWS):
+        """
+        Generator, yields the same rows as read() but only ever
+        decodes chunk_rows schools at a time.
+        """
+        headers = self.get_headers()
+        arrays = []
+        for col in self.manifest['columns']:
+            data_fname, vocab_fname = column_filenames(self.dirname, col)
+            data = np.load(data_fname, mmap_mode='r')
+            if col['kind'] == NUMBER:
+                arrays.append((data, None))
+            else:
+                arrays.append((data, np.array(np.load(vocab_fname).tolist(), dtype=object)))
+
+        for start in range(0, self.get_row_count(), chunk_rows):
+            columns = []
+            for data, vocab in arrays:
+                chunk = data[start:start+chunk_rows]
+                if vocab is None:
+                    columns.append(chunk.tolist())
+                else:
+                    columns.append(vocab.take(chunk).tolist())
+            for row in zip(*columns):
+                if make_dict:
+                    yield dict(zip(headers, row))
+                else:
+                    yield list(row)
+
+    # --------------------------------------
+    def read(self, make_dict=False):
+        """
+        Load the whole cache back into the same list/dict rows
+        that NCESParser.parse_orig produces.
+        """
+        headers = self.get_headers()
+        columns = [self.read_column(i) for i in range(len(headers))]
+        if make_dict:
+            return [dict(zip(headers, row)) for row in zip(*columns)]
+        else:
+            return [list(row) for row in zip(*columns)]
+
+
+# ==============================================================================
+# Column Writer
+# ==============================================================================
+class ColumnWriter(object):
+    """
+    Encodes schools into a ColumnCache as they are appended, the
+    manifest is only written by close() once every column is saved.
+    """
+    def __init__(self, cache, headers, kinds, key=None, source=None, index=None):
+        self.cache = cache
+        self.key = key
+        self.source = source
+        self.index = index or []
+        self.rows = 0
+        self.build_dir = cache.begin_write()
+
+        self.columns = []
+        self.encoders = []
+        used = {}
+        for i, name in enumerate(headers):
+            # The layout files can map two source columns onto one name (ZIP/LZIP)
+            fname = name
+            if name in used:
+                fname = "%s.%d" % (name, i)
+            used[name] = True
+
+            kind = NUMBER if kinds.get(name) == NUMBER else STRING
+            self.columns.append(dict(name=name, kind=kind, file=fname))
+            if kind == NUMBER:
+                self.encoders.append(NumberColumn())
+            else:
+                self.encoders.append(StringColumn())
+        self.appends = [encoder.append for encoder in self.encoders]
+
+    # --------------------------------------
+    def append(self, school):
+        for append, val in zip(self.appends, school):
+            append(val)
+        self.rows += 1
+
+    # --------------------------------------
+    def close(self):
+        for col, encoder in zip(self.columns, self.encoders):
+            data_fname, vocab_fname = column_filenames(self.build_dir, col)
+            encoder.save(data_fname, vocab_fname)
+
+        # Like make_dict, the last column wins if a name is repeated
+        last = {}
+        for col, encoder in zip(self.columns, self.encoders):
+            if col['name'] in self.index and col['kind'] != NUMBER:
+                last[col['name']] = (col, encoder)
+        for name, (col, encoder) in last.items():
+            col['last'] = col['file'] + ".last.npy"
+            encoder.save_last_rows(os.path.join(self.build_dir, col['last']))
+
+        self.cache.finish_write(self.build_dir, dict(version=CACHE_VERSION, rows=self.rows, columns=self.columns,
+                key=self.key, source=self.source))
+
+
+# ==============================================================================
+# Memory Mapped Column Access
+# ==============================================================================
+class CachedColumns(object):
+    """
+    Read only, memory mapped view of a ColumnCache.
+
+    Indexing by column name returns a numpy array without creating any
+    python objects per school:
+        - numeric columns give the float64 values (-1 for missing data)
+        - string columns give the int32 codes, see vocab()/code_of()/decode()
+    """
+    def __init__(self, cache, mmap_mode='r'):
+        self.cache = cache
+        self.mmap_mode = mmap_mode
+        self._arrays = {}
+        self._vocabs = {}
+
+    def __len__(self):
+        return self.cache.get_row_count()
+
+    def __contains__(self, name):
+        return name in self.get_headers()
+
+    def __getitem__(self, name):
+        try:
+            return self._arrays[name]
+        except KeyError:
+            col = self.cache.get_column_info(name)
+            data_fname, vocab_fname = column_filenames(self.cache.dirname, col)
+            self._arrays[name] = np.load(data_fname, mmap_mode=self.mmap_mode)
+            return self._arrays[name]
+
+    # --------------------------------------
+    def get_headers(self):
+        return self.cache.get_headers()
+
+    # --------------------------------------
+    def is_string(self, name):
+        return self.cache.get_column_info(name)['kind'] != NUMBER
+
+    # --------------------------------------
+    def vocab(self, name):
+        """
+        Unique values of a string column, indexed by code
+        """
+        try:
+            return self._vocabs[name]
+        except KeyError:
+            col = self.cache.get_column_info(name)
+            data_fname, vocab_fname = column_filenames(self.cache.dirname, col)
+            if vocab_fname is None:
+                raise Exception("Column %s is not a string column" % name)
+            self._vocabs[name] = np.load(vocab_fname, mmap_mode=self.mmap_mode)
+            return self._vocabs[name]
+
+    # --------------------------------------
+    def code_of(self, name, value):
+        """
+        Code for a string value in the given column, -1 if it never appears
+        """
+        hits = np.flatnonzero(self.vocab(name) == value)
+        if len(hits):
+            return int(hits[0])
+        return -1
+
+    # --------------------------------------
+    def decode(self, name):
+        """
+        Expand a string column back out to an array of strings
+        """
+        return self.vocab(name).take(self[name])
+
+    # --------------------------------------
+    def get_last_rows(self, name, rows=None):
+        """
+        Row of the last school for each code of a string column, -1 if
+        there isn't one.  rows (an array of row numbers) only looks at
+        those schools, otherwise the table saved with the cache is used.
+        """
+        col = self.cache.get_column_info(name)
+        if rows is None:
+            if 'last' in col:
+                return np.load(os.path.join(self.cache.dirname, col['last']))
+            return last_rows(self[name], len(self.vocab(name)))
+        rows = np.asarray(rows, dtype=np.intp)
+        last = last_rows(self[name].take(rows), len(self.vocab(name)))
+        found = np.flatnonzero(last >= 0)
+        last[found] = rows.take(last.take(found))
+        return last
+
+    # --------------------------------------
+    def lookup(self, key_name, val_name, rows=None):
+        """
+        Dictionary mapping each value of the key_name string column to
+        val_name for the last school that has it, the same as
+        SegCalc.get_idxed_val(key_name, val_name) but done on the codes.
+        rows optionally limits the schools looked at.
+        """
+        last = self.get_last_rows(key_name, rows)
+        present = np.flatnonzero(last >= 0)
+        last = last.take(present)
+        keys = self.vocab(key_name).take(present).tolist()
+        if self.is_string(val_name):
+            vals = self.vocab(val_name).take(self[val_name].take(last)).tolist()
+        else:
+            vals = self[val_name].take(last).tolist()
+        return dict(zip(keys, vals))
+
+# *****************************************************************************
+# Unit Tests
+# *****************************************************************************
+class TestColumnCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.cache = ColumnCache(os.path.join(self.dirname, "test_cache"))
+        self.headers = ['LEAID', 'LEANM', 'MEMBER']
+        self.kinds = {'MEMBER': NUMBER}
+        self.schools = [
+            ['0600001', 'LOS ANGELES', 100.0],
+            ['0600002', 'SAN JOSE', -1.0],
+            ['0600001', 'LOS ANGELES UNIFIED', 25.0],
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_rebuild_keeps_existing(self):
+        self.cache.write(self.headers, self.kinds, self.schools)
+        cols = CachedColumns(ColumnCache(self.cache.dirname))
+        member = cols['MEMBER']
+        # A second build of the same cache leaves the first one alone
+        ColumnCache(self.cache.dirname).write(self.headers, self.kinds, self.schools[:1])
+        self.assertEqual(member.tolist(), [100.0, -1.0, 25.0])
+        self.assertEqual(ColumnCache(self.cache.dirname).get_row_count(), 3)
+        self.assertEqual(os.listdir(self.dirname), ["test_cache"])
+
+    def test_round_trip(self):
+        # ZIP twice, like a layout with both ZIP and LZIP
+        headers = ['LEAID', 'ZIP', 'LEANM', 'MEMBER', 'ZIP']
+        schools = [[leaid, '8%04d' % i, name, member, '9%04d' % i]
+                   for i, (leaid, name, member) in enumerate(self.schools)]
+        self.cache.write(headers, self.kinds, schools)
+        self.assertTrue(self.cache.exists())
+        self.assertTrue(os.path.exists(os.path.join(self.cache.dirname, "ZIP.4.codes.npy")))
+
+        cache = ColumnCache(self.cache.dirname)
+        self.assertEqual(cache.get_headers(), headers)
+        self.assertEqual(cache.read(), schools)
+        # The last ZIP wins, the same as make_dict on a parsed row
+        self.assertEqual(cache.read(make_dict=True), [dict(zip(headers, school)) for school in schools])
+        self.assertEqual(list(cache.iter_rows(chunk_rows=2)), schools)
+        self.assertEqual(list(cache.iter_rows(make_dict=True, chunk_rows=1)), cache.read(make_dict=True))
+
+        cols = CachedColumns(cache)
+        self.assertEqual(cols['MEMBER'].tolist(), [100.0, -1.0, 25.0])
+        self.assertEqual(cols.decode('ZIP').tolist(), ['90000', '90001', '90002'])
+        self.assertEqual(cols.code_of('LEAID', '0600002'), 1)
+        self.assertEqual(cols.code_of('LEAID', '0699999'), -1)
+
+    def test_last_rows(self):
+        self.assertEqual(last_rows([2, 0, 2, 1, 0], 4).tolist(), [4, 3, 2, -1])
+        self.assertEqual(last_rows([], 2).tolist(), [-1, -1])
+
+    def test_lookup(self):
+        from segcalc import SegCalc
+        from segcalc import SAMPLE_SCHOOLS
+
+        # SAMPLE_SCHOOLS is one district spread over two states, give each
+        # school its own name so only the last one matches
+        headers = ['LEAID', 'LEANM', 'FIPS', 'MEMBER']
+        schools = [['%07d' % school['LEAID'], 'SCHOOL %d' % i, '%02d' % school['FIPS'], school['MEMBER']]
+                   for i, school in enumerate(SAMPLE_SCHOOLS)]
+        schools += [[leaid, name, '06', member] for leaid, name, member in self.schools]
+        leaid = schools[0][0]
+        dicts = [dict(zip(headers, school)) for school in schools]
+        idx = {'MINORITY': 'MEMBER', 'MAJORITY': 'MEMBER', 'TOTAL': 'MEMBER', 'CATEGORY': 'LEAID'}
+
+        # With and without the saved last row table
+        for index in [['LEAID'], []]:
+            shutil.rmtree(self.cache.dirname, ignore_errors=True)
+            writer = ColumnCache(self.cache.dirname).writer(headers, self.kinds, index=index)
+            for school in schools:
+                writer.append(school)
+            writer.close()
+            cols = CachedColumns(ColumnCache(self.cache.dirname))
+            self.assertEqual('last' in cols.cache.get_column_info('LEAID'), bool(index))
+
+            sc = SegCalc(dicts, idx)
+            for val_name in ['LEANM', 'FIPS', 'MEMBER']:
+                self.assertEqual(cols.lookup('LEAID', val_name), sc.get_idxed_val('LEAID', val_name))
+            self.assertEqual(cols.lookup('LEAID', 'LEANM')[leaid], 'SCHOOL 3')
+            self.assertEqual(cols.lookup('LEAID', 'FIPS')[leaid], '02')
+
+            # Only some of the schools, e.g. one year of a panel
+            for rows in [[0, 1, 4], [2, 5], []]:
+                sc = SegCalc([dicts[row] for row in rows], idx)
+                self.assertEqual(cols.lookup('LEAID', 'LEANM', rows=rows), sc.get_idxed_val('LEAID', 'LEANM'))
+            self.assertEqual(cols.get_last_rows('LEAID', rows=[0, 1, 4]).tolist(), [1, 4, -1])
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+"""
+Registry of the compiled NCES layout files.
+
+Every ncesYY-YY_layout.txt is run through the layout regexes and the
+year to year column renames (FIPST -> FIPS, LZIP -> ZIP, FLEyy -> FRELCH,
+INDyy -> AM, ...) once, and the harmonised result is saved in one JSON
+file, data/nces_layouts.json:
+
+    {"version": 1,
+     "years": {"1987": {"layout": <sha1 of the layout file>,
+                        "index_mode": 0,
+                        "columns": [["LEAID", "AN", 1, 7, 7, "..."], ...]},
+               ...}}
+
+Each column is (name, type, first position, last position, size,
+description), in layout file order.  Tab separated (index mode) years
+have the column order as both positions and a size of 0.  A year is
+recompiled whenever its layout file changes.
+
+Run from the command line to compile every year and see which years
+have each column, or where one column sits in each year:
+
+    ./nces_layouts.py
+    ./nces_layouts.py --column FRELCH
+"""
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from data.nces_get import FIRST_YEAR
+from data.nces_get import LAST_YEAR
+
+# ==============================================================================
+# Constants and RegEx
+# ==============================================================================
+# Bump if compile_layout changes what ends up in the registry
+LAYOUT_VERSION = 1
+
+layouts_filename = "nces_layouts.json"
+formatfile_name = "nces%02d-%02d_layout.txt"
+
+re_idx_header = re.compile(r'Name\s+Order\s+Type\s+Description')
+
+# Name    Type   Position  Size  Description
+re_definition = re.compile(r'^(\w+)\s+(\w+)\s+(\d+)[-](\d+)\s+(\d+)[*]?\s+(.*)$')
+re_sub_definition = re.compile(r'^\s*[+](\w+)\s+(\w+)\s+(\d+)[-](\d+)\s+(\d+)\s+(.*)$')
+
+# Variable    Start   End     Field   Data
+# Name        Pos.    Pos.    Length  Type    Description
+re_alt_definition = re.compile(r'^(\w+)\s+(\d+)\s+(\d+)\s+(\d+)*?\s+(\w+)\s+(.*)$')
+re_alt_sub_definition = re.compile(r'^\s*[+](\w+)\s+(\d+)\s+(\d+)\s+(\d+)*?\s+(\w+)\s+(.*)$')
+
+# Index Data Format
+# Variable             Data
+# Name          Order  Type   Description
+re_idx_definition = re.compile(r'^[+]?(\w+)\s+(\d+)[*]?\s+(\w+)\s+(.*)$')
+
+# ==============================================================================
+# Utility Functions
+# ==============================================================================
+# --------------------------------------
+def get_formatfile_name(year):
+    fname = formatfile_name % (year%100, (year+1)%100)
+    this_dir, this_filename = os.path.split(__file__)
+    return os.path.join(this_dir, 'data', fname)
+
+# --------------------------------------
+def harmonise(col_name, type, year):
+    """
+    Return (col_name, type) with the NCES year to year changes filtered
+    out, so a column has the same name and type in every year
+    """
+    if col_name[:5] == "FIPST":
+        col_name = "FIPS"
+        type = 'AN'
+    if col_name[:4] == "FIPS":
+        type = 'AN'
+    if col_name[:3] == "ZIP" and col_name[:4] != "ZIP4":
+        col_name = "ZIP"
+    if col_name[:4] == "LZIP" and col_name[:5] != "LZIP4" :  # ZIP or Location ZIP (not Mailing ZIP)
+        col_name = "ZIP"
+    if col_name[:4] == "GSL0":  # 1994 typo in the format file.
+        col_name = "GSLO"
+    if col_name == "FLE%02d" % (year%100):
+        col_name = "FRELCH"
+    if col_name == ("IND%02d" % (year%100)):
+        col_name = "AM"
+    elif col_name == "IND":
+        col_name = "AM"
+    if col_name[:4] == "CITY" or col_name[:5] == "LCITY":
+        col_name = "CITY"
+    if col_name[:4] == "STATE" or col_name[:5] == "LSTATE":
+        col_name = "STATE"
+    if (col_name[:5] == "LEAID" or
+        col_name[:4] == "TYPE" or
+        col_name[:6] == "STATUS"):
+        type = 'AN'
+
+    # Strip the year off the column if it is present
+    if col_name[-2:].isdigit():
+        col_name = col_name[:-2]
+    return (col_name, type)
+
+# --------------------------------------
+def compile_layout(fh, year, debug=False):
+    """
+    Read an open layout file, returns the registry entry for it (less
+    the layout hash), see the module docstring
+    """
+    index_mode = 0
+    columns = []
+    for line in fh:
+        if re_idx_header.search(line):
+            index_mode = 1
+
+        match = re_definition.search(line) or re_sub_definition.search(line)
+        if match:
+            col_name, type, loidx, hiidx, size, description = match.groups()
+        else:
+            match = re_alt_definition.search(line) or re_alt_sub_definition.search(line)
+            if match:
+                col_name, loidx, hiidx, size, type, description = match.groups()
+            elif index_mode and re_idx_definition.search(line):
+                col_name, loidx, type, description = re_idx_definition.search(line).groups()
+                hiidx = loidx
+                size = 0
+            else:
+                if debug:
+                    print line
+                continue
+
+        col_name, type = harmonise(col_name, type, year)
+        columns.append([col_name, type, int(loidx), int(hiidx), int(size or 0), description.strip()])
+    return dict(index_mode=index_mode, columns=columns)
+
+# ==============================================================================
+# Layout Registry Class
+# ==============================================================================
+class LayoutRegistry(object):
+    """
+    The compiled layouts of every year in one JSON file, read once
+    """
+    def __init__(self, filename=None):
+        if filename is None:
+            this_dir, this_filename = os.path.split(__file__)
+            filename = os.path.join(this_dir, 'data', layouts_filename)
+        self.filename = filename
+        self._years = None
+
+    # --------------------------------------
+    def read(self):
+        """
+        {year string: layout} from the registry file, empty if there's no
+        registry yet or it was written by another LAYOUT_VERSION
+        """
+        try:
+            with open(self.filename, 'rb') as f:
+                registry = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if registry.get('version') != LAYOUT_VERSION:
+            return {}
+        return registry['years']
+
+    # --------------------------------------
+    def years(self):
+        if self._years is None:
+            self._years = self.read()
+        return self._years
+
+    # --------------------------------------
+    def save(self, year, layout):
+        """
+        Add a year to the registry file.  Other processes may be adding
+        years too, so their entries are read back in first and the file
+        only shows up once it's completely written.
+        """
+        years = self.read()
+        years[str(year)] = layout
+        dirname = os.path.dirname(self.filename)
+        fd, tmpname = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(dict(version=LAYOUT_VERSION, years=years), f, indent=1, sort_keys=True)
+        os.rename(tmpname, self.filename)
+        self._years = years
+
+    # --------------------------------------
+    def get(self, year, formatfile=None):
+        """
+        The compiled layout for a year, recompiled if the layout file has
+        changed.  Without the layout file the registry's copy is used.
+        Strings come back as plain str, the same as read from the file.
+        """
+        if formatfile is None:
+            formatfile = get_formatfile_name(year)
+        try:
+            data = open(formatfile, 'rb').read()
+        except IOError:
+            data = None
+
+        layout = self.years().get(str(year))
+        if data is not None:
+            digest = hashlib.sha1(data).hexdigest()
+            if layout is None or layout['layout'] != digest:
+                layout = compile_layout(StringIO(data), year)
+                layout['layout'] = digest
+                # JSON needs unicode, the descriptions can have latin-1 in them
+                for column in layout['columns']:
+                    column[5] = column[5].decode('latin-1')
+                self.save(year, layout)
+        elif layout is None:
+            raise IOError("No NCES layout file or registry entry for %d" % year)
+
+        columns = []
+        for name, type, loidx, hiidx, size, description in layout['columns']:
+            columns.append([str(name), str(type), loidx, hiidx, size, description.encode('latin-1')])
+        return dict(layout, columns=columns)
+
+# Shared by every parser in the process
+_registry = None
+
+# --------------------------------------
+def get_layout(year, formatfile=None):
+    """
+    Compiled layout for a year from the default registry
+    """
+    global _registry
+    if _registry is None:
+        _registry = LayoutRegistry()
+    return _registry.get(year, formatfile)
+
+# *****************************************************************************
+# Unit Tests
+# *****************************************************************************
+class TestLayouts(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.formatfile = os.path.join(self.dirname, "layout.txt")
+        self.layout = "\n".join([
+            "Name    Type   Position  Size  Description",
+            "FIPST87    AN  1-2 2 State \xe9",
+            "FLE87      N   3-6 4 Free Lunch",
+            "TYPE87     N   7-7 1 School Type",
+            "",
+        ])
+        with open(self.formatfile, 'wb') as f:
+            f.write(self.layout)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_compile(self):
+        layout = compile_layout(StringIO(self.layout), 1987)
+        self.assertEqual(layout['index_mode'], 0)
+        self.assertEqual(layout['columns'], [
+            ['FIPS', 'AN', 1, 2, 2, 'State \xe9'],
+            ['FRELCH', 'N', 3, 6, 4, 'Free Lunch'],
+            ['TYPE', 'AN', 7, 7, 1, 'School Type'],
+        ])
+        layout = compile_layout(StringIO("Name  Order  Type  Description\nIND10  3  N  Indian\n"), 2010)
+        self.assertEqual(layout, dict(index_mode=1, columns=[['AM', 'N', 3, 3, 0, 'Indian']]))
+
+    def test_registry(self):
+        fname = os.path.join(self.dirname, layouts_filename)
+        layout = LayoutRegistry(fname).get(1987, self.formatfile)
+        self.assertEqual(layout['columns'], compile_layout(StringIO(self.layout), 1987)['columns'])
+        # A new registry reads it back, even without the layout file
+        os.remove(self.formatfile)
+        self.assertEqual(LayoutRegistry(fname).get(1987, self.formatfile), layout)
+        self.assertRaises(IOError, LayoutRegistry(fname).get, 1988, self.formatfile)
+        # A changed layout file is recompiled
+        with open(self.formatfile, 'wb') as f:
+            f.write(self.layout.replace("3-6 4", "3-5 3"))
+        self.assertEqual(LayoutRegistry(fname).get(1987, self.formatfile)['columns'][1][2:5], [3, 5, 3])
+
+# *****************************************************************************
+# Program Flow
+# *****************************************************************************
+# -------------------------------------
+# Parse the command line options
+# -------------------------------------
+def main(argv):
+    parser = argparse.ArgumentParser(description='Compile the NCES layout files into the layout registry')
+    parser.add_argument('--first_year', action='store', dest='first_year', required=False, type=int, default=FIRST_YEAR,
+            help='First year to compile')
+    parser.add_argument('--last_year', action='store', dest='last_year', required=False, type=int, default=LAST_YEAR,
+            help='Last year to compile')
+    parser.add_argument('--column', action='store', dest='column', required=False,
+            help='Show the type and position of one column in each year')
+    args = parser.parse_args(argv)
+
+    layouts = []
+    for year in range(args.first_year, args.last_year+1):
+        try:
+            layouts.append((year, get_layout(year)))
+        except IOError:
+            continue
+
+    if args.column:
+        for year, layout in layouts:
+            for name, type, loidx, hiidx, size, description in layout['columns']:
+                if name == args.column:
+                    if layout['index_mode']:
+                        print "%d: %-3s Order %d" % (year, type, loidx)
+                    else:
+                        print "%d: %-3s %d-%d" % (year, type, loidx, hiidx)
+        return
+
+    names = []
+    years = {}
+    for year, layout in layouts:
+        for column in layout['columns']:
+            if column[0] not in years:
+                names.append(column[0])
+                years[column[0]] = []
+            if year not in years[column[0]]:
+                years[column[0]].append(year)
+    for name in names:
+        print "%-12s %s" % (name, " ".join([str(year) for year in years[name]]))
+
+# -------------------------------------
+# Drop the script name from the args
+# and call our command line parser
+# -------------------------------------
+if __name__ == "__main__":
+    main(sys.argv[1:])
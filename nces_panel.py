@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""
+Multi-year panel store.
+
+Every year of a report in one column cache, one row per school-year with
+an extra YEAR column, sorted by LEAID and then year.  Longitudinal reports
+slice this one set of memory mapped files instead of opening and decoding
+a separate cache (or raw data file) for every year:
+
+    panel = NCESPanel(range(1987, 2012))
+    schools = panel.load_year(1995)
+    history = panel.load(category='LEAID', values=['0622710'])
+
+The panel is assembled from the per-year column caches (which are built
+from the raw data as needed) and is keyed on their keys, so it gets
+rebuilt whenever any of the years change.
+
+The columns of the layout files come and go over the years, each year's
+schools only get the columns that year actually had, exactly like loading
+the year on its own.
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+import unittest
+
+import numpy as np
+
+from nces_cache import ColumnCache
+from nces_cache import CachedColumns
+from nces_parser import NCESParser
+
+# ==============================================================================
+# Constants
+# ==============================================================================
+# Bump if the panel layout changes
+PANEL_VERSION = 1
+
+panel_dirname = "panel%02d-%02d_%s"
+
+# Suffix for the numeric copy of a column that is a string in other years
+NUMERIC_SUFFIX = ".N"
+
+# ==============================================================================
+# Utility Functions
+# ==============================================================================
+# --------------------------------------
+def merge_vocabs(vocabs):
+    """
+    Combine several string vocabularies into one sorted vocabulary that
+    always includes ''.  Returns (vocab, remaps) where remaps[i] maps
+    the codes of vocabs[i] onto the combined vocab.
+    """
+    vocabs = [np.asarray(vocab, dtype='S') for vocab in vocabs]
+    vocab = np.unique(np.concatenate(vocabs + [np.array([''], dtype='S')]))
+    remaps = [np.searchsorted(vocab, year_vocab).astype(np.int32) for year_vocab in vocabs]
+    return (vocab, remaps)
+
+# ==============================================================================
+# Panel Class
+# ==============================================================================
+class NCESPanel(object):
+    """
+    All the years in year_range for one subset (see NCESParser)
+    """
+    def __init__(self, years, subset=None):
+        self.years = list(years)
+        self.subset = subset
+        self._cache = None
+        self._columns = None
+
+    def __getstate__(self):
+        # Worker processes reopen the memory maps themselves
+        state = self.__dict__.copy()
+        state['_columns'] = None
+        return state
+
+    # --------------------------------------
+    def get_dirname(self, key):
+        fname = panel_dirname % (self.years[0]%100, self.years[-1]%100, key)
+        this_dir, this_filename = os.path.split(__file__)
+        return os.path.join(this_dir, 'data', fname)
+
+    # --------------------------------------
+    def year_caches(self):
+        """
+        (year, ColumnCache) for every year, building the caches if need be
+        """
+        caches = []
+        for year in self.years:
+            parser = NCESParser(year=year, subset=self.subset)
+            caches.append((year, parser.load_cache()))
+        return caches
+
+    # --------------------------------------
+    def load_cache(self):
+        """
+        The up to date panel cache, built from the year caches if need be
+        """
+        if self._cache is None:
+            caches = self.year_caches()
+            source = dict(
+                version=PANEL_VERSION,
+                subset=self.subset,
+                years=[[year, cache.manifest['key']] for year, cache in caches],
+            )
+            key = hashlib.sha1(json.dumps(source, sort_keys=True)).hexdigest()[:16]
+            cache = ColumnCache(self.get_dirname(key))
+            if cache.exists() and cache.manifest.get('key') == key:
+                print "Loading Previously Saved Panel"
+            else:
+                self.build(cache, caches, key, source)
+            self._cache = cache
+        return self._cache
+
+    # --------------------------------------
+    def get_key(self):
+        """
+        Hash of everything that went into the panel
+        """
+        return self.load_cache().manifest['key']
+
+    # --------------------------------------
+    def build(self, cache, caches, key, source):
+        """
+        Stack the year caches into one panel cache
+        """
+        print "Building the %d-%d Panel" % (self.years[0], self.years[-1])
+        views = [(year, CachedColumns(year_cache)) for year, year_cache in caches]
+
+        # Which years have each column, and as what type
+        names = []
+        kinds = {}
+        for year, cols in views:
+            for name in cols.get_headers():
+                if name not in kinds:
+                    names.append(name)
+                    kinds[name] = set()
+                kinds[name].add(cols.is_string(name))
+
+        # Panel column for each year's columns, a column that is a number
+        # in some years and a string in others is split in two
+        year_columns = dict([(year, []) for year, cols in views])
+        panel_columns = []
+        for name in names:
+            for is_string in sorted(kinds[name], reverse=True):
+                panel_name = name
+                if not is_string and len(kinds[name]) > 1:
+                    panel_name += NUMERIC_SUFFIX
+                panel_columns.append((panel_name, name, is_string))
+                for year, cols in views:
+                    if name in cols and cols.is_string(name) == is_string:
+                        # get_headers can repeat a name, only list it once
+                        if [name, panel_name] not in year_columns[year]:
+                            year_columns[year].append([name, panel_name])
+
+        columns = []
+        years = np.concatenate([np.repeat(float(year), len(cols)) for year, cols in views])
+        columns.append(('YEAR', years, None))
+        for panel_name, name, is_string in panel_columns:
+            present = [(year, cols) for year, cols in views
+                    if name in cols and cols.is_string(name) == is_string]
+            if is_string:
+                vocab, remaps = merge_vocabs([cols.vocab(name) for year, cols in present])
+                remaps = dict(zip([year for year, cols in present], remaps))
+                missing = np.searchsorted(vocab, '')
+                data = []
+                for year, cols in views:
+                    if year in remaps:
+                        data.append(remaps[year].take(cols[name]))
+                    else:
+                        data.append(np.repeat(np.int32(missing), len(cols)))
+                columns.append((panel_name, np.concatenate(data), vocab))
+            else:
+                data = []
+                for year, cols in views:
+                    if name in cols and not cols.is_string(name):
+                        data.append(np.asarray(cols[name]))
+                    else:
+                        data.append(np.repeat(-1.0, len(cols)))
+                columns.append((panel_name, np.concatenate(data), None))
+
+        # Sort by district, then year.  lexsort is stable so the schools
+        # of a district stay in data file order within a year.
+        sort_keys = [years]
+        for panel_name, data, vocab in columns:
+            if panel_name == 'LEAID':
+                sort_keys.append(data)
+        order = np.lexsort(sort_keys)
+        columns = [(panel_name, data[order], vocab) for panel_name, data, vocab in columns]
+
+        source = dict(source, columns=dict([(str(year), year_columns[year]) for year in year_columns]))
+        cache.write_arrays(columns, key=key, source=source)
+        print "Saved %d School-Years to Panel %s" % (len(order), cache.dirname)
+
+    # --------------------------------------
+    def columns(self):
+        """
+        Memory mapped panel columns (CachedColumns), including YEAR
+        """
+        if self._columns is None:
+            self._columns = CachedColumns(self.load_cache())
+        return self._columns
+
+    # --------------------------------------
+    def year_columns(self, year):
+        """
+        [(column name, panel column name), ...] for the columns a year has
+        """
+        return self.load_cache().manifest['source']['columns'][str(year)]
+
+    # --------------------------------------
+    def select(self, years=None, category=None, values=None):
+        """
+        Panel row numbers for the given years and category values
+        """
+        cols = self.columns()
+        mask = np.ones(len(cols), dtype=bool)
+        if years is not None:
+            mask &= np.in1d(cols['YEAR'], [float(year) for year in years])
+        if category is not None:
+            if cols.is_string(category):
+                codes = [cols.code_of(category, val) for val in values]
+                mask &= np.in1d(cols[category], codes)
+            else:
+                mask &= np.in1d(cols[category], [float(val) for val in values])
+        return np.flatnonzero(mask)
+
+    # --------------------------------------
+    def load(self, years=None, category=None, values=None):
+        """
+        Schools (dicts, like NCESParser.parse(make_dict=True)) for the
+        selected years/category values, in panel (LEAID, year) order.
+        """
+        cols = self.columns()
+        rows = self.select(years, category, values)
+        row_years = cols['YEAR'].take(rows)
+
+        schools = [None] * len(rows)
+        for year in np.unique(row_years):
+            pos = np.flatnonzero(row_years == year)
+            year_rows = rows.take(pos)
+            names = []
+            data = []
+            for name, panel_name in self.year_columns(int(year)):
+                names.append(str(name))
+                if cols.is_string(panel_name):
+                    vocab = np.array(cols.vocab(panel_name).tolist(), dtype=object)
+                    data.append(vocab.take(cols[panel_name].take(year_rows)).tolist())
+                else:
+                    data.append(cols[panel_name].take(year_rows).tolist())
+            for i, row in zip(pos, zip(*data)):
+                schools[i] = dict(zip(names, row))
+        return schools
+
+    # --------------------------------------
+    def load_year(self, year):
+        return self.load(years=[year])
+
+    # --------------------------------------
+    def lookup(self, year, key_name, val_name):
+        """
+        {key: value} for a year, e.g. LEAID -> LEANM, worked out on the
+        column codes (see CachedColumns.lookup)
+        """
+        return self.columns().lookup(key_name, val_name, rows=self.select(years=[year]))
+
+# *****************************************************************************
+# Unit Tests
+# *****************************************************************************
+class TestMergeVocabs(unittest.TestCase):
+
+    def test_merge(self):
+        vocabs = [['LA', 'SF'], ['SJ', 'LA'], []]
+        vocab, remaps = merge_vocabs(vocabs)
+        self.assertEqual(vocab.tolist(), ['', 'LA', 'SF', 'SJ'])
+        for year_vocab, remap in zip(vocabs, remaps):
+            self.assertEqual(vocab.take(remap).tolist(), year_vocab)
+
+# *****************************************************************************
+# Program Flow
+# *****************************************************************************
+# -------------------------------------
+# Parse the command line options
+# -------------------------------------
+def main(argv):
+    parser = argparse.ArgumentParser(description='Build the multi-year NCES panel')
+    parser.add_argument('--first_year', action='store', dest='first_year', required=False, type=int, default=1987,
+            help='First year in the panel')
+    parser.add_argument('--last_year', action='store', dest='last_year', required=False, type=int, default=2011,
+            help='Last year in the panel')
+    parser.add_argument('--subset', action='store', dest='subset', required=False,
+            help='Build the panel for a subset (see nces_parser.py --outputs)')
+    args = parser.parse_args(argv)
+
+    panel = NCESPanel(range(args.first_year, args.last_year+1), args.subset)
+    panel.load_cache()
+
+# -------------------------------------
+# Drop the script name from the args
+# and call our command line parser
+# -------------------------------------
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -11,44 +11,101 @@ exposed it to the command line because this is handy for doing quick experiments
 """
 
 import argparse
-import re
 import os
 import csv
+import glob
+import json
+import shutil
+import hashlib
+import zipfile
+import tempfile
+import itertools
+import multiprocessing
+from cStringIO import StringIO
+
+import numpy as np
 
 # Unit testing
 import unittest
 
 from fips import fips_to_st
-from filters.urban import urban_dist
-from filters.big import big_dist
-from filters.tuda import tuda_dist
-from filters.ca_big import ca_big_dist
-from filters.city_zips import sjzips
+from nces_cache import ColumnCache
+from nces_cache import CachedColumns
+from parallel import map_years
+from filters import get_filter
+from filters import filter_names
+from nces_layouts import get_layout
+from nces_layouts import compile_layout
+from nces_layouts import formatfile_name
 from data.nces_get import FIRST_YEAR
+from data.nces_get import get_archives
+from data.nces_get import find_member
 from data.nces_get import LAST_YEAR
 
 # ==============================================================================
-# Constants and RegEx
+# Constants
 # ==============================================================================
-re_idx_header = re.compile(r'Name\s+Order\s+Type\s+Description')
+# Fixed width records decoded at a time by NCESParser.iter_records
+BULK_RECORDS = 65536
 
-# Name    Type   Position  Size  Description
-re_definition = re.compile(r'^(\w+)\s+(\w+)\s+(\d+)[-](\d+)\s+(\d+)[*]?\s+(.*)$')
-re_sub_definition = re.compile(r'^\s*[+](\w+)\s+(\w+)\s+(\d+)[-](\d+)\s+(\d+)\s+(.*)$')
+# Bytes of a tab separated file split at a time by NCESParser.iter_tsv_blocks
+BULK_BYTES = 1024 * 1024
 
-# Variable    Start   End     Field   Data
-# Name        Pos.    Pos.    Length  Type    Description
-re_alt_definition = re.compile(r'^(\w+)\s+(\d+)\s+(\d+)\s+(\d+)*?\s+(\w+)\s+(.*)$')
-re_alt_sub_definition = re.compile(r'^\s*[+](\w+)\s+(\d+)\s+(\d+)\s+(\d+)*?\s+(\w+)\s+(.*)$')
+# Chunks handed out per worker process, so one slow chunk doesn't hold up the rest
+CHUNKS_PER_JOB = 4
 
-# Index Data Format
-# Variable             Data
-# Name          Order  Type   Description
-re_idx_definition = re.compile(r'^[+]?(\w+)\s+(\d+)[*]?\s+(\w+)\s+(.*)$')
+# parse_orig folds these districts into one LEAID after decoding a row
+NYC_GEO_DIST = "NEW YORK CITY GEOGRAPHIC DISTRICT"
 
 datafile_name = "nces%02d-%02d.txt"
-saved_datafile_name = "nces%02d-%02d.csv"
-formatfile_name = "nces%02d-%02d_layout.txt"
+# Column caches are named by the hash of what went into them, see cache_source()
+saved_cachedir_name = "nces%%02d-%%02d_%s_cache"
+
+# Subset name for the whole (unfiltered) dataset
+FULL_SUBSET = "full"
+
+# Bump whenever a change to the parser changes what ends up in the caches,
+# every existing cache is then rebuilt from the raw data on first use
+PARSER_VERSION = 4
+
+# The caches keep a district -> last school table for these columns,
+# for the LEAID to name/FIPS lookups (see CachedColumns.lookup)
+INDEX_COLUMNS = ['LEAID']
+
+# School level classification, the SCHLEVEL column (see school_level)
+SCHLEVEL_OTHER = 0
+SCHLEVEL_ELEMENTARY = 1
+SCHLEVEL_HIGH = 2
+SCHLEVEL_MIDDLE = 3
+SCHLEVEL_MH = 4
+SCHLEVEL_K8 = 5
+SCHLEVEL_K12 = 6
+
+# Yes/No school attributes, bits of the FLAGS column (see school_flags)
+FLAG_CHARTER = 1    # CHARTR is 1/Y
+FLAG_MAGNET = 2     # MAGNET is 1/Y
+FLAG_OPEN = 4       # STATUS 1, open
+FLAG_REGULAR = 8    # TYPE 1, regular school
+FLAG_URBAN = 16     # City locale, ULOCAL 11-13 (LOCALE 1-2 before ULOCAL)
+
+# Columns the flags are worked out from
+FLAG_SOURCES = ['CHARTR', 'MAGNET', 'STATUS', 'TYPE', 'ULOCAL', 'LOCALE']
+
+# Flag for each of the Yes/No columns
+YES_NO_FLAGS = {'CHARTR': FLAG_CHARTER, 'MAGNET': FLAG_MAGNET}
+YES_VALUES = ('1', 'Y', 1)
+
+# Numeric columns worked out as each school is parsed, so the grade
+# and Yes/No tests don't have to look at the raw strings again
+GRADE_COLUMNS = [
+    ("GRADE_LO", "Lowest Grade Offered (number, -1 if unknown)"),
+    ("GRADE_HI", "Highest Grade Offered (number, -1 if unknown)"),
+    ("SCHLEVEL", "School Level (elementary, middle, high school, etc...)"),
+]
+FLAG_COLUMNS = [
+    ("FLAGS", "Charter/Magnet/Open/Regular/Urban bitmap (FLAG_*)"),
+]
+DERIVED_COLUMNS = GRADE_COLUMNS + FLAG_COLUMNS
 
 # ==============================================================================
 # Utility Functions
@@ -78,6 +135,435 @@ def longlines(rawdata):
             lines = []
     if len(lines) > 0: yield "".join(lines)
 
+# --------------------------------------
+def parse_grade(grade):
+    """
+    Convert an NCES grade code to a number.  PK/KG are lumped in with
+    the 1st grade, ungraded and missing entries are 0.
+    """
+    try:
+        return int(grade)
+    except ValueError:
+        if (
+            grade == 'PK' or
+            grade == 'KG'
+            ):
+            return 1
+        elif (
+            grade == 'UG' or
+            grade == 'N' or
+            grade[0] == '.'
+            ):
+            return 0
+        else:
+            raise Exception("Unknown Grade: %s" % (grade))
+
+# --------------------------------------
+def to_number(field):
+    """
+    Convert a 'N' field, squashing invalid values to -1
+    """
+    try:
+        return float(field)
+    except ValueError:
+        return -1.0
+
+# --------------------------------------
+def school_level(low, high):
+    """
+    Classify a school by its numeric grade span, the first test
+    that matches wins:
+
+        SCHLEVEL_ELEMENTARY - tops out at 6th grade or below
+        SCHLEVEL_HIGH       - starts at 8th grade or above
+        SCHLEVEL_MIDDLE     - 3rd grade and up, tops out by 9th
+        SCHLEVEL_MH         - starts between 5th and 8th, goes to 10th or above
+        SCHLEVEL_K8         - starts below 3rd, tops out between 7th and 9th
+        SCHLEVEL_K12        - starts by 3rd, goes to 11th or above
+        SCHLEVEL_OTHER      - anything else
+    """
+    if high <= 6 and high > 0:
+        return SCHLEVEL_ELEMENTARY
+    elif low >= 8:
+        return SCHLEVEL_HIGH
+    elif high <= 9 and low >= 3:
+        return SCHLEVEL_MIDDLE
+    elif high >= 10 and low < 9 and low >= 5:
+        return SCHLEVEL_MH
+    elif high >= 7 and high < 10 and low < 3:
+        return SCHLEVEL_K8
+    elif high >= 11 and low <= 3:
+        return SCHLEVEL_K12
+    else:
+        return SCHLEVEL_OTHER
+
+# --------------------------------------
+def grade_columns(low, high):
+    """
+    Values of the GRADE_COLUMNS for a school's GSLO/GSHI strings
+    """
+    try:
+        low = parse_grade(low)
+        high = parse_grade(high)
+    except Exception:
+        return [-1.0, -1.0, float(SCHLEVEL_OTHER)]
+    return [float(low), float(high), float(school_level(low, high))]
+
+# --------------------------------------
+def school_flags(school):
+    """
+    FLAG_* bitmap for a school (a dict of the FLAG_SOURCES strings,
+    missing columns leave their flag unset)
+    """
+    flags = 0
+    for name, flag in YES_NO_FLAGS.items():
+        if school.get(name) in YES_VALUES:
+            flags |= flag
+    if school.get('STATUS') == '1':
+        flags |= FLAG_OPEN
+    if school.get('TYPE') == '1':
+        flags |= FLAG_REGULAR
+    if school.get('ULOCAL'):
+        if school['ULOCAL'][:1] == '1':
+            flags |= FLAG_URBAN
+    elif school.get('LOCALE') in ('1', '2'):
+        flags |= FLAG_URBAN
+    return flags
+
+# --------------------------------------
+def make_decoder(parse_instr, index_mode):
+    """
+    Build a row decoder specialised to one layout.
+
+    The layout is unrolled into the source of a single list expression
+    (one slice or index plus conversion per column), so decoding a row is
+    one call with no per-field branching.  The common case of every
+    number being valid is done with bare float() calls, a row with a bad
+    number falls back to to_number() for each numeric field.
+    """
+    fast = []
+    safe = []
+    for instr in parse_instr:
+        if index_mode:
+            field = "line[%d]" % instr[2]
+        else:
+            field = "line[%d:%d]" % (instr[2], instr[3])
+        if instr[1] == 'N':
+            fast.append("float(%s)" % field)
+            safe.append("to_number(%s)" % field)
+        else:
+            fast.append("%s.strip()" % field)
+            safe.append("%s.strip()" % field)
+
+    source = "\n".join([
+        "def decode(line):",
+        "    try:",
+        "        return [%s]" % ", ".join(fast),
+        "    except ValueError:",
+        "        return [%s]" % ", ".join(safe),
+    ])
+    namespace = {'to_number': to_number}
+    exec compile(source, "<decoder>", "exec") in namespace
+    return namespace['decode']
+
+# --------------------------------------
+def decode_column(records, instr):
+    """
+    Decode one parse instruction's column out of a 2D array of fixed
+    width records (see decode_records), returns a list of values
+    """
+    count, reclen = records.shape
+    lo, hi = instr[2], min(instr[3], reclen)
+    if hi <= lo:
+        # Past the end of the record, same as slicing a short line
+        if instr[1] == 'N':
+            return [-1.0] * count
+        return [''] * count
+
+    field = records[:, lo:hi]
+    space = (field == 32) | ((field >= 9) & (field <= 13))  # str.strip() whitespace
+    if instr[1] == 'N':
+        digit = (field >= 48) & (field <= 57)
+        runs = digit[:, 0] + (digit[:, 1:] & ~digit[:, :-1]).sum(axis=1)
+        plain = (runs == 1) & (digit | space).all(axis=1)
+        if hi - lo > 18:
+            plain[:] = False    # Could overflow the int64s
+        value = np.zeros(count, dtype=np.int64)
+        for j in range(hi - lo):
+            value = np.where(digit[:, j], value * 10 + (field[:, j] - 48), value)
+        numbers = value.astype(np.float64)
+        for i in np.flatnonzero(~plain):
+            numbers[i] = to_number(field[i].tostring())
+        return numbers.tolist()
+    else:
+        trailing = np.logical_and.accumulate(space[:, ::-1], axis=1)[:, ::-1]
+        field = np.where(trailing, 0, field).astype(np.uint8)
+        values = field.view('S%d' % (hi - lo)).ravel().tolist()
+        for i in np.flatnonzero(space[:, 0] & ~trailing[:, 0]):
+            values[i] = values[i].lstrip()
+        return values
+
+# --------------------------------------
+def decode_records(buf, reclen, parse_instr, prefilter=None):
+    """
+    Vectorised decode of a block of fixed width records.  buf holds
+    whole records of reclen bytes each (line ending included), returns
+    one list of values per parse instruction, the same values the
+    make_decoder decoder gives row by row.
+
+    The block is viewed as a 2D array of bytes and each column is worked
+    out on its slice of it.  Strings have their trailing whitespace
+    zeroed, which numpy's fixed length strings drop.  Numbers that are
+    a plain run of digits are built up digit by digit, anything else
+    ('M', '-1', '1.5', blank) goes through to_number.  buf must not hold
+    any NUL bytes.
+
+    prefilter is an (instructions, test) pair from
+    SchoolFilter.make_row_test, the test's columns are decoded first and
+    the rest only for the records that pass.
+    """
+    records = np.frombuffer(buf, dtype=np.uint8).reshape(-1, reclen)
+    if prefilter is not None:
+        instrs, test = prefilter
+        values = [decode_column(records, instr) for instr in instrs]
+        keep = [test(row) for row in itertools.izip(*values)]
+        records = records[np.array(keep, dtype=bool)]
+    return [decode_column(records, instr) for instr in parse_instr]
+
+# --------------------------------------
+def is_ascii(buf):
+    try:
+        buf.decode('ascii')
+    except UnicodeDecodeError:
+        return False
+    return True
+
+# --------------------------------------
+def make_recoder(parse_instr):
+    """
+    Function that converts the string columns of a decoded row from
+    latin-1 (the raw NCES data) to UTF-8, numbers are left alone
+    """
+    idxs = [i for i, instr in enumerate(parse_instr) if instr[1] != 'N']
+    def recode(row):
+        for i in idxs:
+            row[i] = row[i].decode('latin-1').encode('utf-8')
+        return row
+    return recode
+
+# ==============================================================================
+# Parse Time Filtering
+# ==============================================================================
+class SchoolFilter(object):
+    """
+    Which schools to keep while parsing.
+
+        column/values - keep schools where school[column] is in values
+        grades        - (low, high) keep schools teaching at least one grade
+                        in the range, a single grade works like SegCalc's grade
+
+    Raw data files are checked before a row is decoded (see make_row_test),
+    only the one or two columns the filter needs get decoded first, the
+    rest of the row only if it passes.  An unknown grade span counts as -1
+    like the GRADE_COLUMNS.
+    """
+    def __init__(self, column=None, values=None, grades=None):
+        self.column = column
+        self.values = None
+        if values is not None:
+            self.values = frozenset(values)
+        if isinstance(grades, int):
+            grades = (grades, grades)
+        self.grades = grades
+
+    @classmethod
+    def named(cls, name, grades=None):
+        """
+        SchoolFilter for one of the lists in the filters registry
+        """
+        column, values = get_filter(name)
+        return cls(column, values, grades)
+
+    def spec(self):
+        """
+        Plain (JSON friendly) description of the filter, part of the cache key
+        """
+        values = None
+        if self.values is not None:
+            values = sorted(self.values)
+        grades = None
+        if self.grades:
+            grades = list(self.grades)
+        return dict(column=self.column, values=values, grades=grades)
+
+    def __repr__(self):
+        return "SchoolFilter(column=%r, values=%d, grades=%r)" % (
+                self.column, len(self.values or []), self.grades)
+
+    # --------------------------------------
+    def match_grades(self, low, high):
+        low, high = grade_columns(low, high)[:2]
+        return low <= self.grades[1] and high >= self.grades[0]
+
+    # --------------------------------------
+    def make_check(self, headers, make_dict=False):
+        """
+        Exact test for a parsed school (a dict, or a list ordered like headers)
+        """
+        # Use the numeric grade columns if the parser made them
+        numeric = 'GRADE_LO' in headers and 'GRADE_HI' in headers
+        if numeric:
+            names = (self.column, 'GRADE_LO', 'GRADE_HI')
+        else:
+            names = (self.column, 'GSLO', 'GSHI')
+
+        if make_dict:
+            col, lo, hi = names
+        else:
+            # Like make_dict, the last column wins if a name is repeated
+            last = dict([(name, i) for i, name in enumerate(headers)])
+            col, lo, hi = [last.get(name) for name in names]
+
+        def check(school):
+            if self.values is not None and school[col] not in self.values:
+                return False
+            if self.grades:
+                if numeric:
+                    if not (school[lo] <= self.grades[1] and school[hi] >= self.grades[0]):
+                        return False
+                elif not self.match_grades(school[lo], school[hi]):
+                    return False
+            return True
+        return check
+
+    # --------------------------------------
+    def make_row_test(self, parse_instr):
+        """
+        Cheap test on just the filter columns of a raw row, returns
+        (parse instructions, test), test takes a tuple of those columns
+        decoded.  It can let through extra rows (e.g. the NYC districts
+        that get their LEAID rewritten, or latin-1 names) but never drops
+        a row make_check would keep.  None if the layout is missing a
+        column the test needs.
+        """
+        # Like make_dict, the last column wins if a name is repeated
+        last = dict([(instr[0], instr) for instr in parse_instr])
+        names = []
+        tests = []
+        if self.values is not None:
+            values = set(self.values)
+            for value in self.values:
+                try:
+                    values.add(value.decode('utf-8').encode('latin-1'))
+                except (AttributeError, UnicodeError):
+                    pass
+            pos = len(names)
+            names.append(self.column)
+            if self.column in ('LEAID', 'LEANM'):
+                names.append('LEANM')
+                tests.append(lambda row, pos=pos: (row[pos] in values or
+                        row[pos+1].startswith(NYC_GEO_DIST)))
+            else:
+                tests.append(lambda row, pos=pos: row[pos] in values)
+        if self.grades:
+            pos = len(names)
+            names.extend(['GSLO', 'GSHI'])
+            tests.append(lambda row, pos=pos: self.match_grades(row[pos], row[pos+1]))
+
+        for name in names:
+            if name not in last:
+                return None
+
+        def test(row):
+            for one_test in tests:
+                if not one_test(row):
+                    return False
+            return True
+        return ([last[name] for name in names], test)
+
+    # --------------------------------------
+    def make_prefilter(self, parse_instr, index_mode):
+        """
+        make_row_test on a raw data line (a split row in index mode)
+        """
+        row_test = self.make_row_test(parse_instr)
+        if row_test is None:
+            return lambda line: True
+        instrs, test = row_test
+        decode = make_decoder(instrs, index_mode)
+        return lambda line: test(decode(line))
+
+# --------------------------------------
+def cache_key(source):
+    """
+    Hash of a cache's source description (see NCESParser.cache_source)
+    """
+    return hashlib.sha1(json.dumps(source, sort_keys=True)).hexdigest()[:16]
+
+# --------------------------------------
+def chunk_offsets(fname, chunks, start=0):
+    """
+    Split a file into roughly equal (start, end) byte ranges that
+    always begin and end on a line boundary.
+    """
+    size = os.path.getsize(fname)
+    fh = open(fname, 'rb')
+    offsets = [start]
+    for i in range(1, chunks):
+        pos = start + (size - start) * i / chunks
+        if pos <= offsets[-1]:
+            continue
+        fh.seek(pos - 1)
+        fh.readline()   # Finish off the line we landed in
+        pos = fh.tell()
+        if pos >= size:
+            break
+        if pos > offsets[-1]:
+            offsets.append(pos)
+    fh.close()
+    offsets.append(size)
+    return zip(offsets[:-1], offsets[1:])
+
+# --------------------------------------
+def has_quotes(fname, start=0):
+    """
+    True if there's a '"' anywhere in a file after start.  chunk_offsets
+    only knows about raw newlines, not ones inside a quoted field.
+    """
+    fh = open(fname, 'rb')
+    fh.seek(start)
+    try:
+        for block in iter(lambda: fh.read(BULK_BYTES), ""):
+            if '"' in block:
+                return True
+        return False
+    finally:
+        fh.close()
+
+# --------------------------------------
+def parse_chunk(work):
+    """
+    Worker process entry point, parse one byte range of a data file.
+    Returns (schools, skip_count)
+    """
+    parser, fname, start, end, make_dict, school_filter = work
+    fh = open(fname, 'rb')
+    fh.seek(start)
+    chunk = StringIO(fh.read(end - start))
+    fh.close()
+    schools = list(parser.iter_datafile(chunk, make_dict, school_filter))
+    return (schools, parser.skip_count)
+
+# --------------------------------------
+def parse_member(work):
+    """
+    Worker process entry point, parse one part of a year's data straight
+    out of its zip archive.  Returns (schools, skip_count)
+    """
+    parser, zipname, member, make_dict, school_filter = work
+    schools = list(parser.iter_archives([(zipname, member)], make_dict, school_filter))
+    return (schools, parser.skip_count)
+
 # ==============================================================================
 # Parser Class
 # ==============================================================================
@@ -92,8 +578,9 @@ class NCESParser(object):
         [('COLUMN_NAME', idx), ('COLUMN_NAME', idx), ...]
 
     """
-    def __init__(self, year, debug=False):
+    def __init__(self, year, debug=False, subset=None):
         self.debug = debug
+        self.subset = subset
         self.parse_instr = []
         self.header_count = 0
         self.headers = []
@@ -127,6 +614,13 @@ class NCESParser(object):
 
         self.year = year
         self.formatfile = self.get_formatfile_name()
+        self._decoder = None
+
+    def __getstate__(self):
+        # The generated decoder can't be pickled, worker processes rebuild it
+        state = self.__dict__.copy()
+        state['_decoder'] = None
+        return state
 
     def __repr__(self):
         results = ""
@@ -146,8 +640,132 @@ class NCESParser(object):
         return self.get_filename(datafile_name)
 
     # --------------------------------------
-    def get_saved_datafile_name(self):
-        return self.get_filename(saved_datafile_name)
+    def get_archives(self):
+        """
+        [(zip file, member), ...] the raw data is read from when there's
+        no merged data file, straight out of the archives downloaded by
+        data/nces_get.py.  Empty unless every part is there.
+        """
+        if os.path.exists(self.get_datafile_name()):
+            return []
+        this_dir, this_filename = os.path.split(__file__)
+        archives = [(os.path.join(this_dir, 'data', zipname), member)
+                for zipname, member in get_archives(self.year)]
+        for zipname, member in archives:
+            if not os.path.exists(zipname):
+                return []
+        return archives
+
+    # --------------------------------------
+    def get_subset_filter(self):
+        """
+        SchoolFilter for the subset this parser was created for, None is everything
+        """
+        if self.subset and self.subset != FULL_SUBSET:
+            return SchoolFilter.named(self.subset)
+        return None
+
+    # --------------------------------------
+    def cache_source(self, school_filter=None):
+        """
+        Everything that determines what a cache holds.  The raw data file
+        is identified by name/size/modification time (hashing hundreds of
+        MB on every load would cost more than the cache saves), as are
+        the zip archives it is read from if there's no data file.  The
+        layout file by a hash of its contents.  Missing files are None.
+        No school_filter means every school.
+        """
+        spec = None
+        if school_filter:
+            spec = school_filter.spec()
+
+        datafile = self.get_datafile_name()
+        try:
+            stat = os.stat(datafile)
+            data = [os.path.basename(datafile), stat.st_size, int(stat.st_mtime)]
+        except OSError:
+            data = None
+            archives = self.get_archives()
+            if archives:
+                data = []
+                for zipname, member in archives:
+                    stat = os.stat(zipname)
+                    data.append([os.path.basename(zipname), member, stat.st_size, int(stat.st_mtime)])
+        try:
+            layout = hashlib.sha1(open(self.formatfile, 'rb').read()).hexdigest()
+        except IOError:
+            layout = None
+
+        return dict(
+            version=PARSER_VERSION,
+            year=self.year,
+            datafile=data,
+            layout=layout,
+            save_names=self.save_names,
+            filter=spec,
+        )
+
+    # --------------------------------------
+    def find_cache(self, school_filter=None):
+        """
+        Return the ColumnCache built from exactly the current raw data,
+        layout, columns, filter and parser version, or None.
+
+        Without the raw data file there is nothing to check against or
+        rebuild from, then any cache made with the same columns, filter
+        and parser version is used.
+        """
+        if school_filter is None:
+            school_filter = self.get_subset_filter()
+        source = self.cache_source(school_filter)
+        if source['datafile'] is not None:
+            cache = ColumnCache(self.get_filename(saved_cachedir_name % cache_key(source)))
+            if cache.exists() and cache.manifest.get('key') == cache_key(source):
+                return cache
+            return None
+
+        # Newest first
+        dirnames = glob.glob(self.get_filename(saved_cachedir_name % '*'))
+        dirnames.sort(key=os.path.getmtime, reverse=True)
+        for dirname in dirnames:
+            cache = ColumnCache(dirname)
+            if not cache.exists():
+                continue
+            cached = cache.manifest.get('source', {})
+            if all([cached.get(name) == source[name] for name in ('version', 'year', 'save_names', 'filter')]):
+                print "No raw data for %d, using unchecked cache %s" % (self.year, dirname)
+                return cache
+        return None
+
+    # --------------------------------------
+    def build_cache(self, school_filter=None, jobs=1):
+        """
+        (Re)build the cache for school_filter from the raw data file
+        """
+        if school_filter is None:
+            school_filter = self.get_subset_filter()
+        print "Parsing the NCES Data Set"
+        if jobs > 1:
+            self.parse_orig(jobs=jobs, school_filter=school_filter)
+            return self.save_parsed_data(school_filter)
+        else:
+            schools = self.iter_schools(forced_orig=True, school_filter=school_filter)
+            return self.save_parsed_data(school_filter, schools)
+
+    # --------------------------------------
+    def load_cache(self, school_filter=None, jobs=1):
+        """
+        The up to date cache for school_filter, building it if need be
+        """
+        cache = self.find_cache(school_filter)
+        if cache is None:
+            if not os.path.exists(self.get_datafile_name()) and not self.get_archives():
+                raise IOError("No NCES data or cache for %d" % self.year)
+            cache = self.build_cache(school_filter, jobs)
+        else:
+            print "Loading Previously Saved Column Cache"
+        self.headers = cache.get_headers()
+        return cache
 
     # --------------------------------------
     def get_filename(self, name_str):
@@ -169,60 +787,31 @@ class NCESParser(object):
             print "=" * 80
             print "Reading Format File:  %s" % formatfile
             print "=" * 80
-        fh = open(formatfile, 'rb')
-
-        for line in fh:
-            if re_idx_header.search(line):
-                if self.index_mode == 0:
-                    print "Switching to Index MODE!!!"
-                    self.index_mode = 1
-
-            if re_definition.search(line):
-                col_name, type, loidx, hiidx, size, description = re_definition.search(line).groups()
-            elif re_sub_definition.search(line):
-                col_name, type, loidx, hiidx, size, description = re_sub_definition.search(line).groups()
-            elif re_alt_definition.search(line):
-                col_name, loidx, hiidx, size, type, description = re_alt_definition.search(line).groups()
-            elif re_alt_sub_definition.search(line):
-                col_name, loidx, hiidx, size, type, description = re_alt_sub_definition.search(line).groups()
-            elif self.index_mode and re_idx_definition.search(line):
-                col_name, loidx, type, description = re_idx_definition.search(line).groups()
-                hiidx = loidx
-                size = 0
-            else:
-                if self.debug:
-                    print line
-                continue
+        # Start from scratch if the parser is reused
+        self.parse_instr = []
+        self.header_count = 0
+        self.headers = []
+        self.descriptions = {}
+        self.__dict__.pop('name_idx_dict', None)
+
+        # The debug run compiles the layout file itself, printing every
+        # line it doesn't understand, instead of using the layout registry
+        if self.debug:
+            with open(formatfile, 'rb') as fh:
+                layout = compile_layout(fh, self.year, debug=True)
+        else:
+            layout = get_layout(self.year, formatfile)
 
-            # Filter out a problematic NCES year to year changes
-            if col_name[:5] == "FIPST":
-                col_name = "FIPS"
-                type = 'AN'
-            if col_name[:4] == "FIPS":
-                type = 'AN'
-            if col_name[:3] == "ZIP" and col_name[:4] != "ZIP4":
-                col_name = "ZIP"
-            if col_name[:4] == "LZIP" and col_name[:5] != "LZIP4" :  # ZIP or Location ZIP (not Mailing ZIP)
-                col_name = "ZIP"
-            if col_name[:4] == "GSL0":  # 1994 typo in the format file.
-                col_name = "GSLO"
-            if col_name == "FLE%02d" % (self.year%100):
-                col_name = "FRELCH"
-            if col_name == ("IND%02d" % (self.year%100)):
-                col_name = "AM"
-            elif col_name == "IND":
-                col_name = "AM"
-            if col_name[:4] == "CITY" or col_name[:5] == "LCITY":
-                col_name = "CITY"
-            if col_name[:4] == "STATE" or col_name[:5] == "LSTATE":
-                col_name = "STATE"
-            if (col_name[:5] == "LEAID" or
-                col_name[:4] == "TYPE" or
-                col_name[:6] == "STATUS"):
-                type = 'AN'
+        if layout['index_mode'] and self.index_mode == 0:
+            print "Switching to Index MODE!!!"
+            self.index_mode = 1
 
+        for col_name, type, loidx, hiidx, size, description in layout['columns']:
             self.add_instr(col_name, type, loidx, hiidx, size, description)
 
+        self.add_derived_columns()
+        self._decoder = None
+
         if self.debug:
             print "=" * 80
             print "Format File Parsing Complete"
@@ -237,15 +826,6 @@ class NCESParser(object):
         if self.debug:
             print "Found Column:  %s - %s" % (col_name, size)
 
-        # Strip the year off the column if it is present
-        # We store the year in the main data object
-        if col_name[-2:].isdigit():
-            col_name = col_name[:-2]
-
-        # Is it a number?
-        if type == 'N':
-            pass
-
         if col_name in self.save_names:
             self.parse_instr.append((col_name, type, int(loidx)-1, int(hiidx), description.strip()))
             self.add_column(col_name, description)
@@ -257,6 +837,44 @@ class NCESParser(object):
         self.descriptions[col_name] = desc
         self.header_count += 1
 
+    # --------------------------------------
+    def add_derived_columns(self):
+        """
+        The DERIVED_COLUMNS go after the columns from the data file, the
+        grade columns only for years that have the grade span
+        """
+        derived = list(FLAG_COLUMNS)
+        if 'GSLO' in self.headers and 'GSHI' in self.headers:
+            derived = GRADE_COLUMNS + derived
+        for col_name, description in derived:
+            self.add_column(col_name, description)
+
+    # --------------------------------------
+    def get_derive(self):
+        """
+        Function that appends the DERIVED_COLUMNS to a parsed row (a list).
+        There are only a handful of distinct grade spans and flag
+        combinations, each one is worked out once.
+        """
+        steps = []
+        if GRADE_COLUMNS[0][0] in self.headers:
+            steps.append(([self.get_idx('GSLO'), self.get_idx('GSHI')],
+                    lambda values: grade_columns(*values), {}))
+        names = [name for name in FLAG_SOURCES if name in self.headers]
+        steps.append(([self.get_idx(name) for name in names],
+                lambda values: [float(school_flags(dict(zip(names, values))))], {}))
+
+        def derive(row):
+            for idxs, func, seen in steps:
+                values = tuple([row[i] for i in idxs])
+                try:
+                    row.extend(seen[values])
+                except KeyError:
+                    seen[values] = func(values)
+                    row.extend(seen[values])
+            return row
+        return derive
+
     # --------------------------------------
     def get_headers(self):
         return self.headers
@@ -271,12 +889,44 @@ class NCESParser(object):
                 self.name_idx_dict[name] = i
             return self.name_idx_dict[col_name]
 
+    # --------------------------------------
+    def get_column_types(self):
+        """
+        Map each column name to its NCES data type ('N' or 'AN')
+        """
+        types = {}
+        for instr in self.parse_instr:
+            types[instr[0]] = instr[1]
+        for col_name, description in DERIVED_COLUMNS:
+            if col_name in self.headers:
+                types[col_name] = 'N'
+        return types
+
     # --------------------------------------
     def get_descriptions(self):
         return ",".join(self.descriptions)
 
+    # --------------------------------------
+    def get_decoder(self):
+        """
+        Row decoder compiled from the current parse instructions
+        """
+        if self._decoder is None:
+            self._decoder = make_decoder(self.parse_instr, self.index_mode)
+        return self._decoder
+
     # --------------------------------------
     def parse_line(self, line):
+        if self.debug:
+            return self.parse_line_generic(line)
+        return self.get_decoder()(line)
+
+    # --------------------------------------
+    def parse_line_generic(self, line):
+        """
+        Field by field interpreter of the parse instructions,
+        used in debug mode (prints each field) and for benchmarking.
+        """
         entry = []
         for instr in self.parse_instr:
             if self.index_mode:
@@ -297,7 +947,222 @@ class NCESParser(object):
         return entry
 
     # --------------------------------------
-    def parse_orig(self, datafile="", make_dict=False):
+    def iter_lines(self, lines, make_dict=False, school_filter=None, latin1=False):
+        """
+        Generator, parses an iterable of raw data file lines and yields
+        the schools (see iter_rows).
+
+        With a SchoolFilter, lines are checked on just the filter columns
+        before the rest of the row is decoded.  latin1 lines have their
+        string columns converted to UTF-8.
+        """
+        if self.index_mode:
+            lines = csv.reader(lines, dialect='excel-tab')
+
+        if self.debug:
+            parse_line = self.parse_line_generic
+        else:
+            parse_line = self.get_decoder()
+
+        if school_filter:
+            prefilter = school_filter.make_prefilter(self.parse_instr, self.index_mode)
+            lines = itertools.ifilter(prefilter, lines)
+
+        rows = itertools.imap(parse_line, lines)
+        if latin1:
+            rows = itertools.imap(make_recoder(self.parse_instr), rows)
+        return self.iter_rows(rows, make_dict, school_filter)
+
+    # --------------------------------------
+    def iter_records(self, fh, latin1=False, school_filter=None):
+        """
+        Generator, decodes an open fixed width data file BULK_RECORDS
+        records at a time (see decode_records) and yields the rows.
+
+        The record length comes from the first line.  A block that isn't
+        made of whole records of that length (ragged lines, or a last line
+        with no line ending), or that holds a NUL byte, is finished off to
+        the end of its last line and handed to the row decoder, the next
+        block goes back to decode_records.  For a latin1 file the string
+        columns of a block with anything but ASCII in it are converted to
+        UTF-8.
+
+        With a SchoolFilter only the records that pass its row test (see
+        SchoolFilter.make_row_test) are decoded past the filter columns.
+        """
+        decode = self.get_decoder()
+        recode = make_recoder(self.parse_instr)
+        row_test = None
+        if school_filter:
+            row_test = school_filter.make_row_test(self.parse_instr)
+            prefilter = school_filter.make_prefilter(self.parse_instr, 0)
+        first = fh.readline()
+        reclen = len(first)
+        buf = first + fh.read(reclen * (BULK_RECORDS - 1))
+        while buf:
+            records = np.frombuffer(buf, dtype=np.uint8)
+            if (len(buf) % reclen or "\x00" in buf or
+                (records[reclen-1::reclen] != ord("\n")).any()):
+                if not buf.endswith("\n"):
+                    buf += fh.readline()    # Finish off the line we landed in
+                lines = StringIO(buf)
+                if school_filter:
+                    lines = itertools.ifilter(prefilter, lines)
+                rows = itertools.imap(decode, lines)
+            else:
+                columns = decode_records(buf, reclen, self.parse_instr, row_test)
+                rows = itertools.imap(list, itertools.izip(*columns))
+            if latin1 and not is_ascii(buf):
+                rows = itertools.imap(recode, rows)
+            for row in rows:
+                yield row
+            buf = fh.read(reclen * BULK_RECORDS)
+
+    # --------------------------------------
+    def iter_tsv_blocks(self, fh, latin1=False, school_filter=None):
+        """
+        Generator, reads an open tab separated data file about BULK_BYTES
+        at a time and yields an iterator over the rows of each block.
+
+        Without any quoting a tab separated line is just str.split, which
+        is a good bit quicker than csv.reader.  The lines are only split
+        as far as the last column the layout keeps, the row decoder picks
+        the columns out of that (and strips the '\r' off a last column).
+        A block that needs the csv module's rules (quotes or NUL bytes) is
+        handed to csv.reader, along with the rest of the file.  latin1
+        and school_filter work the same as for iter_records, a split line
+        is tested on its filter fields before it is decoded.
+        """
+        decode = self.get_decoder()
+        recode = make_recoder(self.parse_instr)
+        maxsplit = max([instr[2] for instr in self.parse_instr]) + 1
+        prefilter = None
+        if school_filter:
+            prefilter = school_filter.make_prefilter(self.parse_instr, 1)
+        while True:
+            buf = fh.read(BULK_BYTES)
+            if not buf:
+                return
+            buf += fh.readline()    # Finish off the line we landed in
+            if '"' in buf or "\x00" in buf:
+                lines = itertools.chain(StringIO(buf), fh)
+                rows = csv.reader(lines, dialect='excel-tab')
+                if prefilter:
+                    rows = itertools.ifilter(prefilter, rows)
+                rows = itertools.imap(decode, rows)
+                if latin1:
+                    rows = itertools.imap(recode, rows)
+                yield rows
+                return
+            lines = buf.split("\n")
+            if not lines[-1]:
+                lines.pop()
+            rows = itertools.imap(str.split, lines, itertools.repeat("\t"), itertools.repeat(maxsplit))
+            if prefilter:
+                rows = itertools.ifilter(prefilter, rows)
+            rows = itertools.imap(decode, rows)
+            if latin1 and not is_ascii(buf):
+                rows = itertools.imap(recode, rows)
+            yield rows
+
+    # --------------------------------------
+    def iter_rows(self, rows, make_dict=False, school_filter=None):
+        """
+        Generator, finishes off decoded rows (lists, one value per parse
+        instruction) and yields the schools.  Schools outside the known
+        states are counted in self.skip_count.
+        """
+        derive = self.get_derive()
+        if school_filter:
+            check = school_filter.make_check(self.headers, make_dict)
+        else:
+            check = None
+
+        self.skip_count = 0
+        for row in rows:
+            if make_dict:
+                school = self.make_dict(derive(row))
+                if school['LEANM'].startswith(NYC_GEO_DIST):
+                    school['LEAID'] = "3620580"
+                    school['LEANM'] = "NEW YORK CITY GEOGRAPHIC DISTRICTS"
+                if school['FIPS'] not in fips_to_st.keys():
+                    self.skip_count += 1
+                elif check is None or check(school):
+                    yield school
+            else:
+                school = derive(row)
+                if school[self.get_idx('LEANM')].startswith(NYC_GEO_DIST):
+                    school[self.get_idx('LEAID')] = "3620580"
+                    school[self.get_idx('LEANM')] = "NEW YORK CITY GEOGRAPHIC DISTRICTS"
+                if school[self.get_idx('FIPS')] not in fips_to_st.keys():
+                    self.skip_count += 1
+                elif check is None or check(school):
+                    yield school
+
+    # --------------------------------------
+    def iter_datafile(self, fh, make_dict=False, school_filter=None, latin1=False):
+        """
+        Parse an open raw data file, returns a generator of schools.
+        Fixed width and tab separated files are read in blocks, debug
+        mode (which prints each field) goes line by line.  The merged
+        data files are UTF-8, latin1 is for the raw NCES data.
+        """
+        if self.debug:
+            return self.iter_lines(fh, make_dict, school_filter, latin1)
+        if self.index_mode:
+            rows = itertools.chain.from_iterable(self.iter_tsv_blocks(fh, latin1, school_filter))
+            return self.iter_rows(rows, make_dict, school_filter)
+        return self.iter_rows(self.iter_records(fh, latin1, school_filter), make_dict, school_filter)
+
+    # --------------------------------------
+    def iter_archives(self, archives, make_dict=False, school_filter=None):
+        """
+        Generator, parses the parts of a year straight out of their zip
+        archives (see get_archives) in turn and yields the schools.  Each
+        member is decompressed as it is read, nothing is unpacked to disk.
+        The member is closed however the generator ends, like iter_file.
+        """
+        skip_count = 0
+        for zipname, member in archives:
+            with zipfile.ZipFile(zipname) as zf:
+                fh = zf.open(find_member(zf.namelist(), member))
+                try:
+                    if self.index_mode:
+                        fh.readline() # Pop the header line
+                    for school in self.iter_datafile(fh, make_dict, school_filter, latin1=True):
+                        yield school
+                    skip_count += self.skip_count
+                finally:
+                    fh.close()
+        self.skip_count = skip_count
+
+    # --------------------------------------
+    def iter_file(self, fh, make_dict=False, school_filter=None):
+        """
+        Generator, iter_datafile on an open raw data file that closes the
+        file once the schools run out, or the generator is dropped early.
+        """
+        try:
+            for school in self.iter_datafile(fh, make_dict, school_filter):
+                yield school
+        finally:
+            fh.close()
+
+    # --------------------------------------
+    def parse_lines(self, lines, make_dict=False, school_filter=None):
+        """
+        Parse an iterable of raw data file lines.
+        Returns (schools, skip_count)
+        """
+        schools = list(self.iter_lines(lines, make_dict, school_filter))
+        return (schools, self.skip_count)
+
+    # --------------------------------------
+    def open_datafile(self, datafile=""):
+        """
+        Read the format file and open the raw data file,
+        positioned on the first line of data.
+        """
         # Read the format file
         self.read_formatfile(self.formatfile)
 
@@ -309,30 +1174,56 @@ class NCESParser(object):
 
         fh = open(fname, 'rb')
         if self.index_mode:
-            fh = csv.reader(fh, dialect='excel-tab')
-            line = fh.next() # Pop the header line
+            fh.readline() # Pop the header line
+        return fh
+
+    # --------------------------------------
+    def parse_orig(self, datafile="", make_dict=False, jobs=1, school_filter=None):
+        """
+        Parse the raw NCES data file.  With jobs > 1 the file is split on
+        line boundaries and the pieces are parsed in worker processes.
+        A quoted tab separated field can hold a newline, so a tab separated
+        file with any quotes in it is parsed in one process (see has_quotes).
+        Without the merged data file the zip archives are read instead,
+        with jobs > 1 the parts of a split year are parsed side by side.
+        """
+        archives = []
+        if not datafile:
+            archives = self.get_archives()
 
-        skip_count = 0
         self.schools = []
-        for line in fh:
-            if make_dict:
-                school = self.make_dict(self.parse_line(line))
-                if school['LEANM'].startswith("NEW YORK CITY GEOGRAPHIC DISTRICT"):
-                    school['LEAID'] = "3620580"
-                    school['LEANM'] = "NEW YORK CITY GEOGRAPHIC DISTRICTS"
-                if school['FIPS'] in fips_to_st.keys():
-                    self.schools.append(school)
-                else:
-                    skip_count += 1
+        if archives:
+            self.read_formatfile(self.formatfile)
+            work = [(self, zipname, member, make_dict, school_filter) for zipname, member in archives]
+            skip_count = 0
+            for schools, skipped in map_years(parse_member, work, jobs):
+                self.schools.extend(schools)
+                skip_count += skipped
+        else:
+            fh = self.open_datafile(datafile)
+            if jobs > 1 and self.index_mode and has_quotes(fh.name, fh.tell()):
+                print "Quoted fields in %s, parsing it in a single process" % fh.name
+                jobs = 1
+            if jobs <= 1:
+                self.schools = list(self.iter_file(fh, make_dict, school_filter))
+                skip_count = self.skip_count
             else:
-                school = self.parse_line(line)
-                if school[self.get_idx('LEANM')].startswith("NEW YORK CITY GEOGRAPHIC DISTRICT"):
-                    school[self.get_idx('LEAID')] = "3620580"
-                    school[self.get_idx('LEANM')] = "NEW YORK CITY GEOGRAPHIC DISTRICTS"
-                if school[self.get_idx('FIPS')] in fips_to_st.keys():
-                    self.schools.append(school)
-                else:
-                    skip_count += 1
+                fname = fh.name
+                start = fh.tell()
+                fh.close()
+                work = [(self, fname, lo, hi, make_dict, school_filter)
+                        for lo, hi in chunk_offsets(fname, jobs * CHUNKS_PER_JOB, start)]
+                pool = multiprocessing.Pool(processes=jobs)
+                try:
+                    results = pool.map(parse_chunk, work)
+                finally:
+                    pool.terminate()
+                    pool.join()
+
+                skip_count = 0
+                for schools, skipped in results:
+                    self.schools.extend(schools)
+                    skip_count += skipped
 
         if self.debug:
             print "Found %d Schools" % len(self.schools)
@@ -341,40 +1232,59 @@ class NCESParser(object):
 
 
     # --------------------------------------
-    def parse_saved(self, make_dict=False):
-
-        saved_fname = self.get_saved_datafile_name()
-        fh = open(saved_fname, 'rb')
-
-        if make_dict:
-            cfh = csv.DictReader(fh, quoting=csv.QUOTE_NONNUMERIC)
-            self.headers = cfh.fieldnames
-        else:
-            cfh = csv.reader(fh, quoting=csv.QUOTE_NONNUMERIC)
-            self.headers = cfh.next()
-
-        self.schools = []
-        for line in cfh:
-            self.schools.append(line)
+    def parse_cached(self, make_dict=False, school_filter=None, jobs=1):
+        """
+        Load the column cache for school_filter (default, the parser's subset),
+        it is (re)built from the raw data first if missing or out of date.
+        """
+        cache = self.load_cache(school_filter, jobs)
+        self.schools = cache.read(make_dict)
 
         if self.debug:
             print len(self.schools)
         return self.schools
 
+    # --------------------------------------
+    def get_columns(self, mmap_mode='r', school_filter=None):
+        """
+        Memory mapped numpy arrays for each column of the cached year,
+        no per school python objects are created.
+        """
+        return CachedColumns(self.load_cache(school_filter), mmap_mode)
 
     # --------------------------------------
-    def parse(self, datafile="", make_dict=False, forced_orig=False):
+    def parse(self, datafile="", make_dict=False, forced_orig=False, jobs=1, school_filter=None):
+        """
+        Load a year of schools.
+
+        school_filter (a SchoolFilter) limits which schools are returned,
+        it defaults to the subset the parser was created for.  Each filter
+        gets its own cache, keyed on the raw data, layout, columns and
+        parser version so a stale or different subset is never picked up.
+        forced_orig/datafile skip the caches and read the raw file.
+        """
         if forced_orig or datafile:
-            return self.parse_orig(datafile, make_dict)
-        else:
-            saved_fname = self.get_saved_datafile_name()
-            try:
-                open(saved_fname, 'rb')
-                print "Loading Previously Saved CSV Data Set"
-                return self.parse_saved(make_dict)
-            except IOError:
-                print "Parsing the NCES Data Set"
-                return self.parse_orig(datafile, make_dict)
+            return self.parse_orig(datafile, make_dict, jobs, school_filter)
+        return self.parse_cached(make_dict, school_filter, jobs)
+
+    # --------------------------------------
+    def iter_schools(self, datafile="", make_dict=False, forced_orig=False, school_filter=None):
+        """
+        Streaming version of parse(), same sources, but returns an iterator
+        that hands out schools one at a time instead of collecting them in
+        self.schools.  Good for single pass reports.
+
+        The headers are set up before this returns, only the rows are lazy.
+        """
+        if forced_orig or datafile:
+            archives = []
+            if not datafile:
+                archives = self.get_archives()
+            if archives:
+                self.read_formatfile(self.formatfile)
+                return self.iter_archives(archives, make_dict, school_filter)
+            return self.iter_file(self.open_datafile(datafile), make_dict, school_filter)
+        return self.load_cache(school_filter).iter_rows(make_dict)
 
     # --------------------------------------
     def make_dict(self, school):
@@ -383,25 +1293,54 @@ class NCESParser(object):
         return dict(zip(self.headers, school))
 
     # --------------------------------------
-    def save_parsed_data(self, filter=False, idx="", idx_list=[]):
+    def save_parsed_data(self, school_filter=None, schools=None):
         """
-        Save out the parsed data
+        Save out the parsed data to the column cache.
+
+        schools defaults to self.schools, pass iter_schools() to stream
+        straight from the data file to the cache.  school_filter picks
+        which of them are saved.
         """
-        fname = self.get_saved_datafile_name()
+        return self.save_subsets([(school_filter, school_filter)], schools)[0]
 
-        fh = open(fname, 'wb')
-        cfh = csv.writer(fh, quoting=csv.QUOTE_NONNUMERIC)
-        cfh.writerow(self.get_headers())
+    # --------------------------------------
+    def save_subsets(self, subsets, schools=None):
+        """
+        Save several subsets of the parsed data in a single pass over the
+        schools, each into its own cache directory.
+
+        subsets is a list of (subset name, SchoolFilter or None),
+        returns the ColumnCaches written.
+        """
+        if schools is None:
+            schools = self.schools
 
-        count = 0
-        for school in self.schools:
-            if (not filter or
-                    filter and school[self.get_idx(idx)] in idx_list):
-                if self.debug:
-                    print school
-                cfh.writerow(school)
-                count += 1
-        print "Saved %d Entries to CSV File %s" % (count, fname)
+        headers = self.get_headers()
+        kinds = self.get_column_types()
+        outputs = []
+        for subset, school_filter in subsets:
+            check = None
+            if school_filter:
+                check = school_filter.make_check(headers)
+            source = self.cache_source(school_filter)
+            key = cache_key(source)
+            cache = ColumnCache(self.get_filename(saved_cachedir_name % key))
+            writer = cache.writer(headers, kinds, key=key, source=source, index=INDEX_COLUMNS)
+            outputs.append((cache, writer, check))
+
+        for school in schools:
+            if isinstance(school, dict):
+                school = [school[name] for name in headers]
+            if self.debug:
+                print school
+            for cache, writer, check in outputs:
+                if check is None or check(school):
+                    writer.append(school)
+
+        for cache, writer, check in outputs:
+            writer.close()
+            print "Saved %d Entries to Column Cache %s" % (cache.get_row_count(), cache.dirname)
+        return [cache for cache, writer, check in outputs]
 
 # *****************************************************************************
 # Unit Tests
@@ -414,6 +1353,254 @@ class TestBasicNetwork(unittest.TestCase):
     def test_old_style(self):
         self.assertEqual(self.parse.something, ["Test"])
 
+class TestDecoder(unittest.TestCase):
+
+    def setUp(self):
+        self.instr = [
+            ('FIPS', 'AN', 0, 2, ''),
+            ('LEANM', 'AN', 2, 8, ''),
+            ('MEMBER', 'N', 8, 12, ''),
+        ]
+
+    def test_fixed_width(self):
+        decode = make_decoder(self.instr, 0)
+        self.assertEqual(decode("06 ABC  1234"), ['06', 'ABC', 1234.0])
+        self.assertEqual(decode("06 ABC     M"), ['06', 'ABC', -1.0])
+
+    def test_index_mode(self):
+        instr = [(name, type, i, i, desc) for i, (name, type, lo, hi, desc) in enumerate(self.instr)]
+        decode = make_decoder(instr, 1)
+        self.assertEqual(decode(['06', ' ABC ', '12']), ['06', 'ABC', 12.0])
+        self.assertEqual(decode(['06', 'ABC', 'N']), ['06', 'ABC', -1.0])
+
+    def test_records(self):
+        lines = ["06 ABC  1234\r\n", "36XYZ      M\r\n", "06     12.5 \r\n"]
+        decode = make_decoder(self.instr, 0)
+        columns = decode_records("".join(lines), len(lines[0]), self.instr)
+        self.assertEqual(map(list, zip(*columns)), [decode(line) for line in lines])
+
+    def test_records_ragged(self):
+        global BULK_RECORDS
+        parser = NCESParser(year=1987)
+        parser.parse_instr = self.instr
+        decode = parser.get_decoder()
+        lines = ["06 ABC  1234\n", "36XYZ      M\n", "06 AB 12\n", "06 ABC    12\n", "36XYZ      5\n", "06 ABC  12"]
+        fh = StringIO("".join(lines))
+        saved, BULK_RECORDS = BULK_RECORDS, 2
+        try:
+            rows = parser.iter_records(fh)
+            self.assertEqual([rows.next() for i in range(3)], [decode(line) for line in lines[:3]])
+            # Only the ragged block was row decoded, not the rest of the file
+            self.assertEqual(fh.tell(), len("".join(lines[:5])))
+            self.assertEqual(list(rows), [decode(line) for line in lines[3:]])
+        finally:
+            BULK_RECORDS = saved
+
+    def test_tsv_blocks(self):
+        parser = NCESParser(year=2010)
+        parser.parse_instr = [(name, type, i, i, desc) for i, (name, type, lo, hi, desc) in enumerate(self.instr)]
+        parser.index_mode = 1
+        decode = parser.get_decoder()
+        for data in ["06\tABC\t12\tX\r\n36\tXYZ\tM\r\n", "06\t\"A\tB\"\t12\n36\tXYZ\t5"]:
+            rows = itertools.chain.from_iterable(parser.iter_tsv_blocks(StringIO(data)))
+            expect = map(decode, csv.reader(StringIO(data), dialect='excel-tab'))
+            self.assertEqual(list(rows), expect)
+
+    def test_latin1(self):
+        parser = NCESParser(year=1987)
+        parser.parse_instr = self.instr
+        lines = "06CAF\xc9   12\n36XYZ      M\n"
+        rows = list(parser.iter_records(StringIO(lines), latin1=True))
+        self.assertEqual(rows, [['06', 'CAF\xc3\x89', 12.0], ['36', 'XYZ', -1.0]])
+
+class TestSchoolFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.instr = [
+            ('LEAID', 'AN', 0, 7, ''),
+            ('LEANM', 'AN', 7, 45, ''),
+            ('GSLO', 'AN', 45, 47, ''),
+            ('GSHI', 'AN', 47, 49, ''),
+        ]
+        self.headers = [instr[0] for instr in self.instr]
+        self.lines = [
+            "0622710LOS ANGELES UNIFIED                   KG05\n",
+            "3600076NEW YORK CITY GEOGRAPHIC DISTRICT # 1 0912\n",
+            "0100007SOMEWHERE ELSE                        0608\n",
+        ]
+
+    def test_values(self):
+        school_filter = SchoolFilter('LEAID', ['0622710', '3620580'])
+        prefilter = school_filter.make_prefilter(self.instr, 0)
+        self.assertEqual([prefilter(line) for line in self.lines], [True, True, False])
+        check = school_filter.make_check(self.headers)
+        self.assertTrue(check(['3620580', '', 'KG', '05']))
+        self.assertFalse(check(['3600076', '', 'KG', '05']))
+
+    def test_grades(self):
+        prefilter = SchoolFilter(grades=(6, 8)).make_prefilter(self.instr, 0)
+        self.assertEqual([prefilter(line) for line in self.lines], [False, False, True])
+        check = SchoolFilter(grades=1).make_check(self.headers, make_dict=True)
+        self.assertTrue(check(dict(GSLO='PK', GSHI='05')))
+        self.assertFalse(check(dict(GSLO='06', GSHI='08')))
+        # Same as the numeric columns, an unknown grade is dropped, not an error
+        self.assertFalse(check(dict(GSLO='XX', GSHI='08')))
+
+    def test_numeric_grades(self):
+        headers = self.headers + [name for name, description in GRADE_COLUMNS]
+        check = SchoolFilter(grades=(6, 8)).make_check(headers)
+        self.assertTrue(check(['', '', '06', '08'] + grade_columns('06', '08')))
+        self.assertFalse(check(['', '', 'KG', '05'] + grade_columns('KG', '05')))
+        self.assertFalse(check(['', '', 'XX', '08'] + grade_columns('XX', '08')))
+
+    def test_blocks(self):
+        school_filter = SchoolFilter('LEAID', ['3620580'], grades=(9, 12))
+        row_test = school_filter.make_row_test(self.instr)
+        columns = decode_records("".join(self.lines), len(self.lines[0]), self.instr, row_test)
+        self.assertEqual(zip(*columns), [tuple(make_decoder(self.instr, 0)(self.lines[1]))])
+        parser = NCESParser(year=2010)
+        parser.parse_instr = [(name, type, i, i, desc) for i, (name, type, lo, hi, desc) in enumerate(self.instr)]
+        parser.index_mode = 1
+        data = "".join(["\t".join([line[lo:hi] for name, type, lo, hi, desc in self.instr]) + "\n"
+                for line in self.lines])
+        rows = itertools.chain.from_iterable(parser.iter_tsv_blocks(StringIO(data), school_filter=school_filter))
+        self.assertEqual([row[0] for row in rows], ['3600076'])
+        self.assertEqual(SchoolFilter('ZIP', ['95112']).make_row_test(self.instr), None)
+
+class TestSchoolLevel(unittest.TestCase):
+
+    def test_levels(self):
+        self.assertEqual(grade_columns('KG', '05'), [1.0, 5.0, SCHLEVEL_ELEMENTARY])
+        self.assertEqual(school_level(9, 12), SCHLEVEL_HIGH)
+        self.assertEqual(school_level(6, 8), SCHLEVEL_MIDDLE)
+        self.assertEqual(school_level(7, 12), SCHLEVEL_MH)
+        self.assertEqual(school_level(1, 8), SCHLEVEL_K8)
+        self.assertEqual(school_level(1, 12), SCHLEVEL_K12)
+        self.assertEqual(school_level(0, 0), SCHLEVEL_OTHER)
+
+class TestSchoolFlags(unittest.TestCase):
+
+    def test_flags(self):
+        school = dict(CHARTR='Y', MAGNET='2', STATUS='1', TYPE='1', ULOCAL='21', LOCALE='1')
+        self.assertEqual(school_flags(school), FLAG_CHARTER | FLAG_OPEN | FLAG_REGULAR)
+        # Older years only have LOCALE
+        self.assertEqual(school_flags(dict(MAGNET='1', LOCALE='2')), FLAG_MAGNET | FLAG_URBAN)
+
+class TestChunkOffsets(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.fname = tempfile.mkstemp()
+        os.write(fd, "".join(["line %d %s\n" % (i, "x" * (i % 7)) for i in range(100)]))
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def test_line_boundaries(self):
+        data = open(self.fname, 'rb').read()
+        for chunks in (1, 2, 3, 8, 500):
+            offsets = chunk_offsets(self.fname, chunks)
+            self.assertEqual(offsets[0][0], 0)
+            self.assertEqual(offsets[-1][1], len(data))
+            self.assertEqual("".join([data[lo:hi] for lo, hi in offsets]), data)
+            for lo, hi in offsets:
+                self.assertTrue(lo < hi)
+                self.assertTrue(data[hi-1] == "\n")
+
+    def test_start(self):
+        start = open(self.fname, 'rb').readline()
+        offsets = chunk_offsets(self.fname, 4, len(start))
+        self.assertEqual(offsets[0][0], len(start))
+
+    def test_quotes(self):
+        self.assertFalse(has_quotes(self.fname))
+        with open(self.fname, 'ab') as f:
+            f.write('06\t"TWO\nLINES"\t12\n')
+        size = os.path.getsize(self.fname)
+        self.assertTrue(has_quotes(self.fname))
+        self.assertFalse(has_quotes(self.fname, size - 3))
+
+class TestCacheSource(unittest.TestCase):
+
+    def setUp(self):
+        import nces_layouts
+        self.dirname = dirname = tempfile.mkdtemp()
+        # Keep the test year out of the real layout registry
+        self.registry = nces_layouts._registry
+        nces_layouts._registry = nces_layouts.LayoutRegistry(os.path.join(dirname, "layouts.json"))
+
+        class TempParser(NCESParser):
+            def get_filename(self, name_str):
+                return os.path.join(dirname, name_str % (self.year%100, (self.year+1)%100))
+            def get_archives(self):
+                return []
+        self.parser = TempParser(year=1987)
+
+        self.layout = "\n".join([
+            "FIPS    AN  1-2   2  State",
+            "LEAID   AN  3-9   7  District ID",
+            "LEANM   AN  10-21 12 District Name",
+            "GSLO    AN  22-23 2  Low Grade",
+            "GSHI    AN  24-25 2  High Grade",
+            "MEMBER  N   26-29 4  Students",
+            "",
+        ])
+        self.lines = [
+            "060600001LOS ANGELES KG05 100\n",
+            "060600002SAN JOSE    0912  40\n",
+        ]
+        self.write(self.parser.formatfile, self.layout)
+        self.datafile = self.parser.get_datafile_name()
+        self.write(self.datafile, "".join(self.lines))
+
+    def tearDown(self):
+        import nces_layouts
+        nces_layouts._registry = self.registry
+        shutil.rmtree(self.dirname)
+
+    def write(self, fname, data):
+        with open(fname, 'wb') as f:
+            f.write(data)
+
+    def test_invalidation(self):
+        high = SchoolFilter(grades=(9, 12))
+        full = self.parser.load_cache()
+        self.assertEqual(full.get_row_count(), 2)
+        self.assertEqual(self.parser.find_cache().dirname, full.dirname)
+        # Each filter has its own cache
+        self.assertEqual(self.parser.find_cache(high), None)
+        filtered = self.parser.load_cache(high)
+        self.assertEqual(filtered.get_row_count(), 1)
+        self.assertNotEqual(filtered.dirname, full.dirname)
+        self.assertEqual(self.parser.find_cache().dirname, full.dirname)
+
+        # A changed layout file
+        self.write(self.parser.formatfile, self.layout.replace("Students", "Student Count"))
+        self.assertEqual(self.parser.find_cache(), None)
+        self.write(self.parser.formatfile, self.layout)
+        self.assertEqual(self.parser.find_cache().dirname, full.dirname)
+
+        # A touched data file, then a bigger one
+        stat = os.stat(self.datafile)
+        os.utime(self.datafile, (stat.st_atime, stat.st_mtime + 10))
+        self.assertEqual(self.parser.find_cache(), None)
+        os.utime(self.datafile, (stat.st_atime, stat.st_mtime))
+        self.assertEqual(self.parser.find_cache().dirname, full.dirname)
+        self.write(self.datafile, "".join(self.lines + ["060600003OAKLAND     0608  70\n"]))
+        os.utime(self.datafile, (stat.st_atime, stat.st_mtime))
+        self.assertEqual(self.parser.find_cache(), None)
+        rebuilt = self.parser.load_cache()
+        self.assertEqual(rebuilt.get_row_count(), 3)
+
+        # Without the raw data the newest cache with the same filter is used
+        os.utime(full.dirname, (0, 0))
+        os.remove(self.datafile)
+        self.assertEqual(self.parser.find_cache().dirname, rebuilt.dirname)
+        self.assertEqual(self.parser.find_cache(high).dirname, filtered.dirname)
+        other = SchoolFilter(grades=(1, 5))
+        self.assertEqual(self.parser.find_cache(other), None)
+        self.assertRaises(IOError, self.parser.load_cache, other)
+
 # *****************************************************************************
 # Program Flow
 # *****************************************************************************
@@ -428,6 +1615,8 @@ def main():
     parser.add_argument('--match_val', nargs='+', action='store', dest='match_val', required=False,
             help='Value to match when using --match_idx')
     # Prepackaged match-idx/val pairs
+    parser.add_argument('--filter', action='store', dest='filter', required=False, choices=filter_names(),
+            help='Select only schools matching one of the named filters')
     parser.add_argument('-urban_only', action='store_true', dest='urban_only', required=False,
             help='Filter out non-Urban Districts')
     parser.add_argument('-big_only', action='store_true', dest='big_only', required=False,
@@ -438,35 +1627,83 @@ def main():
             help='Select only Districts in the NAEP TUDA List')
     parser.add_argument('-sjzips', action='store_true', dest='sjzips', required=False,
             help='Select only Districts in San Jose, CA')
+    parser.add_argument('--outputs', nargs='+', action='store', dest='outputs', required=False,
+            choices=[FULL_SUBSET] + filter_names(), metavar='SUBSET',
+            help='Save each of these subsets (full or a named filter) to its own cache in one pass')
+    parser.add_argument('--grades', nargs=2, action='store', dest='grades', required=False, type=int,
+            metavar=('LOW', 'HIGH'), help='Only keep schools teaching a grade in this range')
     # Other Options
+    parser.add_argument('--jobs', action='store', dest='jobs', required=False, type=int, default=1,
+            help='Number of processes used to parse each raw data file')
     parser.add_argument('-debug', action='store_true',
             help='Print Debug Messages')
     args = parser.parse_args()
     # print args
 
+    # --outputs writes the caches NCESParser(subset=...) reads back, those
+    # are just the named filter, so the other filter options can't apply
+    if args.outputs:
+        others = [('-urban_only', args.urban_only), ('-big_only', args.big_only),
+                ('-ca_big_only', args.ca_big_only), ('-tuda_only', args.tuda_only),
+                ('-sjzips', args.sjzips), ('--filter', args.filter),
+                ('--match_idx', args.match_idx), ('--grades', args.grades)]
+        used = [name for name, value in others if value]
+        if used:
+            parser.error("%s can't be combined with --outputs, the subset caches "
+                    "are the named filters only" % ", ".join(used))
+
     # -------------------------------------
     # Actually do the work we intend to do here
     # -------------------------------------
+    grades = None
+    if args.grades:
+        grades = tuple(args.grades)
+
+    saves = []
+    if args.urban_only:
+        saves.append(SchoolFilter.named('urban', grades))
+    if args.big_only:
+        saves.append(SchoolFilter.named('big', grades))
+    if args.ca_big_only:
+        saves.append(SchoolFilter.named('ca_big', grades))
+    elif args.tuda_only:
+        saves.append(SchoolFilter.named('tuda', grades))
+    elif args.sjzips:
+        saves.append(SchoolFilter.named('sjzips', grades))
+    elif args.filter:
+        saves.append(SchoolFilter.named(args.filter, grades))
+    elif args.match_idx:
+        saves.append(SchoolFilter(args.match_idx, args.match_val, grades))
+    elif grades:
+        saves.append(SchoolFilter(grades=grades))
+    else:
+        saves.append(None)
+
+    # Each subset gets its own cache, keyed by its filter
+    subsets = [(None, school_filter) for school_filter in saves]
+    if args.outputs:
+        subsets = []
+        for subset in args.outputs:
+            school_filter = None
+            if subset != FULL_SUBSET:
+                school_filter = SchoolFilter.named(subset)
+            subsets.append((subset, school_filter))
+
     for year in range(FIRST_YEAR, LAST_YEAR+1):
         print "=" * 80
         print "Saving out a reduced dataset for %d" % year
         print "=" * 80
         parser = NCESParser(year=year, debug=args.debug)
-        parser.parse(forced_orig=True)
-        if args.urban_only:
-            parser.save_parsed_data(filter=True, idx="LEAID", idx_list=urban_dist)
-        if args.big_only:
-            parser.save_parsed_data(filter=True, idx="LEAID", idx_list=big_dist)
-        if args.ca_big_only:
-            parser.save_parsed_data(filter=True, idx="LEAID", idx_list=ca_big_dist)
-        elif args.tuda_only:
-            parser.save_parsed_data(filter=True, idx="LEAID", idx_list=tuda_dist)
-        elif args.sjzips:
-            parser.save_parsed_data(filter=True, idx="ZIP", idx_list=sjzips)
-        elif args.match_idx:
-            parser.save_parsed_data(filter=True, idx=args.match_idx, idx_list=args.match_val)
+
+        # Every subset comes out of one parse, a lone filter is pushed down into it
+        school_filter = None
+        if len(subsets) == 1:
+            school_filter = subsets[0][1]
+        if args.jobs > 1:
+            schools = parser.parse(forced_orig=True, jobs=args.jobs, school_filter=school_filter)
         else:
-            parser.save_parsed_data()
+            schools = parser.iter_schools(forced_orig=True, school_filter=school_filter)
+        parser.save_subsets(subsets, schools)
 
 # -------------------------------------
 # Drop the script name from the args
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""
+Spread independent per-year work over a pool of worker processes.
+
+Each year of NCES data can be loaded and crunched on its own, only the
+report writing at the end needs all of them.  map_years() hands one work
+unit per year to a multiprocessing pool and gives the results back in the
+same order as the work units, so the report scripts can keep writing years
+out in order as they arrive.
+"""
+import multiprocessing
+
+# ==============================================================================
+# Functions
+# ==============================================================================
+def add_jobs_argument(parser):
+    """
+    Add the common --jobs option to a report's argument parser
+    """
+    parser.add_argument('--jobs', action='store', dest='jobs', required=False, type=int, default=1,
+            help='Number of years to process in parallel (worker processes)')
+
+# -------------------------------------
+def map_years(func, work_units, jobs=1):
+    """
+    Generator, yields func(unit) for each work unit in order.
+
+    func and the work units have to be picklable (module level functions,
+    plain data) when jobs > 1.  With jobs == 1 everything runs in this process.
+    """
+    work_units = list(work_units)
+    if jobs <= 1 or len(work_units) <= 1:
+        for unit in work_units:
+            yield func(unit)
+        return
+
+    pool = multiprocessing.Pool(processes=min(jobs, len(work_units)))
+    try:
+        for result in pool.imap(func, work_units):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
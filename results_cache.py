@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Disk backed memo of the per-year segregation calculations.
+
+The reports spend nearly all of their time in SegCalc, but the results
+only depend on the data set and the calculation parameters, not on the
+report layout.  Each year's results are pickled under a key built from
+the data set's cache key and every parameter that feeds the calculation:
+
+    results = ResultsCache()
+    parts = dict(report='segrete', data=panel.get_key(), year=year, idx=idx)
+    datasets = results.memo(parts, calc, year)
+
+so re-running a report with a different --outfile or --max_record only
+costs the spreadsheet write.  The least recently used results are
+dropped once the directory grows past max_bytes.
+"""
+import os
+import json
+import shutil
+import cPickle
+import hashlib
+import tempfile
+import unittest
+
+# ==============================================================================
+# Constants
+# ==============================================================================
+# Bump if the shape of any memoized results changes
+RESULTS_VERSION = 1
+
+results_dirname = "results_cache"
+
+# Default size limit for the saved results
+MAX_BYTES = 256 * 1024 * 1024
+
+# ==============================================================================
+# Utility Functions
+# ==============================================================================
+def add_results_argument(parser):
+    """
+    Add the common --recalc option to a report's argument parser
+    """
+    parser.add_argument('--recalc', action='store_true', dest='recalc', required=False,
+            help='Ignore any previously saved results and recalculate them')
+
+# ==============================================================================
+# Results Cache Class
+# ==============================================================================
+class ResultsCache(object):
+    """
+    Pickled results in one directory, one file per key
+    """
+    def __init__(self, dirname=None, max_bytes=MAX_BYTES, refresh=False):
+        if dirname is None:
+            this_dir, this_filename = os.path.split(__file__)
+            dirname = os.path.join(this_dir, 'data', results_dirname)
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+
+    # --------------------------------------
+    def make_key(self, parts):
+        """
+        Hash of everything the results depend on, parts is a dict of
+        plain (JSON-able) data
+        """
+        source = dict(parts, version=RESULTS_VERSION)
+        return hashlib.sha1(json.dumps(source, sort_keys=True)).hexdigest()
+
+    # --------------------------------------
+    def get_filename(self, key):
+        return os.path.join(self.dirname, key + ".pkl")
+
+    # --------------------------------------
+    def get(self, key):
+        """
+        The saved results for key, or None.  A hit counts as a use for
+        the eviction order.
+        """
+        fname = self.get_filename(key)
+        try:
+            with open(fname, 'rb') as f:
+                value = cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return None
+        try:
+            os.utime(fname, None)
+        except OSError:
+            pass
+        return value
+
+    # --------------------------------------
+    def put(self, key, value):
+        """
+        Save results, the file only shows up once it's completely written
+        so other processes never see a partial pickle.
+        """
+        if not os.path.isdir(self.dirname):
+            try:
+                os.makedirs(self.dirname)
+            except OSError:
+                # Another worker got there first
+                if not os.path.isdir(self.dirname):
+                    raise
+        fd, tmpname = tempfile.mkstemp(dir=self.dirname, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            cPickle.dump(value, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, self.get_filename(key))
+        self.evict()
+
+    # --------------------------------------
+    def evict(self):
+        """
+        Drop the least recently used results until we're under max_bytes
+        """
+        entries = []
+        total = 0
+        for fname in os.listdir(self.dirname):
+            if not fname.endswith(".pkl"):
+                continue
+            path = os.path.join(self.dirname, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Already evicted by another worker
+                pass
+            total -= size
+
+    # --------------------------------------
+    def memo(self, parts, func, *args):
+        """
+        func(*args), from disk if these parts have been calculated before
+        """
+        key = self.make_key(parts)
+        if not self.refresh:
+            value = self.get(key)
+            if value is not None:
+                print "Loading Previously Saved Results"
+                return value
+        value = func(*args)
+        self.put(key, value)
+        return value
+
+# *****************************************************************************
+# Unit Tests
+# *****************************************************************************
+class TestResultsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def calc(self, value):
+        self.calls.append(value)
+        return [value] * 100
+
+    def test_memo(self):
+        results = ResultsCache(self.dirname)
+        parts = dict(year=1987, idx={'MINORITY': 'BLACK'})
+        self.assertEqual(results.memo(parts, self.calc, 1), [1] * 100)
+        self.assertEqual(results.memo(parts, self.calc, 1), [1] * 100)
+        self.assertEqual(self.calls, [1])
+        # Any change to the parts is a new calculation
+        results.memo(dict(parts, year=1988), self.calc, 2)
+        self.assertEqual(self.calls, [1, 2])
+        # As is asking for a refresh
+        ResultsCache(self.dirname, refresh=True).memo(parts, self.calc, 3)
+        self.assertEqual(self.calls, [1, 2, 3])
+
+    def test_evict_lru(self):
+        results = ResultsCache(self.dirname)
+        keys = [results.make_key(dict(year=year)) for year in range(3)]
+        for i, key in enumerate(keys):
+            results.put(key, self.calc(i))
+            os.utime(results.get_filename(key), (i, i))
+        size = os.path.getsize(results.get_filename(keys[0]))
+
+        # Using the oldest makes the middle one the least recently used
+        self.assertEqual(results.get(keys[0]), [0] * 100)
+        results.max_bytes = 2 * size
+        results.evict()
+        self.assertEqual(results.get(keys[1]), None)
+        self.assertEqual(results.get(keys[0]), [0] * 100)
+        self.assertEqual(results.get(keys[2]), [2] * 100)
@@ -11,6 +11,11 @@ import argparse
 
 from segcalc import SegCalc
 from nces_parser import NCESParser
+from nces_panel import NCESPanel
+from parallel import add_jobs_argument
+from parallel import map_years
+from results_cache import ResultsCache
+from results_cache import add_results_argument
 
 from fips import fips_to_st
 
@@ -35,6 +40,32 @@ def write_ws(worksheets, category, row, col, data):
 
     worksheets[category].write(row, col, val)
 
+# -------------------------------------
+def calc_year(work):
+    """
+    Calculate every group for a year, or fetch them from the saved
+    results, the unit of work handed to each process with --jobs.
+
+    Returns (year, group_results)
+    """
+    year, panel, idx, grade, groups, results = work
+    parts = dict(report='seg_by_category', data=panel.get_key(), year=year, idx=idx,
+            grade=grade, groups=groups)
+    return (year, results.memo(parts, calc_groups, year, panel, idx, grade, groups))
+
+# -------------------------------------
+def calc_groups(year, panel, idx, grade, groups):
+    """
+    Load a year of data and calculate every group
+    """
+    print "Loading NCES Data from:  %d" % year
+    schools = panel.load_year(year)
+    segcalc = SegCalc(schools, idx, grade=grade)
+    print "Finished Loading NCES Data from:  %d" % year
+
+    print "Performing Calculations on Data from:  %d" % year
+    return segcalc.calc_groups(groups)
+
 # -------------------------------------
 # Parse the command line options
 # -------------------------------------
@@ -58,6 +89,10 @@ def main(argv):
             help='Override the default list of years to report on')
     parser.add_argument('--grade', action='store', dest='grade', required=False, type=int,
             help='Select a specific grade that the school must have')
+    parser.add_argument('--subset', action='store', dest='subset', required=False,
+            help='Read a subset cached by nces_parser.py --outputs (e.g. urban, city_san_jose)')
+    add_jobs_argument(parser)
+    add_results_argument(parser)
     parser.add_argument('-debug', action='store_true', dest='debug', required=False,
             help='Debug Mode')
     args = parser.parse_args()
@@ -94,8 +129,9 @@ def main(argv):
     else:
         category = 'LEAID'
 
-    # Search through the data for the list of districts to report on
-    nces = NCESParser(year=2010)
+    # Search through the data for the list of districts to report on,
+    # from the same subset the panel is built from
+    nces = NCESParser(year=2010, subset=args.subset)
     schools = nces.parse(make_dict=True)
     categories = {}
     for school in schools:
@@ -199,39 +235,40 @@ def main(argv):
     # --------------------------------------
     # Now fill in the static data data
     # --------------------------------------
-    for i, year in enumerate(year_range):
+    # The years are spread over --jobs processes and come back in order
+    # Every year comes out of one multi-year panel
+    panel = NCESPanel(year_range, args.subset)
+    panel.load_cache()
+    groups = zip(minorities, sec_minorities, majorities)
+    results = ResultsCache(refresh=args.recalc)
+    work = [(year, panel, idx, grade, groups, results) for year in year_range]
+    for i, (year, group_results) in enumerate(map_years(calc_year, work, args.jobs)):
         # Reset the column offset as we move to a new row
         col_offset = base_col_offset
 
-        print "Loading NCES Data from:  %d" % year
-        nces = NCESParser(year=year)
-        schools = nces.parse(make_dict=True)
-        segcalc = SegCalc(schools, idx, grade=grade)
-        print "Finished Loading NCES Data from:  %d" % year
+        # Student counts and school choice are the same for every group
+        results = group_results[0]
 
         print "Calculating Total Student Count"
-        tot_idx = segcalc.calc_totals()
+        tot_idx = results['tot_idx']
         for category in categories.keys():
             write_ws(worksheets, category, row_offset, col_offset, tot_idx)
         col_offset += 1
 
         print "Calculating Proportion of Students in a Magnet"
-        mag_idx = segcalc.calc_dependant_totals(sum_idx='MEMBER', dep_idx='MAGNET')
-        pmag_idx = segcalc.calc_prop(mag_idx, tot_idx)
+        pmag_idx = results['pmag_idx']
         for category in categories.keys():
             write_ws(worksheets, category, row_offset, col_offset, pmag_idx)
         col_offset += 1
 
         print "Calculating Proportion of Students in a Charter"
-        chr_idx = segcalc.calc_dependant_totals(sum_idx='MEMBER', dep_idx='CHARTR')
-        pchr_idx = segcalc.calc_prop(chr_idx, tot_idx)
+        pchr_idx = results['pchr_idx']
         for category in categories.keys():
             write_ws(worksheets, category, row_offset, col_offset, pchr_idx)
         col_offset += 1
 
         print "Calculating Proportion of Students in a Magnet or Charter"
-        chc_idx = segcalc.calc_dependant_totals(sum_idx='MEMBER', dep_idx='CHARTR', sec_dep_idx='MAGNET')
-        pchc_idx = segcalc.calc_prop(chc_idx, tot_idx)
+        pchc_idx = results['pchc_idx']
         for category in categories.keys():
             write_ws(worksheets, category, row_offset, col_offset, pchc_idx)
         col_offset += 1
@@ -240,43 +277,39 @@ def main(argv):
         # Now for each minority group - fill in the data
         # --------------------------------------
         for i, group in enumerate(minorities):
-            idx['MINORITY'] = minorities[i]
-            idx['SEC_MINORITY'] = sec_minorities[i]
-            idx['MAJORITY'] = majorities[i]
             print "*" * 80
-            print "Running all calculations with the following parameters"
+            print "Filling in results for the following parameters"
             print "*" * 80
-            print idx
+            print "Minority: %s, Secondary Minority: %s, Majority: %s" % (minorities[i], sec_minorities[i], majorities[i])
             print "*" * 80
-            segcalc = SegCalc(schools, idx, grade=grade)
+            results = group_results[i]
 
-            print "Performing Calculations on Data from:  %d" % year
             print "Calculating Total Minority Students"
-            min_idx = segcalc.calc_totals('MINORITY')
+            min_idx = results['min_idx']
             for category in categories.keys():
                 write_ws(worksheets, category, row_offset, col_offset, min_idx)
             col_offset += 1
 
             print "Calculating Proportion of Students in the Minority"
-            mper_idx = segcalc.calc_proportion(idx='MINORITY')
+            mper_idx = results['mper_idx']
             for category in categories.keys():
                 write_ws(worksheets, category, row_offset, col_offset, mper_idx)
             col_offset += 1
 
             print "Calculating Dissimilarity Index"
-            dis_idx = segcalc.calc_dis_idx()
+            dis_idx = results['dis_idx']
             for category in categories.keys():
                 write_ws(worksheets, category, row_offset, col_offset, dis_idx)
             col_offset += 1
 
             print "Calculating Exposure Index"
-            exp_idx = segcalc.calc_exp_idx()
+            exp_idx = results['exp_idx']
             for category in categories.keys():
                 write_ws(worksheets, category, row_offset, col_offset, exp_idx)
             col_offset += 1
 
             print "Calculating Isolation Index"
-            iso_idx = segcalc.calc_iso_idx()
+            iso_idx = results['iso_idx']
             for category in categories.keys():
                 write_ws(worksheets, category, row_offset, col_offset, iso_idx)
             col_offset += 1
@@ -13,6 +13,11 @@ import operator
 
 from segcalc import SegCalc
 from nces_parser import NCESParser
+from nces_panel import NCESPanel
+from parallel import add_jobs_argument
+from parallel import map_years
+from results_cache import ResultsCache
+from results_cache import add_results_argument
 
 from xlwt import Workbook
 from xlwt import Formula
@@ -35,6 +40,31 @@ def write_ws(worksheets, year, data, leaid, row, col):
 
     worksheets[year].write(row, col, val)
 
+# -------------------------------------
+def calc_year(work):
+    """
+    Calculate every group for a year, or fetch them from the saved
+    results, the unit of work handed to each process with --jobs.
+
+    Returns (year, group_results)
+    """
+    year, panel, idx, groups, results = work
+    parts = dict(report='seg_by_year', data=panel.get_key(), year=year, idx=idx, groups=groups)
+    return (year, results.memo(parts, calc_groups, year, panel, idx, groups))
+
+# -------------------------------------
+def calc_groups(year, panel, idx, groups):
+    """
+    Load a year of data and calculate every group
+    """
+    print "Loading NCES Data from:  %d" % year
+    schools = panel.load_year(year)
+    segcalc = SegCalc(schools, idx)
+    print "Finished Loading NCES Data from:  %d" % year
+
+    print "Performing Calculations on Data from:  %d" % year
+    return segcalc.calc_groups(groups)
+
 # -------------------------------------
 # Parse the command line options
 # -------------------------------------
@@ -54,6 +84,8 @@ def main(argv):
             help='Only use data points that match some criterion')
     parser.add_argument('--match_val', action='store', dest='match_val', required=False,
             help='Value to match when using --match_idx')
+    add_jobs_argument(parser)
+    add_results_argument(parser)
     parser.add_argument('-debug', action='store_true', dest='debug', required=False,
             help='Debug Mode')
     args = parser.parse_args()
@@ -113,8 +145,6 @@ def main(argv):
 
     # Create ordered lists that we can iterate over
     # consistently, sorted by the size of the district
-    nces = NCESParser(year=2010)
-    schools = nces.parse(make_dict=True)
     segcalc = SegCalc(schools, calc_idx)
     tot_idx = segcalc.calc_totals()
     dist_by_size = sorted(tot_idx.iteritems(), key=operator.itemgetter(1), reverse=True)
@@ -196,19 +226,23 @@ def main(argv):
     # --------------------------------------
     # Now fill in the static data data
     # --------------------------------------
-    for i, year in enumerate(year_range):
+    # The years are spread over --jobs processes and come back in order
+    # Every year comes out of one multi-year panel
+    panel = NCESPanel(year_range)
+    panel.load_cache()
+    groups = zip(minorities, sec_minorities, majorities)
+    results = ResultsCache(refresh=args.recalc)
+    work = [(year, panel, calc_idx, groups, results) for year in year_range]
+    for i, (year, group_results) in enumerate(map_years(calc_year, work, args.jobs)):
         # Reset the column offset as we move to a new row
         col_offset = base_col_offset
         row_offset = base_row_offset
 
-        print "Loading NCES Data from:  %d" % year
-        nces = NCESParser(year=year)
-        schools = nces.parse(make_dict=True)
-        segcalc = SegCalc(schools, calc_idx)
-        print "Finished Loading NCES Data from:  %d" % year
+        # Student counts and school choice are the same for every group
+        results = group_results[0]
 
         print "Calculating Total Student Count"
-        tot_idx = segcalc.calc_totals()
+        tot_idx = results['tot_idx']
         for leaid in dist_leaids:
             write_ws(worksheets, year, tot_idx, leaid, row_offset, col_offset)
             row_offset += 1
@@ -216,8 +250,7 @@ def main(argv):
         col_offset += 1
 
         print "Calculating Proportion of Students in a Magnet"
-        mag_idx = segcalc.calc_dependant_totals(sum_idx='MEMBER', dep_idx='MAGNET')
-        pmag_idx = segcalc.calc_prop(mag_idx, tot_idx)
+        pmag_idx = results['pmag_idx']
         for leaid in dist_leaids:
             write_ws(worksheets, year, pmag_idx, leaid, row_offset, col_offset)
             row_offset += 1
@@ -225,8 +258,7 @@ def main(argv):
         col_offset += 1
 
         print "Calculating Proportion of Students in a Charter"
-        chr_idx = segcalc.calc_dependant_totals(sum_idx='MEMBER', dep_idx='CHARTR')
-        pchr_idx = segcalc.calc_prop(chr_idx, tot_idx)
+        pchr_idx = results['pchr_idx']
         for leaid in dist_leaids:
             write_ws(worksheets, year, pchr_idx, leaid, row_offset, col_offset)
             row_offset += 1
@@ -234,8 +266,7 @@ def main(argv):
         col_offset += 1
 
         print "Calculating Proportion of Students in a Magnet or Charter"
-        chc_idx = segcalc.calc_dependant_totals(sum_idx='MEMBER', dep_idx='CHARTR', sec_dep_idx='MAGNET')
-        pchc_idx = segcalc.calc_prop(chc_idx, tot_idx)
+        pchc_idx = results['pchc_idx']
         for leaid in dist_leaids:
             write_ws(worksheets, year, pchc_idx, leaid, row_offset, col_offset)
             row_offset += 1
@@ -246,19 +277,15 @@ def main(argv):
         # Now for each minority group - fill in the data
         # --------------------------------------
         for i, group in enumerate(minorities):
-            calc_idx['MINORITY'] = minorities[i]
-            calc_idx['SEC_MINORITY'] = sec_minorities[i]
-            calc_idx['MAJORITY'] = majorities[i]
             print "*" * 80
-            print "Running all calculations with the following parameters"
+            print "Filling in results for the following parameters"
             print "*" * 80
-            print calc_idx
+            print "Minority: %s, Secondary Minority: %s, Majority: %s" % (minorities[i], sec_minorities[i], majorities[i])
             print "*" * 80
-            segcalc = SegCalc(schools, calc_idx)
+            results = group_results[i]
 
-            print "Performing Calculations on Data from:  %d" % year
             print "Calculating Total Minority Students"
-            min_idx = segcalc.calc_totals('MINORITY')
+            min_idx = results['min_idx']
             for leaid in dist_leaids:
                 write_ws(worksheets, year, min_idx, leaid, row_offset, col_offset)
                 row_offset += 1
@@ -266,7 +293,7 @@ def main(argv):
             col_offset += 1
 
             print "Calculating Proportion of Students in the Minority"
-            mper_idx = segcalc.calc_proportion('MINORITY')
+            mper_idx = results['mper_idx']
             for leaid in dist_leaids:
                 write_ws(worksheets, year, mper_idx, leaid, row_offset, col_offset)
                 row_offset += 1
@@ -274,7 +301,7 @@ def main(argv):
             col_offset += 1
 
             print "Calculating Dissimilarity Index"
-            dis_idx = segcalc.calc_dis_idx()
+            dis_idx = results['dis_idx']
             for leaid in dist_leaids:
                 write_ws(worksheets, year, dis_idx, leaid, row_offset, col_offset)
                 row_offset += 1
@@ -282,7 +309,7 @@ def main(argv):
             col_offset += 1
 
             print "Calculating Exposure Index"
-            exp_idx = segcalc.calc_exp_idx()
+            exp_idx = results['exp_idx']
             for leaid in dist_leaids:
                 write_ws(worksheets, year, exp_idx, leaid, row_offset, col_offset)
                 row_offset += 1
@@ -290,7 +317,7 @@ def main(argv):
             col_offset += 1
 
             print "Calculating Isolation Index"
-            iso_idx = segcalc.calc_iso_idx()
+            iso_idx = results['iso_idx']
             for leaid in dist_leaids:
                 write_ws(worksheets, year, iso_idx, leaid, row_offset, col_offset)
                 row_offset += 1
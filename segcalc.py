@@ -7,17 +7,42 @@ that we can index for one of several parameters to get the required
 data.
 """
 import sys
-import operator
+import copy
+import unittest
 
 from nces_parser import NCESParser
+from nces_parser import parse_grade
+from nces_parser import school_level
+from nces_parser import school_flags
+from nces_parser import FLAG_CHARTER
+from nces_parser import FLAG_MAGNET
+from nces_parser import YES_NO_FLAGS
 
 # ==============================================================================
 # Constants
 # ==============================================================================
+# Quick test data set, normally this module isn't run at the command line
+SAMPLE_SCHOOLS = [
+    {'BLACK': 5, 'WHITE': 20, 'MEMBER': 25, 'FIPS': 01, 'LEAID': 011},
+    {'BLACK': 20, 'WHITE': 5, 'MEMBER': 25, 'FIPS': 01, 'LEAID': 011},
+    {'BLACK': 5, 'WHITE': 20, 'MEMBER': 25, 'FIPS': 02, 'LEAID': 011},
+    {'BLACK': 5, 'WHITE': 20, 'MEMBER': 25, 'FIPS': 02, 'LEAID': 011},
+]
 
 # ==============================================================================
 # Utility Functions
 # ==============================================================================
+# --------------------------------------
+def gini_pairwise_sum(points):
+    """
+    Reference O(n^2) form of the Gini numerator, Sum(i)Sum(j) (ti*tj*|pi - pj|)
+    for a list of (pi, ti).  Only used to check/benchmark calc_gini_coef.
+    """
+    total = 0.0
+    for pi, ti in points:
+        for pj, tj in points:
+            total += ti*tj*abs(pi - pj)
+    return total
 
 # ==============================================================================
 class SegCalc(object):
@@ -149,6 +174,48 @@ class SegCalc(object):
             print "Schools Found: %d" % (len(self._filtered_schools))
             return self._filtered_schools
 
+    # ======================================
+    @property
+    def category_index(self):
+        """
+        The filtered schools regrouped so that each category is one
+        contiguous run, plus a list of (category, start, end) rows for
+        each category in the order they first show up.  The schools
+        in a category keep their original order.  Built once and shared
+        by every calculation so each school's category is only
+        looked up once.
+        """
+        try:
+            return self._category_index
+        except AttributeError:
+            by_cat = {}
+            cats = []
+            for school in self.filtered_schools:
+                cat = school[self.cat_idx]
+                try:
+                    by_cat[cat].append(school)
+                except KeyError:
+                    by_cat[cat] = [school]
+                    cats.append(cat)
+
+            grouped = []
+            ranges = []
+            for cat in cats:
+                start = len(grouped)
+                grouped.extend(by_cat[cat])
+                ranges.append((cat, start, len(grouped)))
+            self._category_index = (grouped, ranges)
+            return self._category_index
+
+    # ======================================
+    def iter_categories(self):
+        """
+        Yield (category, list of schools in the category)
+        """
+        grouped, ranges = self.category_index
+        for cat, start, end in ranges:
+            yield cat, grouped[start:end]
+
     # ======================================
     def get_idxed_val(self, idx_x, idx_y):
         """
@@ -168,32 +235,33 @@ class SegCalc(object):
     # ======================================
     def get_grade(self, school, high=True):
         """
-        Get the high or low grade
+        Get the high or low grade, from the numeric GRADE_HI/GRADE_LO
+        columns the parser adds (-1 if unknown) or the raw grade codes
         """
         if high:
-            grade_idx = 'GSHI'
+            num_idx, grade_idx = 'GRADE_HI', 'GSHI'
         else:
-            grade_idx = 'GSLO'
+            num_idx, grade_idx = 'GRADE_LO', 'GSLO'
 
         try:
-            grade = int(school[grade_idx])
+            return int(school[num_idx])
+        except KeyError:
+            pass
+        try:
+            return parse_grade(school[grade_idx])
         except KeyError:
             raise Exception("Problem School:",school.__repr__())
-        except ValueError:
-            if (
-                school[grade_idx] == 'PK' or
-                school[grade_idx] == 'KG'
-                ):
-                grade = 1
-            elif (
-                school[grade_idx] == 'UG' or
-                school[grade_idx] == 'N' or
-                school[grade_idx][0] == '.'
-                ):
-                grade = 0
-            else:
-                raise Exception("Unknown Grade: %s" % (school[grade_idx]))
-        return grade
+
+    # ======================================
+    def get_level(self, school):
+        """
+        School level code (nces_parser.SCHLEVEL_*), precomputed by the
+        parser in the SCHLEVEL column
+        """
+        try:
+            return int(school['SCHLEVEL'])
+        except KeyError:
+            return school_level(self.get_grade(school, high=False), self.get_grade(school, high=True))
 
     # ======================================
     def is_elementary(self, school):
@@ -327,23 +395,28 @@ class SegCalc(object):
         Get a report on the total student count and so forth
         """
         Total = {}
-        for school in self.filtered_schools:
-            if idx == 'MINORITY':
-                ti = self.get_minority(school)
-            elif idx == 'MAJORITY':
-                ti = self.get_majority(school)
-            elif not idx:  # Default to Totals Student Count
-                ti = self.get_members(school)
-            else:
-                ti = school[idx]
+        for cat, schools in self.iter_categories():
+            total = None
+            for school in schools:
+                if idx == 'MINORITY':
+                    ti = self.get_minority(school)
+                elif idx == 'MAJORITY':
+                    ti = self.get_majority(school)
+                elif not idx:  # Default to Totals Student Count
+                    ti = self.get_members(school)
+                else:
+                    ti = school[idx]
 
-            # Make sure the datastructure exists
-            # Negative numbers mean missing data.
-            if ti >= 0:
-                try:
-                    Total[school[self.cat_idx]] += ti
-                except KeyError:
-                    Total[school[self.cat_idx]] = ti
+                # Negative numbers mean missing data.
+                if ti >= 0:
+                    if total is None:
+                        total = ti
+                    else:
+                        total += ti
+
+            # Only categories with some valid data get an entry
+            if total is not None:
+                Total[cat] = total
         return Total
 
     # ======================================
@@ -351,34 +424,25 @@ class SegCalc(object):
         """
         Get a report on the total student count and so forth
         """
-        Total = {}
-        for school in self.filtered_schools:
-            try:
-                test = Total[school[self.cat_idx]]
-            except KeyError:
-                Total[school[self.cat_idx]] = 0
-
-            try:
-                dependant_field = school[dep_idx]
-            except KeyError:
-                dependant_field = 0
-            try:
-                sec_dependant_field = school[sec_dep_idx]
-            except KeyError:
-                sec_dependant_field = 0
+        # The Yes/No columns are bits in the FLAGS column
+        any_of = self.get_flag_mask(dep_idx, sec_dep_idx)
 
-            if (dependant_field == '1' or
-                dependant_field == 1 or
-                dependant_field == 'Y' or
-                sec_dependant_field == '1' or
-                sec_dependant_field == 1 or
-                sec_dependant_field == 'Y'):
-                ti = school[sum_idx]
-
-                # Make sure the datastructure exists
-                # Negative numbers mean missing data.
-                if ti >= 0:
-                    Total[school[self.cat_idx]] += ti
+        Total = {}
+        for cat, schools in self.iter_categories():
+            total = 0
+            for school in schools:
+                if any_of is not None:
+                    dependant = self.get_flags(school) & any_of
+                else:
+                    dependant = self.is_flagged(school, dep_idx) or self.is_flagged(school, sec_dep_idx)
+
+                if dependant:
+                    ti = school[sum_idx]
+
+                    # Negative numbers mean missing data.
+                    if ti >= 0:
+                        total += ti
+            Total[cat] = total
         return Total
 
     # ======================================
@@ -405,29 +469,26 @@ class SegCalc(object):
         Get a report on the total student count and so forth
         """
         Percentages = {}
-        for school in self.filtered_schools:
-            try:
-                perc = dict(
-                    WHITE=school['WHITE'],
-                    BLACK=school['BLACK'],
-                    HISP=school['HISP'],
-                    ASIAN=school['ASIAN'],
-                    AM=school['AM'],
-                    MEMBER=school['MEMBER']
-                )
-            except KeyError:
-                raise Exception("Problem School:",school.__repr__())
-
-            # Make sure the datastructure exists
-            try:
-                test = Percentages[school[self.cat_idx]]
-            except KeyError:
-                Percentages[school[self.cat_idx]] = dict(WHITE=0, BLACK=0, HISP=0, ASIAN=0, AM=0, MEMBER=0)
+        for cat, schools in self.iter_categories():
+            totals = dict(WHITE=0, BLACK=0, HISP=0, ASIAN=0, AM=0, MEMBER=0)
+            for school in schools:
+                try:
+                    perc = dict(
+                        WHITE=school['WHITE'],
+                        BLACK=school['BLACK'],
+                        HISP=school['HISP'],
+                        ASIAN=school['ASIAN'],
+                        AM=school['AM'],
+                        MEMBER=school['MEMBER']
+                    )
+                except KeyError:
+                    raise Exception("Problem School:",school.__repr__())
 
-            # Negative numbers mean missing data.
-            for ethn in perc.keys():
-                if perc[ethn] >= 0:
-                    Percentages[school[self.cat_idx]][ethn] += perc[ethn]
+                # Negative numbers mean missing data.
+                for ethn in perc.keys():
+                    if perc[ethn] >= 0:
+                        totals[ethn] += perc[ethn]
+            Percentages[cat] = totals
 
         for cat_idx in Percentages.keys():
             try:
@@ -456,43 +517,35 @@ class SegCalc(object):
         """
         Y = {}
         Sum = {}
-        for school in self.filtered_schools:
-            try:
-                yi = school[self.minority_idx]
-                ti = school[self.total_idx]
-            except KeyError:
-                raise Exception("Problem School:",school.__repr__())
-
-            # Make sure the datastructure exists
-            try:
-                test = Sum[school[self.cat_idx]]
-            except KeyError:
-                Sum[school[self.cat_idx]] = 0.0
-
-            # Now sum up all the members of Group Y to divided
-            # out of the final sum
-            try:
-                test = Y[school[self.cat_idx]]
-            except KeyError:
-                Y[school[self.cat_idx]] = 0.0
-
-            # Negative numbers are used to represent missing data, don't
-            # include these in the calculations
-            if yi < 0 or ti <= 0:
-                continue
+        for cat, schools in self.iter_categories():
+            y_sum = 0.0
+            t_sum = 0.0
+            for school in schools:
+                try:
+                    yi = school[self.minority_idx]
+                    ti = school[self.total_idx]
+                except KeyError:
+                    raise Exception("Problem School:",school.__repr__())
 
-            # Compute the term to be summed up
-            # Test for divide by zero and ignore the data point if it happens
-            try:
-                per = float(yi)/ti
-            except ZeroDivisionError:
-                continue
+                # Negative numbers are used to represent missing data, don't
+                # include these in the calculations
+                if yi < 0 or ti <= 0:
+                    continue
 
-            # Add to the Group Tally if 90% limit is exceeded
-            if per > 0.9:
-                Y[school[self.cat_idx]] += yi
-            # Always add to the Category total
-            Sum[school[self.cat_idx]] += ti
+                # Compute the term to be summed up
+                # Test for divide by zero and ignore the data point if it happens
+                try:
+                    per = float(yi)/ti
+                except ZeroDivisionError:
+                    continue
+
+                # Add to the Group Tally if 90% limit is exceeded
+                if per > 0.9:
+                    y_sum += yi
+                # Always add to the Category total
+                t_sum += ti
+            Y[cat] = y_sum
+            Sum[cat] = t_sum
 
         # Convert to a percentage
         for cat in Y.keys():
@@ -528,48 +581,34 @@ class SegCalc(object):
         """
         Y = {}
         Sum = {}
-        for school in self.filtered_schools:
-            yi = get_min(school)
-            zi = get_maj(school)
-            ti = self.get_members(school)
-
-            # Make sure the datastructure exists
-            try:
-                test = Sum[school[self.cat_idx]]
-            except KeyError:
-                Sum[school[self.cat_idx]] = 0.0
-
-            # Now sum up all the members of Group Y to divided
-            # out of the final sum
-            try:
-                test = Y[school[self.cat_idx]]
-            except KeyError:
-                Y[school[self.cat_idx]] = 0.0
+        for cat, schools in self.iter_categories():
+            cat_sum = 0.0
+            y_sum = 0.0
+            for school in schools:
+                yi = get_min(school)
+                zi = get_maj(school)
+                ti = self.get_members(school)
 
-            # Negative numbers are used to represent missing data, don't
-            # include these in the calculations
-            if yi < 0 or zi < 0 or ti < 0:
-                continue
+                # Negative numbers are used to represent missing data, don't
+                # include these in the calculations
+                if yi < 0 or zi < 0 or ti < 0:
+                    continue
 
-            # Compute the term to be summed up
-            # Test for divide by zero and ignore the data point if it happens
-            try:
-                sum = float(yi*zi)/ti
-            except ZeroDivisionError:
-                continue
+                # Compute the term to be summed up
+                # Test for divide by zero and ignore the data point if it happens
+                try:
+                    sum = float(yi*zi)/ti
+                except ZeroDivisionError:
+                    continue
 
-            # No divided by zero, so add to the sum
-            try:
-                Sum[school[self.cat_idx]] += sum
-            except KeyError:
-                Sum[school[self.cat_idx]] = sum
+                # No divided by zero, so add to the sum
+                cat_sum += sum
 
-            # Now sum up all the members of Group Y to divided
-            # out of the final sum
-            try:
-                Y[school[self.cat_idx]] += yi
-            except KeyError:
-                Y[school[self.cat_idx]] = yi
+                # Now sum up all the members of Group Y to divided
+                # out of the final sum
+                y_sum += yi
+            Sum[cat] = cat_sum
+            Y[cat] = y_sum
 
         # import pprint
         # pprint.pprint(Sum)
@@ -610,30 +649,28 @@ class SegCalc(object):
         T = {}
         Py = {}
         Pz = {}
-        for school in self.filtered_schools:
-            ti = self.get_members(school)
-            giy = self.get_minority(school)
-            giz = self.get_majority(school)
-
+        for cat, schools in self.iter_categories():
             # Make sure to create an entry for
-            # every school, even if the data is bogus
-            try:
-                test = T[school[self.cat_idx]]
-                test = Py[school[self.cat_idx]]
-                test = Pz[school[self.cat_idx]]
-            except KeyError:
-                T[school[self.cat_idx]] = 0.0
-                Py[school[self.cat_idx]] = 0.0
-                Pz[school[self.cat_idx]] = 0.0
+            # every category, even if the data is bogus
+            t_sum = 0.0
+            y_sum = 0.0
+            z_sum = 0.0
+            for school in schools:
+                ti = self.get_members(school)
+                giy = self.get_minority(school)
+                giz = self.get_majority(school)
 
-            # Negative numbers are used to represent missing data, don't
-            # include these in the calculations
-            if giy < 0 or giz < 0 or ti < 0:
-                continue
+                # Negative numbers are used to represent missing data, don't
+                # include these in the calculations
+                if giy < 0 or giz < 0 or ti < 0:
+                    continue
 
-            T[school[self.cat_idx]] += ti
-            Py[school[self.cat_idx]] += giy
-            Pz[school[self.cat_idx]] += giz
+                t_sum += ti
+                y_sum += giy
+                z_sum += giz
+            T[cat] = t_sum
+            Py[cat] = y_sum
+            Pz[cat] = z_sum
 
         for cat in T.keys():
             try:
@@ -689,26 +726,24 @@ class SegCalc(object):
 
         # Now we have Py/Pz, we can calculate the numerator
         Num = {}
-        for school in self.filtered_schools:
-            ti = self.get_members(school)
-            giy = self.get_minority(school)
-            giz = self.get_majority(school)
-
-            # Make sure the datastructure exists
-            try:
-                test = Num[school[self.cat_idx]]
-            except KeyError:
-                Num[school[self.cat_idx]] = 0.0
+        for cat, schools in self.iter_categories():
+            py = Py[cat]
+            num = 0.0
+            for school in schools:
+                ti = self.get_members(school)
+                giy = self.get_minority(school)
+                giz = self.get_majority(school)
 
-            # Negative numbers are used to represent missing data, don't
-            # include these in the calculations
-            if giy < 0 or giz < 0 or ti < 0:
-                continue
+                # Negative numbers are used to represent missing data, don't
+                # include these in the calculations
+                if giy < 0 or giz < 0 or ti < 0:
+                    continue
 
-            # Add the terms for both groups here
-            # Currently we are limited to the dissimilarily between
-            # two groups.
-            Num[school[self.cat_idx]] += abs(giy - Py[school[self.cat_idx]] * ti)
+                # Add the terms for both groups here
+                # Currently we are limited to the dissimilarily between
+                # two groups.
+                num += abs(giy - py * ti)
+            Num[cat] = num
 
         if self.debug:
             print "=" * 80
@@ -739,6 +774,228 @@ class SegCalc(object):
 
         return Sum
 
+    # ======================================
+    def get_flags(self, school):
+        """
+        FLAG_* bitmap for a school, precomputed by the parser
+        in the FLAGS column
+        """
+        try:
+            return int(school['FLAGS'])
+        except KeyError:
+            return school_flags(school)
+
+    # ======================================
+    def get_flag_mask(self, *idxes):
+        """
+        FLAG_* bits for some Yes/No columns (None entries are skipped),
+        None if any of them isn't one of the flags
+        """
+        mask = 0
+        for idx in idxes:
+            if idx is None:
+                continue
+            try:
+                mask |= YES_NO_FLAGS[idx]
+            except KeyError:
+                return None
+        return mask
+
+    # ======================================
+    def has_flags(self, school, any_of=0, all_of=0):
+        """
+        Does the school have at least one of the any_of flags (when
+        given) and all of the all_of flags?  e.g. a charter or magnet:
+
+            segcalc.has_flags(school, any_of=FLAG_CHARTER|FLAG_MAGNET)
+        """
+        flags = self.get_flags(school)
+        if any_of and not (flags & any_of):
+            return False
+        return (flags & all_of) == all_of
+
+    # ======================================
+    def is_flagged(self, school, idx):
+        """
+        Is a Yes/No field (CHARTR, MAGNET, etc...) set for this school?
+        """
+        if idx in YES_NO_FLAGS:
+            return bool(self.get_flags(school) & YES_NO_FLAGS[idx])
+        try:
+            field = school[idx]
+        except KeyError:
+            return False
+        return (field == '1' or field == 1 or field == 'Y')
+
+    # ======================================
+    def calc_all(self):
+        """
+        Calculate all of the report measures with a single pass over the schools,
+        rather than the dozen or so passes made by calling each calc_* method in turn.
+
+        Returns a dictionary of {category: value} dictionaries, each one matching
+        the method noted below:
+
+            dis_idx   - calc_dis_idx()
+            exp_idx   - calc_exp_idx()
+            iso_idx   - calc_iso_idx()
+            min_idx   - calc_totals('MINORITY')
+            tot_idx   - calc_totals()
+            mper_idx  - calc_proportion('MINORITY')
+            pmag_idx  - Proportion of students in a Magnet
+            pchr_idx  - Proportion of students in a Charter
+            pchc_idx  - Proportion of students in a Magnet or Charter
+        """
+        groups = [(self.minority_idx, self.sec_minority_idx, self.majority_idx)]
+        return self.calc_groups(groups)[0]
+
+    # ======================================
+    def calc_groups(self, groups):
+        """
+        calc_all for a list of (MINORITY, SEC_MINORITY, MAJORITY) groups, all
+        computed in the same pass over the schools.  Returns a list of calc_all
+        dictionaries in the same order as groups.
+
+        The Dissimilarity Index needs Py before it can sum |giy - Py*ti|, so the
+        (giy, ti) pairs are kept per category and summed once the pass is done.
+        """
+        # One calculator per group so the usual accessors pick the right columns
+        calcs = []
+        sums = []
+        for minority, sec_minority, majority in groups:
+            calc = copy.copy(self)
+            calc.minority_idx = minority
+            calc.sec_minority_idx = sec_minority
+            calc.majority_idx = majority
+            calcs.append(calc)
+            sums.append(dict(T={}, Py={}, Pz={}, Exp={}, Exp_Y={}, Iso={}, Iso_Y={}, Min={}, Dis_Terms={}))
+
+        # Totals that don't depend on the group
+        Tot = {}
+        Mag = {}
+        Chr = {}
+        Chc = {}
+        for cat, schools in self.iter_categories():
+            # Every category gets an entry, even if the data is bogus,
+            # except the counts that only exist once there's valid data
+            tot = None
+            mag = 0
+            chrtr = 0
+            chc = 0
+            cat_sums = []
+            for group in sums:
+                cat_sums.append(dict(T=0.0, Py=0.0, Pz=0.0, Exp=0.0, Exp_Y=0.0, Iso=0.0, Iso_Y=0.0,
+                        Min=None, Dis_Terms=[]))
+
+            for school in schools:
+                ti = self.get_members(school)
+
+                # Negative numbers are used to represent missing data, don't
+                # include these in the calculations
+                if ti >= 0:
+                    if tot is None:
+                        tot = ti
+                    else:
+                        tot += ti
+
+                # School Choice, summed on the raw MEMBER count
+                mi = school['MEMBER']
+                if mi >= 0:
+                    flags = self.get_flags(school)
+                    if flags & FLAG_MAGNET:
+                        mag += mi
+                    if flags & FLAG_CHARTER:
+                        chrtr += mi
+                    if flags & (FLAG_CHARTER | FLAG_MAGNET):
+                        chc += mi
+
+                for calc, cat_sum in zip(calcs, cat_sums):
+                    giy = calc.get_minority(school)
+                    giz = calc.get_majority(school)
+
+                    if giy >= 0:
+                        if cat_sum['Min'] is None:
+                            cat_sum['Min'] = giy
+                        else:
+                            cat_sum['Min'] += giy
+
+                    # Isolation - Exposure of Group Y to itself
+                    if giy >= 0 and ti > 0:
+                        cat_sum['Iso'] += float(giy*giy)/ti
+                        cat_sum['Iso_Y'] += giy
+
+                    if giy >= 0 and giz >= 0 and ti >= 0:
+                        # Exposure of Group Y to Group Z
+                        if ti > 0:
+                            cat_sum['Exp'] += float(giy*giz)/ti
+                            cat_sum['Exp_Y'] += giy
+
+                        # Totals and Averages for the Dissimilarity Index
+                        cat_sum['T'] += ti
+                        cat_sum['Py'] += giy
+                        cat_sum['Pz'] += giz
+                        cat_sum['Dis_Terms'].append((giy, ti))
+
+            if tot is not None:
+                Tot[cat] = tot
+            Mag[cat] = mag
+            Chr[cat] = chrtr
+            Chc[cat] = chc
+            for group, cat_sum in zip(sums, cat_sums):
+                for name, value in cat_sum.items():
+                    if value is not None:
+                        group[name][cat] = value
+
+        results = []
+        for group in sums:
+            T = group['T']
+            Py = group['Py']
+            Pz = group['Pz']
+            Exp = group['Exp']
+            Iso = group['Iso']
+            Dis = {}
+            for cat in T.keys():
+                # Exposure/Isolation - Divide Y back out of the sum
+                if Exp[cat] > 0.1:
+                    Exp[cat] = Exp[cat] / group['Exp_Y'][cat]
+                if Iso[cat] > 0.1:
+                    Iso[cat] = Iso[cat] / group['Iso_Y'][cat]
+
+                try:
+                    Py[cat] = float(Py[cat]) / T[cat]
+                except ZeroDivisionError:
+                    Py[cat] = 0.0
+                try:
+                    Pz[cat] = float(Pz[cat]) / T[cat]
+                except ZeroDivisionError:
+                    Pz[cat] = 0.0
+
+                # Dissimilarity - See calc_dis_idx
+                Num = 0.0
+                for giy, ti in group['Dis_Terms'][cat]:
+                    Num += abs(giy - Py[cat] * ti)
+                Den = 0.0
+                Den += T[cat] * Py[cat] * (1 - Py[cat])
+                Den += T[cat] * Pz[cat] * (1 - Pz[cat])
+                Den *= 2.0
+                try:
+                    Dis[cat] = Num/Den
+                except ZeroDivisionError:
+                    Dis[cat] = 0.0
+
+            results.append(dict(
+                dis_idx=Dis,
+                exp_idx=Exp,
+                iso_idx=Iso,
+                min_idx=group['Min'],
+                tot_idx=dict(Tot),
+                mper_idx=self.calc_prop(group['Min'], Tot),
+                pmag_idx=self.calc_prop(Mag, Tot),
+                pchr_idx=self.calc_prop(Chr, Tot),
+                pchc_idx=self.calc_prop(Chc, Tot)
+            ))
+        return results
+
     # ======================================
     def calc_gini_coef(self):
         """
@@ -755,45 +1012,43 @@ class SegCalc(object):
 
             2*T*T(Py)(1-Py)
 
-        """
-        # Sort schools out into lists group by the category index
-        schools_by_cat = {}
-        for school in self.filtered_schools:
-            # Make sure the datastructure exists
-            try:
-                test = schools_by_cat[school[self.cat_idx]]
-            except KeyError:
-                schools_by_cat[school[self.cat_idx]] = []
-            schools_by_cat[school[self.cat_idx]].append(school)
+        Rather than visiting every pair of schools, sort the schools in a category
+        by pi.  Each school then contributes ti*pi once for every student in a
+        school below it and -ti*pi for every student in a school above it:
 
-        if self.debug:
-            print schools_by_cat.keys()
+            2 * Sum(k) tk*pk*(W_below(k) - W_above(k))
 
+        which is the same double sum in O(n log n).
+        """
         Num = {}
-        # Now the double sum for the numerator
-        for cat in schools_by_cat.keys():
+        for cat, schools in self.iter_categories():
             if self.debug:
-                print "Schools in Category %s:  %d" % (cat, len(schools_by_cat[cat]))
-            for ischool in schools_by_cat[cat]:
-                for jschool in schools_by_cat[cat]:
-                    ti = self.get_members(ischool)
-                    gyi = self.get_minority(ischool)
-                    tj = self.get_members(jschool)
-                    gyj = self.get_minority(jschool)
-
-                    # Make sure the datastructure exists
-                    try:
-                        test = Num[cat]
-                    except KeyError:
-                        Num[cat] = 0.0
-
-                    # Negative numbers are used to represent missing data, don't
-                    # include these in the calculations
-                    if gyi < 0 or gyj < 0 or ti <= 0 or tj <= 0:
-                        continue
-
-                    # Sum the Term Here:  ti*tj*abs(...)
-                    Num[cat] += ti*tj*abs(gyi/ti-gyj/tj)
+                print "Schools in Category %s:  %d" % (cat, len(schools))
+
+            # (pi, ti) for every school in the category
+            schools_by_pi = []
+            for school in schools:
+                ti = self.get_members(school)
+                gyi = self.get_minority(school)
+
+                # Negative numbers are used to represent missing data, don't
+                # include these in the calculations
+                if gyi < 0 or ti <= 0:
+                    continue
+                schools_by_pi.append((float(gyi)/ti, ti))
+            schools_by_pi.sort()
+
+            W = 0.0
+            for pi, ti in schools_by_pi:
+                W += ti
+
+            # Sum the Term Here:  ti*pi*(students below - students above)
+            Num[cat] = 0.0
+            W_below = 0.0
+            for pi, ti in schools_by_pi:
+                Num[cat] += ti * pi * (W_below - (W - W_below - ti))
+                W_below += ti
+            Num[cat] *= 2.0
 
         if self.debug:
             print "=" * 80
@@ -829,98 +1084,44 @@ class SegCalc(object):
         return Gini
 
 
-    # ======================================
-    def calc_gini_coef2(self):
-        """
-        Calculate the Gini Coefficient - A measure of inequality or in this case
-        segregation (equality of distribution of minority students as compared to
-        total minority population in the selected category)
-
-        Calculate the sum of difference between proportions of a minority group
-        against all other schools in the category:
-
-            Sum(i)Sum(j) (ti*tj*|pi - pj|)
-
-        Normalization term, the area of an ideally distributed district:
-
-            2*T*T(Py)(1-Py)
-
-        """
-        # Categorized Totals/Probabilities
-        T, Py, Pz = self.calc_cat_totals()
-
-        schools_and_y_group = []
-        for school in self.filtered_schools:
-            giy = school[self.minority_idx]
-            ti = school[self.total_idx]
-            try:
-                schools_and_y_group.append((giy/ti, giy, ti, school))
-            except ZeroDivisionError:
-                pass
-
-        schools_by_pi = sorted(schools_and_y_group, key=operator.itemgetter(0))
-
-        B_y_axis = {}
-        B = {}
-        Count = {}
-
-        for pi, giy, ti, school in schools_by_pi:
-
-            category = school[self.cat_idx]
-
-            # Make sure the datastructure exists
-            try:
-                test = B[category]
-            except KeyError:
-                B_y_axis[category] = 0.0
-                B[category] = 0.0
-                Count[category] = 0
-
-            # Negative numbers are used to represent missing data, don't
-            # include these in the calculations
-
-            if giy < 0 or ti <= 0:
-                print school
-                continue
-
-            # Areas
-            if category == '02':
-                print "%f vs %f" % (pi, Py['02'])
-            B_y_axis[category] += pi
-            B[category] += B_y_axis[category]
-            Count[category] += 1
-
-        if self.debug:
-            import pprint
-            print "=" * 80
-            print "B"
-            print "=" * 80
-            pprint.pprint(B)
-
-            import pprint
-            print "=" * 80
-            print "B_y_axis"
-            print "=" * 80
-            pprint.pprint(B_y_axis)
-
-            import pprint
-            print "=" * 80
-            print "Count"
-            print "=" * 80
-            pprint.pprint(Count)
-
-
-        Gini = {}
-        for cat in B.keys():
-            try:
-                B[cat] = B[cat] / (Count[cat] * B_y_axis[cat])  # Normalize area to 1
-                Gini[cat] = (1 + 1/Count[cat] - 2*B[cat])           # Return Area A
-            except ZeroDivisionError:
-                Gini[cat] = 0.0
-
-        return Gini
+# *****************************************************************************
+# Unit Tests
+# *****************************************************************************
+class TestGini(unittest.TestCase):
 
+    def setUp(self):
+        self.idx = {
+            'MINORITY': 'BLACK',
+            'MAJORITY': 'WHITE',
+            'TOTAL': 'MEMBER',
+            'CATEGORY': 'FIPS',
+        }
+        self.schools = SAMPLE_SCHOOLS + [
+            {'BLACK': 3, 'WHITE': 9, 'MEMBER': 13, 'FIPS': 02, 'LEAID': 012},
+            {'BLACK': 30, 'WHITE': 1, 'MEMBER': 33, 'FIPS': 02, 'LEAID': 012},
+            {'BLACK': -1, 'WHITE': 30, 'MEMBER': 40, 'FIPS': 02, 'LEAID': 012},
+            {'BLACK': 0, 'WHITE': 0, 'MEMBER': 0, 'FIPS': 04, 'LEAID': 013},
+        ]
+
+    def test_matches_pairwise(self):
+        sg = SegCalc(self.schools, self.idx)
+        T, Py, Pz = sg.calc_cat_totals()
+        gini = sg.calc_gini_coef()
+        for cat in gini.keys():
+            points = []
+            for school in self.schools:
+                if school['FIPS'] == cat and school['BLACK'] >= 0 and school['MEMBER'] > 0:
+                    points.append((float(school['BLACK'])/school['MEMBER'], school['MEMBER']))
+            den = 2 * T[cat] * T[cat] * Py[cat] * (1 - Py[cat])
+            if den:
+                self.assertAlmostEqual(gini[cat], gini_pairwise_sum(points)/den)
+            else:
+                self.assertEqual(gini[cat], 0.0)
 
+    def test_no_segregation(self):
+        sg = SegCalc([dict(school, BLACK=5) for school in SAMPLE_SCHOOLS], self.idx)
+        for value in sg.calc_gini_coef().values():
+            self.assertAlmostEqual(value, 0.0)
 
 # *****************************************************************************
 # -------------------------------------
@@ -935,12 +1136,7 @@ def usage():
 def main(argv):
     # Lets do a quick test, normally this isn't run at the command line
     # Short list for now
-    sl = [
-        {'BLACK': 5, 'WHITE': 20, 'MEMBER': 25, 'FIPS': 01, 'LEAID': 011},
-        {'BLACK': 20, 'WHITE': 5, 'MEMBER': 25, 'FIPS': 01, 'LEAID': 011},
-        {'BLACK': 5, 'WHITE': 20, 'MEMBER': 25, 'FIPS': 02, 'LEAID': 011},
-        {'BLACK': 5, 'WHITE': 20, 'MEMBER': 25, 'FIPS': 02, 'LEAID': 011},
-    ]
+    sl = SAMPLE_SCHOOLS
     idx = {
             'Y_GROUP': 'BLACK',
             'Z_GROUP': 'WHITE',
@@ -974,10 +1170,6 @@ def main(argv):
     print "Gini Coefficient"
     print "=" * 80
     pprint.pprint(sg.calc_gini_coef())
-    print "=" * 80
-    print "Gini Coefficient 2"
-    print "=" * 80
-    pprint.pprint(sg.calc_gini_coef2())
 
 
 # -------------------------------------
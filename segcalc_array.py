@@ -0,0 +1,740 @@
+#!/usr/bin/env python
+"""
+Array backed version of the segregation calculator.
+
+SegCalc walks a list of school dicts once per measure.  ArraySegCalc takes the
+same index dictionary but works on whole columns instead (numpy arrays, or the
+memory mapped CachedColumns from NCESParser.get_columns()).  The category
+column is factorised once into integer ids and every measure becomes a grouped
+reduction with np.bincount, the results are returned in the same
+{category: value} dictionaries that SegCalc produces.
+"""
+import sys
+import copy
+import unittest
+
+import numpy as np
+
+from segcalc import SegCalc
+from segcalc import SAMPLE_SCHOOLS
+from segcalc import parse_grade
+from nces_parser import NCESParser
+from nces_parser import YES_NO_FLAGS
+
+# ==============================================================================
+# Constants
+# ==============================================================================
+# Values of CHARTR/MAGNET/etc... that mean 'Yes'
+TRUE_VALS = ['1', 'Y']
+
+# ==============================================================================
+# Utility Functions
+# ==============================================================================
+def columns_from_schools(school_list):
+    """
+    Turn a list of school dicts into a dictionary of column arrays.
+    Only the keys present in every school are kept.
+    """
+    if not school_list:
+        return {}
+    names = set(school_list[0].keys())
+    for school in school_list:
+        names.intersection_update(school.keys())
+    columns = {}
+    for name in names:
+        columns[name] = np.array([school[name] for school in school_list])
+    return columns
+
+# --------------------------------------
+def is_string_array(values):
+    return values.dtype.kind in ('S', 'U', 'O')
+
+# ==============================================================================
+class ArraySegCalc(object):
+    """
+    A segregation calculating object that works on column arrays.
+    """
+    def __init__(self, columns, index_dict, only_hs=False, only_el=False, grade=False):
+        """
+        columns is a mapping of column name to array, either a dict
+        or the CachedColumns from NCESParser.get_columns()
+        """
+        self.debug = 0
+        self.columns = columns
+        self.only_high_school = only_hs
+        self.only_elementary = only_el
+        self.grade = grade
+        self.minority_idx = index_dict['MINORITY']  # Minority Group Student Count
+        self.majority_idx = index_dict['MAJORITY']  # Majority Group Student Count
+        self.total_idx = index_dict['TOTAL']      # Total Student Count
+        self.cat_idx = index_dict['CATEGORY']     # Index to Categorize along (state, district, etc)
+
+        # Search for Some optional arguments
+        try:
+            self.sec_minority_idx = index_dict['SEC_MINORITY']  # Minority Group Student Count
+        except KeyError:
+            self.sec_minority_idx = None
+
+        # Skip items that don't match item[idx] == val
+        try:
+            self.match = True
+            self.match_idx = index_dict['MATCH_IDX']
+            self.match_val = index_dict['MATCH_VAL']
+        except KeyError:
+            self.match = False
+
+    # ======================================
+    # Column Accessors
+    # ======================================
+    def has_column(self, name):
+        return name is not None and name in self.columns
+
+    # ======================================
+    def get_raw_column(self, name):
+        """
+        Full (unfiltered) column, string columns are decoded
+        """
+        if not self.has_column(name):
+            raise KeyError(name)
+        try:
+            if self.columns.is_string(name):
+                return self.columns.decode(name)
+        except AttributeError:
+            pass
+        return np.asarray(self.columns[name])
+
+    # ======================================
+    def get_column(self, name):
+        """
+        Column restricted to the filtered schools
+        """
+        values = self.get_raw_column(name)
+        if self.filtered_rows is not None:
+            values = values[self.filtered_rows]
+        return values
+
+    # ======================================
+    def get_row_count(self):
+        for name in (self.total_idx, self.cat_idx):
+            if self.has_column(name):
+                return len(self.columns[name])
+        return 0
+
+    # ======================================
+    def get_minority(self):
+        """
+        Minority student count for each school, plus the secondary
+        minority group if requested.  A missing column counts as 0.
+        """
+        try:
+            count = np.trunc(self.get_column(self.minority_idx).astype(np.float64))
+            if self.sec_minority_idx:
+                count = count + np.trunc(self.get_column(self.sec_minority_idx).astype(np.float64))
+        except KeyError:
+            return np.zeros(len(self.cat_ids))
+        return count
+
+    # ======================================
+    def get_majority(self):
+        """
+        Majority student count for each school
+        """
+        # Free Lunch Majority is the non-Free Lunch people
+        if self.minority_idx == 'FRELCH':
+            return self.get_members() - self.get_minority()
+        try:
+            return np.trunc(self.get_column(self.majority_idx).astype(np.float64))
+        except KeyError:
+            raise Exception("Missing Column:", self.majority_idx)
+
+    # ======================================
+    def get_members(self):
+        """
+        Total student count for each school
+        """
+        try:
+            return np.trunc(self.get_column(self.total_idx).astype(np.float64))
+        except KeyError:
+            raise Exception("Missing Column:", self.total_idx)
+
+    # ======================================
+    def get_flags(self):
+        """
+        FLAG_* bitmap for each school, from the parser's FLAGS column
+        or put together from the Yes/No columns
+        """
+        if self.has_column('FLAGS'):
+            return self.get_column('FLAGS').astype(np.int32)
+        flags = np.zeros(len(self.cat_ids), dtype=np.int32)
+        for name, flag in YES_NO_FLAGS.items():
+            flags[self.get_flag(name)] |= flag
+        return flags
+
+    # ======================================
+    def get_flag_mask(self, any_of=0, all_of=0):
+        """
+        Boolean array, True for the schools with at least one of the
+        any_of flags (when given) and all of the all_of flags
+        """
+        flags = self.get_flags()
+        mask = (flags & all_of) == all_of
+        if any_of:
+            mask &= (flags & any_of) != 0
+        return mask
+
+    # ======================================
+    def get_flag(self, name):
+        """
+        Boolean array, True where the column is '1', 1 or 'Y'.
+        A missing column is all False.
+        """
+        if name in YES_NO_FLAGS and self.has_column('FLAGS'):
+            return self.get_flag_mask(any_of=YES_NO_FLAGS[name])
+        if not self.has_column(name):
+            return np.zeros(len(self.cat_ids), dtype=bool)
+        values = self.get_column(name)
+        if is_string_array(values):
+            return np.in1d(values, TRUE_VALS)
+        return values == 1
+
+    # ======================================
+    def get_grade(self, high=True):
+        """
+        Numeric high or low grade for every school (unfiltered), straight
+        from the GRADE_HI/GRADE_LO columns if the parser made them
+        """
+        if high:
+            num_idx, grade_idx = 'GRADE_HI', 'GSHI'
+        else:
+            num_idx, grade_idx = 'GRADE_LO', 'GSLO'
+
+        if self.has_column(num_idx):
+            return self.get_raw_column(num_idx)
+
+        try:
+            values = self.get_raw_column(grade_idx)
+        except KeyError:
+            raise Exception("Missing Column:", grade_idx)
+        # Only a handful of distinct grade codes, convert each once
+        uniq, inverse = np.unique(values, return_inverse=True)
+        grades = np.array([parse_grade(val) for val in uniq.tolist()], dtype=np.int32)
+        return grades[inverse]
+
+    # ======================================
+    @property
+    def filtered_rows(self):
+        """
+        Row numbers of the schools that pass the requested filters,
+        None if every school is used.  Cached for later use.
+        """
+        try:
+            return self._filtered_rows
+        except AttributeError:
+            if (
+                self.match == False and
+                self.only_high_school == False and
+                self.only_elementary == False and
+                self.grade == False
+            ):
+                self._filtered_rows = None
+                print "Schools Found: %d" % (self.get_row_count())
+                return self._filtered_rows
+
+            keep = np.zeros(self.get_row_count(), dtype=bool)
+            if self.match and self.has_column(self.match_idx):
+                values = self.get_raw_column(self.match_idx)
+                if is_string_array(values):
+                    keep |= (values == self.match_val)
+                elif self.match_val.isdigit():
+                    keep |= (values == int(self.match_val))
+            if self.only_high_school:
+                keep |= (self.get_grade(high=False) >= 8)
+            if self.only_elementary:
+                high_grade = self.get_grade(high=True)
+                keep |= (high_grade <= 6) & (high_grade > 0)
+            if self.grade:
+                keep |= ((self.grade <= self.get_grade(high=True)) &
+                         (self.grade >= self.get_grade(high=False)))
+
+            self._filtered_rows = np.flatnonzero(keep)
+            print "Schools Found: %d" % (len(self._filtered_rows))
+            return self._filtered_rows
+
+    # ======================================
+    @property
+    def cat_ids(self):
+        """
+        Factorise the category column of the filtered schools, cat_keys[cat_ids[i]]
+        is the category of school i.  Cached for later use.
+        """
+        try:
+            return self._cat_ids
+        except AttributeError:
+            rows = self.filtered_rows
+            try:
+                # Cached string columns are already integer codes
+                is_string = self.columns.is_string(self.cat_idx)
+            except AttributeError:
+                is_string = False
+            if is_string:
+                codes = np.asarray(self.columns[self.cat_idx])
+                if rows is not None:
+                    codes = codes[rows]
+                uniq, self._cat_ids = np.unique(codes, return_inverse=True)
+                self._cat_keys = self.columns.vocab(self.cat_idx).take(uniq).tolist()
+            else:
+                uniq, self._cat_ids = np.unique(self.get_column(self.cat_idx), return_inverse=True)
+                self._cat_keys = uniq.tolist()
+            return self._cat_ids
+
+    # ======================================
+    @property
+    def cat_keys(self):
+        self.cat_ids
+        return self._cat_keys
+
+    # ======================================
+    def group_sum(self, values, mask=None):
+        """
+        Sum values by category, optionally only where mask is True
+        """
+        if mask is not None:
+            values = np.where(mask, values, 0.0)
+        return np.bincount(self.cat_ids, weights=values, minlength=len(self.cat_keys))
+
+    # ======================================
+    def group_any(self, mask):
+        """
+        True for every category that has at least one school in mask
+        """
+        return np.bincount(self.cat_ids, weights=mask, minlength=len(self.cat_keys)) > 0
+
+    # ======================================
+    def make_dict(self, values, present=None, cast=float):
+        """
+        Convert a per category array back to a {category: value} dictionary
+        """
+        results = {}
+        for i, key in enumerate(self.cat_keys):
+            if present is None or present[i]:
+                results[key] = cast(values[i])
+        return results
+
+    # ======================================
+    def get_idxed_val(self, idx_x, idx_y):
+        """
+        Get a dictionary mapping one index to another, last school wins
+        """
+        x = self.get_column(idx_x)[::-1]
+        y = self.get_column(idx_y)[::-1]
+        uniq, first = np.unique(x, return_index=True)
+        return dict(zip(uniq.tolist(), y[first].tolist()))
+
+    # ======================================
+    # Calculation Methods
+    # ======================================
+    def calc_sum(self, x_dict, y_dict):
+        """
+        Given two dictionaries that are grouped data entries, calculate
+        a new dictionary that is the grouped sum.
+        """
+        sum_dict = {}
+        for key in x_dict.keys():
+            try:
+                sum_dict[key] = x_dict[key] + y_dict[key]
+            except KeyError:
+                raise Exception("Input Dicts didn't have the same keys")
+        return sum_dict
+
+    # ======================================
+    def calc_prop(self, num_dict, den_dict):
+        """
+        Given two dictionaries that are grouped data entries, calculate
+        a new dictionary that is the grouped proportion.
+        """
+        prop_dict = {}
+        for key in num_dict.keys():
+            try:
+                prop_dict[key] = float(num_dict[key]) / float(den_dict[key])
+            except ZeroDivisionError:
+                prop_dict[key] = 0.0
+            except KeyError:
+                prop_dict[key] = 0.0
+        return prop_dict
+
+    # ======================================
+    def calc_totals(self, idx=None):
+        """
+        Get a report on the total student count and so forth
+        """
+        cast = int
+        if idx == 'MINORITY':
+            ti = self.get_minority()
+        elif idx == 'MAJORITY':
+            ti = self.get_majority()
+        elif not idx:  # Default to Totals Student Count
+            ti = self.get_members()
+        else:
+            ti = self.get_column(idx).astype(np.float64)
+            cast = float
+
+        # Negative numbers mean missing data.
+        valid = ti >= 0
+        return self.make_dict(self.group_sum(ti, valid), self.group_any(valid), cast)
+
+    # ======================================
+    def calc_dependant_totals(self, sum_idx, dep_idx, sec_dep_idx=None):
+        """
+        Get a report on the total student count and so forth
+        """
+        ti = self.get_column(sum_idx).astype(np.float64)
+        dependant = self.get_flag(dep_idx) | self.get_flag(sec_dep_idx)
+
+        # Negative numbers mean missing data.
+        return self.make_dict(self.group_sum(ti, dependant & (ti >= 0)))
+
+    # ======================================
+    def calc_proportion(self, idx='MINORITY'):
+        """
+        Get a report on the total student count and so forth
+        """
+        return self.calc_prop(self.calc_totals(idx), self.calc_totals())
+
+    # ======================================
+    def calc_percentages(self):
+        """
+        Get a report on the total student count and so forth
+        """
+        ethnicities = ['WHITE', 'BLACK', 'HISP', 'ASIAN', 'AM']
+        sums = {}
+        for ethn in ethnicities + ['MEMBER']:
+            try:
+                perc = self.get_column(ethn).astype(np.float64)
+            except KeyError:
+                raise Exception("Missing Column:", ethn)
+            # Negative numbers mean missing data.
+            sums[ethn] = self.group_sum(perc, perc >= 0)
+
+        Percentages = {}
+        for i, key in enumerate(self.cat_keys):
+            ti = sums['MEMBER'][i]
+            Percentages[key] = dict(MEMBER=float(ti))
+            for ethn in ethnicities:
+                if ti == 0:
+                    Percentages[key][ethn] = 0.0
+                else:
+                    Percentages[key][ethn] = sums[ethn][i] / ti
+        return Percentages
+
+    # ======================================
+    def calc_90(self):
+        """
+        Percentage of the Group within the Category that are in
+        a school w/ 90% or more of that give Group.
+        """
+        try:
+            yi = self.get_column(self.minority_idx).astype(np.float64)
+            ti = self.get_column(self.total_idx).astype(np.float64)
+        except KeyError:
+            raise Exception("Missing Column:", self.minority_idx, self.total_idx)
+
+        # Negative numbers are used to represent missing data
+        valid = (yi >= 0) & (ti > 0)
+        per = np.where(valid, yi, 0.0) / np.where(valid, ti, 1.0)
+
+        Y = self.group_sum(yi, valid & (per > 0.9))
+        Sum = self.group_sum(ti, valid)
+        return self.make_dict(np.where(Sum != 0, Y / np.where(Sum != 0, Sum, 1.0), 0.0))
+
+    # ======================================
+    # Segragation Calculations
+    # ======================================
+    def calc_iso_exp_idx(self, yi, zi):
+        """
+        Calculate the Exposure or Isolation Index, see SegCalc.calc_iso_exp_idx
+
+            Sum(yi/Y * zi/ti) over schools in the category/subcategory
+        """
+        ti = self.get_members()
+
+        # Negative numbers are used to represent missing data and
+        # empty schools would be a divide by zero, skip both
+        valid = (yi >= 0) & (zi >= 0) & (ti > 0)
+        terms = np.where(valid, yi * zi, 0.0) / np.where(valid, ti, 1.0)
+
+        Sum = self.group_sum(terms, valid)
+        Y = self.group_sum(yi, valid)
+        big = Sum > 0.1
+        Sum[big] = Sum[big] / Y[big]
+        return self.make_dict(Sum)
+
+    # ======================================
+    def calc_exp_idx(self):
+        # Expose Y Group to Z Group
+        return self.calc_iso_exp_idx(self.get_minority(), self.get_majority())
+
+    # ======================================
+    def calc_iso_idx(self):
+        # Expose a group to itself
+        minority = self.get_minority()
+        return self.calc_iso_exp_idx(minority, minority)
+
+    # ======================================
+    def calc_cat_total_arrays(self):
+        """
+        Per category (T, Py, Pz) arrays, indexed by cat_ids.
+        """
+        ti = self.get_members()
+        giy = self.get_minority()
+        giz = self.get_majority()
+
+        # Negative numbers are used to represent missing data
+        valid = (giy >= 0) & (giz >= 0) & (ti >= 0)
+        T = self.group_sum(ti, valid)
+        safe_T = np.where(T != 0, T, 1.0)
+        Py = np.where(T != 0, self.group_sum(giy, valid) / safe_T, 0.0)
+        Pz = np.where(T != 0, self.group_sum(giz, valid) / safe_T, 0.0)
+        return (T, Py, Pz)
+
+    # ======================================
+    def calc_cat_totals(self):
+        """
+        Total student count and the proportion in the Y and Z groups,
+        returns a tuple of dictionaries, (T, Py, Pz)
+        """
+        T, Py, Pz = self.calc_cat_total_arrays()
+        return (self.make_dict(T), self.make_dict(Py), self.make_dict(Pz))
+
+    # ======================================
+    def calc_dis_idx(self):
+        """
+        Calculate the Dissimilarity Index, see SegCalc.calc_dis_idx
+
+            Sum(i) |(giy - Py*ti)| / 2*(T(Py)(1-Py) + T(Pz)(1-Pz))
+        """
+        T, Py, Pz = self.calc_cat_total_arrays()
+
+        ti = self.get_members()
+        giy = self.get_minority()
+        giz = self.get_majority()
+        valid = (giy >= 0) & (giz >= 0) & (ti >= 0)
+        Num = self.group_sum(np.abs(giy - Py[self.cat_ids] * ti), valid)
+
+        Den = 2.0 * (T * Py * (1 - Py) + T * Pz * (1 - Pz))
+        return self.make_dict(np.where(Den != 0, Num / np.where(Den != 0, Den, 1.0), 0.0))
+
+    # ======================================
+    def calc_all(self):
+        """
+        The same dictionary of report measures as SegCalc.calc_all
+        """
+        tot_idx = self.calc_totals()
+        min_idx = self.calc_totals('MINORITY')
+        mag_idx = self.calc_dependant_totals(sum_idx='MEMBER', dep_idx='MAGNET')
+        chr_idx = self.calc_dependant_totals(sum_idx='MEMBER', dep_idx='CHARTR')
+        chc_idx = self.calc_dependant_totals(sum_idx='MEMBER', dep_idx='CHARTR', sec_dep_idx='MAGNET')
+        return dict(
+            dis_idx=self.calc_dis_idx(),
+            exp_idx=self.calc_exp_idx(),
+            iso_idx=self.calc_iso_idx(),
+            min_idx=min_idx,
+            tot_idx=tot_idx,
+            mper_idx=self.calc_prop(min_idx, tot_idx),
+            pmag_idx=self.calc_prop(mag_idx, tot_idx),
+            pchr_idx=self.calc_prop(chr_idx, tot_idx),
+            pchc_idx=self.calc_prop(chc_idx, tot_idx)
+        )
+
+    # ======================================
+    def calc_groups(self, groups):
+        """
+        calc_all for a list of (MINORITY, SEC_MINORITY, MAJORITY) groups, see
+        SegCalc.calc_groups.  The filtered rows and category ids are shared.
+        """
+        self.cat_ids
+        results = []
+        for minority, sec_minority, majority in groups:
+            calc = copy.copy(self)
+            calc.minority_idx = minority
+            calc.sec_minority_idx = sec_minority
+            calc.majority_idx = majority
+            results.append(calc.calc_all())
+        return results
+
+    # ======================================
+    def calc_gini_coef(self):
+        """
+        Calculate the Gini Coefficient, see SegCalc.calc_gini_coef
+
+            Sum(i)Sum(j) (ti*tj*|pi - pj|) / 2*T*T(Py)(1-Py)
+
+        Schools are sorted by (category, pi) once, the running total of
+        students below each school comes from a single cumsum.
+        """
+        ti = self.get_members()
+        gyi = self.get_minority()
+
+        # Negative numbers are used to represent missing data
+        valid = (gyi >= 0) & (ti > 0)
+        cat = self.cat_ids[valid]
+        t = ti[valid]
+        p = gyi[valid] / t
+
+        order = np.lexsort((p, cat))
+        cat = cat[order]
+        t = t[order]
+        p = p[order]
+
+        # Students in the category and in the earlier categories
+        W = np.bincount(cat, weights=t, minlength=len(self.cat_keys))
+        W_prev = np.cumsum(W) - W
+        W_below = np.cumsum(t) - t - W_prev[cat]
+        W_above = W[cat] - W_below - t
+        Num = 2.0 * np.bincount(cat, weights=t * p * (W_below - W_above), minlength=len(self.cat_keys))
+
+        T, Py, Pz = self.calc_cat_total_arrays()
+        Den = 2 * T * T * Py * (1 - Py)
+        return self.make_dict(np.where(Den != 0, Num / np.where(Den != 0, Den, 1.0), 0.0))
+
+
+# *****************************************************************************
+# Unit Tests
+# *****************************************************************************
+class TestArraySegCalc(unittest.TestCase):
+    """
+    The array engine has to match SegCalc on the same data
+    """
+    schools = SAMPLE_SCHOOLS + [
+        {'BLACK': 0, 'WHITE': 0, 'MEMBER': 0, 'FIPS': 02, 'LEAID': 012},
+        {'BLACK': -1, 'WHITE': 30, 'MEMBER': 40, 'FIPS': 02, 'LEAID': 012},
+        {'BLACK': 38, 'WHITE': 1, 'MEMBER': 40, 'FIPS': 04, 'LEAID': 013},
+    ]
+
+    def setUp(self):
+        self.idx = {
+            'MINORITY': 'BLACK',
+            'MAJORITY': 'WHITE',
+            'TOTAL': 'MEMBER',
+            'CATEGORY': 'LEAID',
+        }
+
+    def assertDictAlmostEqual(self, a, b):
+        self.assertEqual(sorted(a.keys()), sorted(b.keys()))
+        for key in a.keys():
+            if isinstance(a[key], dict):
+                self.assertDictAlmostEqual(a[key], b[key])
+            else:
+                self.assertAlmostEqual(a[key], b[key])
+
+    def check_parity(self):
+        sc = SegCalc(self.schools, self.idx)
+        asc = ArraySegCalc(columns_from_schools(self.schools), self.idx)
+        self.assertDictAlmostEqual(sc.calc_dis_idx(), asc.calc_dis_idx())
+        self.assertDictAlmostEqual(sc.calc_exp_idx(), asc.calc_exp_idx())
+        self.assertDictAlmostEqual(sc.calc_iso_idx(), asc.calc_iso_idx())
+        self.assertDictAlmostEqual(sc.calc_90(), asc.calc_90())
+        self.assertDictAlmostEqual(sc.calc_gini_coef(), asc.calc_gini_coef())
+        self.assertDictAlmostEqual(sc.calc_totals(), asc.calc_totals())
+        self.assertDictAlmostEqual(sc.calc_totals('MINORITY'), asc.calc_totals('MINORITY'))
+        self.assertDictAlmostEqual(sc.calc_totals('MAJORITY'), asc.calc_totals('MAJORITY'))
+        self.assertDictAlmostEqual(sc.calc_proportion(), asc.calc_proportion())
+        for sc_dict, asc_dict in zip(sc.calc_cat_totals(), asc.calc_cat_totals()):
+            self.assertDictAlmostEqual(sc_dict, asc_dict)
+
+    def test_calc_all(self):
+        schools = [dict(school, CHARTR=['1', '2', 'N'][i % 3], MAGNET=['Y', '2'][i % 2])
+                   for i, school in enumerate(self.schools)]
+        sc = SegCalc(schools, self.idx)
+        asc = ArraySegCalc(columns_from_schools(schools), self.idx)
+        results = sc.calc_all()
+        array_results = asc.calc_all()
+        self.assertDictAlmostEqual(results['dis_idx'], sc.calc_dis_idx())
+        self.assertDictAlmostEqual(results['exp_idx'], sc.calc_exp_idx())
+        self.assertDictAlmostEqual(results['iso_idx'], sc.calc_iso_idx())
+        self.assertDictAlmostEqual(results['min_idx'], sc.calc_totals('MINORITY'))
+        self.assertDictAlmostEqual(results['tot_idx'], sc.calc_totals())
+        self.assertDictAlmostEqual(results['mper_idx'], sc.calc_proportion('MINORITY'))
+        self.assertDictAlmostEqual(results['pchc_idx'], sc.calc_prop(
+            sc.calc_dependant_totals(sum_idx='MEMBER', dep_idx='CHARTR', sec_dep_idx='MAGNET'),
+            sc.calc_totals()))
+        for key in results.keys():
+            self.assertDictAlmostEqual(results[key], array_results[key])
+
+    def test_calc_groups(self):
+        groups = [('BLACK', None, 'WHITE'), ('WHITE', None, 'BLACK'), ('BLACK', 'WHITE', 'WHITE')]
+        results = SegCalc(self.schools, self.idx).calc_groups(groups)
+        array_results = ArraySegCalc(columns_from_schools(self.schools), self.idx).calc_groups(groups)
+        for i, (minority, sec_minority, majority) in enumerate(groups):
+            idx = dict(self.idx, MINORITY=minority, SEC_MINORITY=sec_minority, MAJORITY=majority)
+            single = SegCalc(self.schools, idx).calc_all()
+            for key in single.keys():
+                self.assertDictAlmostEqual(single[key], results[i][key])
+                self.assertDictAlmostEqual(single[key], array_results[i][key])
+
+    def test_by_district(self):
+        self.check_parity()
+
+    def test_by_state(self):
+        self.idx['CATEGORY'] = 'FIPS'
+        self.check_parity()
+
+    def test_sample_list(self):
+        self.schools = SAMPLE_SCHOOLS
+        self.check_parity()
+
+    def test_percentages(self):
+        schools = [dict(school, HISP=1, ASIAN=2, AM=0) for school in self.schools]
+        sc = SegCalc(schools, self.idx)
+        asc = ArraySegCalc(columns_from_schools(schools), self.idx)
+        self.assertDictAlmostEqual(sc.calc_percentages(), asc.calc_percentages())
+
+    def test_dependant_totals(self):
+        schools = [dict(school, CHARTR=['1', '2', 'N'][i % 3], MAGNET=['Y', '2'][i % 2])
+                   for i, school in enumerate(self.schools)]
+        sc = SegCalc(schools, self.idx)
+        asc = ArraySegCalc(columns_from_schools(schools), self.idx)
+        self.assertDictAlmostEqual(
+            sc.calc_dependant_totals(sum_idx='MEMBER', dep_idx='CHARTR'),
+            asc.calc_dependant_totals(sum_idx='MEMBER', dep_idx='CHARTR'))
+        self.assertDictAlmostEqual(
+            sc.calc_dependant_totals(sum_idx='MEMBER', dep_idx='CHARTR', sec_dep_idx='MAGNET'),
+            asc.calc_dependant_totals(sum_idx='MEMBER', dep_idx='CHARTR', sec_dep_idx='MAGNET'))
+
+    def test_match(self):
+        schools = [dict(school, FIPS='%02d' % school['FIPS']) for school in self.schools]
+        self.idx['MATCH_IDX'] = 'FIPS'
+        self.idx['MATCH_VAL'] = '02'
+        sc = SegCalc(schools, self.idx)
+        asc = ArraySegCalc(columns_from_schools(schools), self.idx)
+        self.assertDictAlmostEqual(sc.calc_dis_idx(), asc.calc_dis_idx())
+        self.assertDictAlmostEqual(sc.calc_totals(), asc.calc_totals())
+
+
+# *****************************************************************************
+# -------------------------------------
+# Parse the command line options
+# -------------------------------------
+def main(argv):
+    # Compare the two engines on a real year of data
+    idx = {
+        'MINORITY': 'BLACK',
+        'MAJORITY': 'WHITE',
+        'TOTAL': 'MEMBER',
+        'CATEGORY': 'FIPS',
+    }
+    nces = NCESParser(year=2006)
+    sg = SegCalc(nces.parse(make_dict=True), idx)
+    asg = ArraySegCalc(nces.get_columns(), idx)
+
+    for name in ['calc_dis_idx', 'calc_exp_idx', 'calc_iso_idx', 'calc_90', 'calc_gini_coef']:
+        dict_result = getattr(sg, name)()
+        array_result = getattr(asg, name)()
+        worst = max([abs(dict_result[key] - array_result[key]) for key in dict_result.keys()])
+        print "%s: Max Difference %g" % (name, worst)
+
+# -------------------------------------
+# Drop the script name from the args
+# and call our command line parser
+# -------------------------------------
+if __name__ == "__main__":
+    main(sys.argv[1:])
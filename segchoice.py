@@ -9,6 +9,10 @@ import operator
 
 from segcalc import SegCalc
 from nces_parser import NCESParser
+from nces_parser import FLAG_CHARTER
+from nces_parser import FLAG_MAGNET
+from parallel import add_jobs_argument
+from parallel import map_years
 from fips import fips_to_st
 
 from xlwt import Workbook
@@ -26,27 +30,18 @@ MAX_RECORD = 100
 def sch_type_report(schools, cat_idx):
     """
     Report on school counts and student population for the various
-    school types (Magnet, Charter, etc...)
+    school types (Magnet, Charter, etc...).  A school counts as charter
+    or magnet when its CHARTR/MAGNET column is 1 or Y (see FLAGS).
     """
     counts_dict = {}
     for school in schools:
         try:
-            charter = school['CHARTR']
-            magnet = school['MAGNET']
+            flags = int(school['FLAGS'])
             ti = school['MEMBER']
             try:
                 ti = int(ti)
             except ValueError:
                 ti = 0
-
-            try:
-                charter = int(charter)
-            except ValueError:
-                charter = 0
-            try:
-                magnet = int(magnet)
-            except ValueError:
-                magnet = 0
         except KeyError:
             raise KeyError("Problem School:",school.__repr__())
 
@@ -59,10 +54,10 @@ def sch_type_report(schools, cat_idx):
         # Negative numbers mean missing data.
         if ti > 0:
             counts_dict[school[cat_idx]]['all'] += ti
-            if int(charter) == 1:
+            if flags & FLAG_CHARTER:
                 counts_dict[school[cat_idx]]['charter'] += 1
                 counts_dict[school[cat_idx]]['charter_st'] += ti
-            elif int(magnet) == 1:
+            elif flags & FLAG_MAGNET:
                 counts_dict[school[cat_idx]]['magnet'] += 1
                 counts_dict[school[cat_idx]]['magnet_st'] += ti
             else:
@@ -145,6 +140,34 @@ def save_sch_report(year_range, results, count, category_lut, filename):
     wb.save(filename)
 
 
+# -------------------------------------
+def calc_year(work):
+    """
+    Count the school types for one year, the unit of work handed to each
+    process with --jobs.  The last year also works out the category names.
+
+    Returns (year, counts or None if the year lacks the data, category_lut)
+    """
+    year, idx, category, want_lut = work
+
+    # Count of schools and charters and what not
+    nces = NCESParser(year=year)
+    schools = nces.parse(make_dict=True)
+    try:
+        counts = sch_type_report(schools, category)
+    except KeyError:
+        counts = None
+
+    # Get some information for reporting
+    category_lut = None
+    if want_lut:
+        segcalc = SegCalc(schools, idx)
+        if category == 'LEAID':
+            category_lut = segcalc.get_idxed_val('LEAID', 'LEANM')
+        elif category == 'FIPS':
+            category_lut = dict(zip(fips_to_st.keys(), [fips_to_st[key][0] for key in fips_to_st.keys()]))
+    return (year, counts, category_lut)
+
 # -------------------------------------
 # Parse the command line options
 # -------------------------------------
@@ -162,6 +185,7 @@ def main(argv):
             help='Override the default list of years to report on')
     parser.add_argument('--max_record', action='store', dest='max_record', required=False,
             help='Override the default number of items to report')
+    add_jobs_argument(parser)
     parser.add_argument('-debug', action='store_true', dest='debug', required=False,
             help='Debug Mode')
     args = parser.parse_args()
@@ -198,24 +222,16 @@ def main(argv):
         idx['MATCH_IDX'] = args.match_idx
         idx['MATCH_VAL'] = args.match_val
 
+    # The years are spread over --jobs processes and come back in order
     results = []
     data_years = []
-    for year in year_range:
-        # Count of schools and charters and what not
-        nces = NCESParser(year=year)
-        schools = nces.parse(make_dict=True)
-        try:
-            results.append(sch_type_report(schools, category))
+    work = [(year, idx, category, year == year_range[-1]) for year in year_range]
+    for year, counts, lut in map_years(calc_year, work, args.jobs):
+        if counts is not None:
+            results.append(counts)
             data_years.append(year)
-        except KeyError:
-            pass
-
-    # Get some information for reporting
-    segcalc = SegCalc(schools, idx)
-    if category == 'LEAID':
-        category_lut = segcalc.get_idxed_val('LEAID', 'LEANM')
-    elif category == 'FIPS':
-        category_lut = dict(zip(fips_to_st.keys(), [fips_to_st[key][0] for key in fips_to_st.keys()]))
+        if lut is not None:
+            category_lut = lut
 
     save_sch_report(
         data_years,
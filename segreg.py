@@ -7,6 +7,9 @@ import argparse
 import operator
 
 from nces_parser import NCESParser
+from nces_parser import FLAG_CHARTER
+from nces_parser import FLAG_MAGNET
+from nces_parser import FLAG_URBAN
 from segcalc2 import SegCalc
 
 import numpy as np
@@ -105,8 +108,7 @@ def main(argv):
     urbanicity_totals = {}
     for school in schools:
         # if school[region] in big_districts[:MAX_RECORD]:
-        local = school['ULOCAL']
-        if local[0] == '1':
+        if int(school['FLAGS']) & FLAG_URBAN:
             try:
                 urbanicity_totals[school[region]] += 1
             except KeyError:
@@ -127,10 +129,7 @@ def main(argv):
     for school in schools:
         # if school[region] in big_districts[:MAX_RECORD]:
         if school[region] in urbanicity_totals.keys():
-            if (
-                school['CHARTR'] == '1' or
-                school['MAGNET'] == '1'
-            ):
+            if int(school['FLAGS']) & (FLAG_CHARTER | FLAG_MAGNET):
                 head_count = int(school['MEMBER'])
                 if head_count < 0:
                     head_count = 0
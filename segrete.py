@@ -8,8 +8,12 @@ import argparse
 import operator
 
 from segcalc import SegCalc
-from nces_parser import NCESParser
+from nces_panel import NCESPanel
 from fips import fips_to_st
+from parallel import add_jobs_argument
+from parallel import map_years
+from results_cache import ResultsCache
+from results_cache import add_results_argument
 
 from xlwt import Workbook
 
@@ -22,33 +26,66 @@ MAX_RECORD = 1000
 # ==============================================================================
 # Functions
 # ==============================================================================
-def calc_idxes(segcalc):
+def calc_idxes(segcalc, groups):
     """
-    Call down to get all the various measures calculated
+    Call down to get all the various measures calculated, for each
+    (minority, secondary minority, majority) group
     """
-    print "Calculating Dissimilarity Index"
-    dis_idx = segcalc.calc_dis_idx()
-    print "Calculating Exposure Index"
-    exp_idx = segcalc.calc_exp_idx()
-    print "Calculating Isolation Index"
-    iso_idx = segcalc.calc_iso_idx()
-    print "Calculating Total Minority Students"
-    min_idx = segcalc.calc_totals('MINORITY')
-    print "Calculating Total Student Count"
-    tot_idx = segcalc.calc_totals()
-    print "Calculating Proportion of Students in the Minority"
-    mper_idx = segcalc.calc_proportion(idx='MINORITY')
-    print "Calculating Proportion of Students in a Magnet"
-    mag_idx = segcalc.calc_dependant_totals(sum_idx='MEMBER', dep_idx='MAGNET')
-    pmag_idx = segcalc.calc_prop(mag_idx, tot_idx)
-    print "Calculating Proportion of Students in a Charter"
-    chr_idx = segcalc.calc_dependant_totals(sum_idx='MEMBER', dep_idx='CHARTR')
-    pchr_idx = segcalc.calc_prop(chr_idx, tot_idx)
-    print "Calculating Proportion of Students in a Magnet or Charter"
-    chc_idx = segcalc.calc_dependant_totals(sum_idx='MEMBER', dep_idx='CHARTR', sec_dep_idx='MAGNET')
-    pchc_idx = segcalc.calc_prop(chc_idx, tot_idx)
+    print "Calculating Dissimilarity, Exposure and Isolation Indexes, Totals and Proportions"
+    group_results = segcalc.calc_groups(groups)
     print "Done with Calculations"
-    return (dis_idx, exp_idx, iso_idx, min_idx, tot_idx, mper_idx, pmag_idx, pchr_idx, pchc_idx)
+
+    datasets = []
+    for results in group_results:
+        datasets.append((
+            results['dis_idx'],
+            results['exp_idx'],
+            results['iso_idx'],
+            results['min_idx'],
+            results['tot_idx'],
+            results['mper_idx'],
+            results['pmag_idx'],
+            results['pchr_idx'],
+            results['pchc_idx']
+        ))
+    return datasets
+
+# -------------------------------------
+def calc_year(work):
+    """
+    Calculate every group for a year, or fetch them from the saved
+    results, the unit of work handed to each process with --jobs.
+
+    Returns (category_lut, category_lut2, datasets)
+    """
+    year, panel, idx, category, groups, results = work
+    parts = dict(report='segrete', data=panel.get_key(), year=year, idx=idx,
+            category=category, groups=groups)
+    return results.memo(parts, calc_luts_idxes, year, panel, idx, category, groups)
+
+# -------------------------------------
+def calc_luts_idxes(year, panel, idx, category, groups):
+    """
+    Load a year of data, look up the category names and calculate
+    every group
+    """
+    print "Loading NCES Data from:  %d" % year
+    schools = panel.load_year(year)
+    print "Finished Loading NCES Data from:  %d" % year
+
+    # Get our data query ready
+    segcalc = SegCalc(schools, idx)
+    if category == 'LEAID':
+        category_lut = panel.lookup(year, 'LEAID', 'LEANM')
+        category_lut2 = panel.lookup(year, 'LEAID', 'FIPS')
+    elif category == 'FIPS':
+        category_lut = dict(zip(fips_to_st.keys(), [fips_to_st[key][0] for key in fips_to_st.keys()]))
+        category_lut2 = None
+
+    print "Performing Calculations on Data from:  %d" % year
+    group_datasets = calc_idxes(segcalc, groups)
+    print "Finished Performing Calculations on Data from:  %d" % year
+    return (category_lut, category_lut2, group_datasets)
 
 # -------------------------------------
 def save_report(year_range, idxes, count, category_list, category_txt, category_txt2, filename):
@@ -134,6 +171,8 @@ def main(argv):
             help='Override the default list of years to report on')
     parser.add_argument('--max_record', action='store', dest='max_record', required=False,
             help='Override the default number of items to report')
+    add_jobs_argument(parser)
+    add_results_argument(parser)
     parser.add_argument('-debug', action='store_true', dest='debug', required=False,
             help='Debug Mode')
     args = parser.parse_args()
@@ -186,48 +225,36 @@ def main(argv):
         idx['MATCH_IDX'] = args.match_idx
         idx['MATCH_VAL'] = args.match_val
 
-    for i, group in enumerate(minorities):
-        idx['MINORITY'] = minorities[i]
-        idx['SEC_MINORITY'] = sec_minorities[i]
-        idx['MAJORITY'] = majorities[i]
-        print "*" * 80
-        print "Running all calculations with the following parameters"
-        print "*" * 80
-        print idx
-        print "*" * 80
-        DATASETS = 9
-        datasets = [[] for _ in range(DATASETS)]
-
-        for year in year_range:
-            print "Loading NCES Data from:  %d" % year
-            nces = NCESParser(year=year)
-            schools = nces.parse(make_dict=True)
-            print "Finished Loading NCES Data from:  %d" % year
-            if args.debug:
-                # print schools
-                pass
-            # Get our data query ready
-            segcalc = SegCalc(schools, idx)
-            if category == 'LEAID':
-                category_lut = segcalc.get_idxed_val('LEAID', 'LEANM')
-                category_lut2 = segcalc.get_idxed_val('LEAID', 'FIPS')
-            elif category == 'FIPS':
-                category_lut = dict(zip(fips_to_st.keys(), [fips_to_st[key][0] for key in fips_to_st.keys()]))
-                category_lut2 = None
-
-            print "Performing Calculations on Data from:  %d" % year
-            dataset = calc_idxes(segcalc)
-            print "Finished Performing Calculations on Data from:  %d" % year
+    groups = zip(minorities, sec_minorities, majorities)
+    print "*" * 80
+    print "Running all calculations with the following parameters"
+    print "*" * 80
+    print idx
+    for group in groups:
+        print "Minority: %s, Secondary Minority: %s, Majority: %s" % group
+    print "*" * 80
+    DATASETS = 9
+    datasets = [[[] for _ in range(DATASETS)] for group in groups]
 
-            print "Appending Yearly Data"
+    # Every group is calculated from the same pass over each year,
+    # the years come out of one multi-year panel and are spread
+    # over --jobs processes
+    panel = NCESPanel(year_range)
+    panel.load_cache()
+    results = ResultsCache(refresh=args.recalc)
+    work = [(year, panel, idx, category, groups, results) for year in year_range]
+    for category_lut, category_lut2, group_datasets in map_years(calc_year, work, args.jobs):
+        print "Appending Yearly Data"
+        for i, dataset in enumerate(group_datasets):
             for j in range(DATASETS):
-                datasets[j].append(dataset[j])
+                datasets[i][j].append(dataset[j])
 
+    for i, group in enumerate(groups):
         print "Sorting By Size of the last year"
-        category_by_size = sorted(dataset[4].iteritems(), key=operator.itemgetter(1), reverse=True)
+        category_by_size = sorted(datasets[i][4][-1].iteritems(), key=operator.itemgetter(1), reverse=True)
         category_list = []
-        for category, total in category_by_size:
-            category_list.append(category)
+        for cat, total in category_by_size:
+            category_list.append(cat)
         if args.debug:
             print "dist_dict = {"
             for cat in category_list:
@@ -237,7 +264,7 @@ def main(argv):
         print "Generating Report"
         save_report(
                 year_range,
-                datasets,
+                datasets[i],
                 report_count,
                 category_list,
                 category_lut,
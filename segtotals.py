@@ -11,6 +11,8 @@ from nces_parser import NCESParser
 
 from xlwt import Workbook
 from fips import fips_to_st
+from parallel import add_jobs_argument
+from parallel import map_years
 
 # ==============================================================================
 # Constants
@@ -29,6 +31,34 @@ def calc_totals(segcalc):
     percentages = segcalc.calc_percentages()
     return percentages
 
+# -------------------------------------
+def calc_year(work):
+    """
+    Load a year of data and calculate the totals, the unit of work
+    handed to each process with --jobs.
+
+    Returns (category_lut, category_lut2, percentages)
+    """
+    year, idx, category = work
+
+    print "Loading NCES Data from:  %d" % year
+    nces = NCESParser(year=year)
+    schools = nces.parse(make_dict=True)
+    print "Finished Loading NCES Data from:  %d" % year
+    # Get our data query ready
+    segcalc = SegCalc(schools, idx)
+    if category == 'LEAID':
+        category_lut = segcalc.get_idxed_val('LEAID', 'LEANM')
+        category_lut2 = segcalc.get_idxed_val('LEAID', 'FIPS')
+    elif category == 'FIPS':
+        category_lut = dict(zip(fips_to_st.keys(), [fips_to_st[key][0] for key in fips_to_st.keys()]))
+        category_lut2 = None
+
+    print "Performing Calculations on Data from:  %d" % year
+    percentages = calc_totals(segcalc)
+    print "Finished Performing Calculations on Data from:  %d" % year
+    return (category_lut, category_lut2, percentages)
+
 # -------------------------------------
 def save_totals(
     year_range,
@@ -123,6 +153,7 @@ def main(argv):
             help='Override the default list of years to report on')
     parser.add_argument('--max_record', action='store', dest='max_record', required=False,
             help='Override the default number of items to report')
+    add_jobs_argument(parser)
     parser.add_argument('-debug', action='store_true', dest='debug', required=False,
             help='Debug Mode')
     args = parser.parse_args()
@@ -159,23 +190,9 @@ def main(argv):
         idx['MATCH_VAL'] = args.match_val
 
     totals = []
-    for year in year_range:
-        print "Loading NCES Data from:  %d" % year
-        nces = NCESParser(year=year)
-        schools = nces.parse(make_dict=True)
-        print "Finished Loading NCES Data from:  %d" % year
-        # Get our data query ready
-        segcalc = SegCalc(schools, idx)
-        if category == 'LEAID':
-            category_lut = segcalc.get_idxed_val('LEAID', 'LEANM')
-            category_lut2 = segcalc.get_idxed_val('LEAID', 'FIPS')
-        elif category == 'FIPS':
-            category_lut = dict(zip(fips_to_st.keys(), [fips_to_st[key][0] for key in fips_to_st.keys()]))
-            category_lut2 = None
-
-        print "Performing Calculations on Data from:  %d" % year
-        totals.append(calc_totals(segcalc))
-        print "Finished Performing Calculations on Data from:  %d" % year
+    work = [(year, idx, category) for year in year_range]
+    for category_lut, category_lut2, percentages in map_years(calc_year, work, args.jobs):
+        totals.append(percentages)
 
     print "Sorting By Size of the last year"
     category_by_size = sorted([(key, value['MEMBER']) for key,value in totals[-1].iteritems()], key=operator.itemgetter(1), reverse=True)